@@ -21,6 +21,30 @@ import os
 from datetime import datetime
 
 
+def date_to_julian_day(my_date):
+    """
+    Returns the Julian day number of a date.
+    """
+
+    a = (14 - my_date.month) // 12
+    y = my_date.year + 4800 - a
+    m = my_date.month + 12 * a - 3
+
+    return my_date.day + ((153 * m + 2) // 5) + 365 * y + y // 4 - y // 100 + y // 400 - 32045
+
+
+def image_julian_day(fn):
+    """
+    Returns the Julian day number of the acquisition date in the file name of an image.
+    """
+    if "RapidEye" in fn:
+        my_date = os.path.basename(fn).split('_')[0]
+        return date_to_julian_day(datetime.strptime(my_date, "%Y%m%d"))
+    else:
+        my_date = os.path.basename(fn).split('_')[2]
+        return date_to_julian_day(datetime.strptime(my_date, "%Y-%m-%d"))
+
+
 class CreateFileLists(object):
     def __init__(self, outdir):
         self.outdir = outdir
@@ -29,12 +53,7 @@ class CreateFileLists(object):
         """
         Returns the Julian day number of a date.
         """
-
-        a = (14 - my_date.month) // 12
-        y = my_date.year + 4800 - a
-        m = my_date.month + 12 * a - 3
-
-        return my_date.day + ((153 * m + 2) // 5) + 365 * y + y // 4 - y // 100 + y // 400 - 32045
+        return date_to_julian_day(my_date)
 
     def create_file_lists(self):
 
@@ -46,13 +65,7 @@ class CreateFileLists(object):
         juldatelist = []
 
         for fn in infilelist:
-            if "RapidEye" in fn:
-                my_date = os.path.basename(fn).split('_')[0]
-                jul_date = self.date_to_julian_day(datetime.strptime(my_date, "%Y%m%d"))
-            else:
-                my_date = os.path.basename(fn).split('_')[2]
-                jul_date = self.date_to_julian_day(datetime.strptime(my_date, "%Y-%m-%d"))
-            juldatelist.append(jul_date)
+            juldatelist.append(image_julian_day(fn))
 
         ziplist = zip(juldatelist, infilelist)
         ziplist = list(ziplist)
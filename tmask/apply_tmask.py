@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Script to mask a new image with the stored TMASK model, without fitting it again
+
+The model is evaluated at the julian date of the image, and the image is thresholded
+and filtered in the same way as by create_cloud_masks.py.
+
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+from osgeo import gdal
+
+from data_prep.create_filelists import image_julian_day
+from tmask.create_cloud_masks import (calculate_tmask_model, cloud_mask_bytes, get_filename,
+                                      get_threshold_info, load_num_days, load_tmask_model)
+from tmask.datacube import read_image
+from tmask.image_writer import write_image
+from tools.folders_handle import (COEFFICIENTS_FOLDER,
+                                  RESULTS_FOLDER)
+
+
+def read_new_image(img_file, coeffs, juldate=None):
+    """
+    Read a new image to mask with a loaded TMASK model
+
+    :param img_file: TOAR image to mask, of the same AOI as the model
+    :param coeffs: coefficients of the model, of shape (bands, 5, rows, cols)
+    :param juldate: julian date of the image, or None to take it from the file name
+    :return: tuple of the julian date, the image of shape (1, bands, rows, cols), and its projection and
+             geotransform
+
+    """
+    if juldate is None:
+        juldate = image_julian_day(img_file)
+    bands, params, rows, cols = coeffs.shape
+
+    # The image is opened once, for its size, its bands and its georeferencing
+    image = np.empty((1, bands, rows, cols), dtype=np.uint16)
+    img = gdal.Open(img_file, gdal.GA_ReadOnly)
+    if (img.RasterYSize, img.RasterXSize) != (rows, cols):
+        raise ValueError("Image %s is %dx%d, but the model is %dx%d" %
+                         (img_file, img.RasterXSize, img.RasterYSize, cols, rows))
+    read_image(img_file, image[0], bands=bands, img=img)
+    projection, geotransform = img.GetProjection(), img.GetGeoTransform()
+    img = None
+
+    return juldate, image, projection, geotransform
+
+
+def mask_image(img_file, image, predicted, projection, geotransform, threshold_info, results_folder,
+               filter_size=3, min_clump=0, creation_options=None):
+    """
+    Threshold a new image against its prediction by the TMASK model, and write its mask
+
+    :param img_file: TOAR image being masked, which the mask is named after
+    :param image: the image, as read by read_new_image()
+    :param predicted: the prediction of the image, of shape (1, bands, rows, cols)
+    :param projection: projection of the image
+    :param geotransform: geotransform of the image
+    :param threshold_info: tuple containing array of threshold value and flat if dynamic thresholding is used
+    :param results_folder: Folder where the mask is stored
+    :param filter_size: size of the majority filter which removes very small clumps
+    :param min_clump: clumps of fewer pixels are removed after the majority filter
+    :param creation_options: list of GDAL creation options of the mask
+    :return: tuple of the filename of the mask and the mask
+
+    """
+    rows, cols = image.shape[2:]
+    thresholds_cloud, dynamic = threshold_info
+    cloud_byte = cloud_mask_bytes(image, predicted, np.asarray(thresholds_cloud), dynamic, filter_size, min_clump)[0]
+
+    image_info = (gdal.GetDriverByName('GTiff'), cols, rows, projection, geotransform)
+    fn = get_filename(results_folder, '_cloud', img_file)
+    write_image(fn, image_info, gdal.GDT_Byte, cloud_byte, 1, options=creation_options)
+
+    return fn, cloud_byte
+
+
+def score_image(img_file, juldates, coeffs, threshold_info, results_folder, juldate=None,
+                filter_size=3, min_clump=0, creation_options=None, num_days=None):
+    """
+    Create the cloud/cloud shadow mask of a new image from a loaded TMASK model
+
+    :param img_file: TOAR image to mask, of the same AOI as the model
+    :param juldates: julian dates the model was fitted to
+    :param coeffs: coefficients of the model, of shape (bands, 5, rows, cols)
+    :param threshold_info: tuple containing array of threshold value and flat if dynamic thresholding is used
+    :param results_folder: Folder where the mask is stored
+    :param juldate: julian date of the image, or None to take it from the file name
+    :param filter_size: size of the majority filter which removes very small clumps
+    :param min_clump: clumps of fewer pixels are removed after the majority filter
+    :param creation_options: list of GDAL creation options of the mask
+    :param num_days: inter-annual period the model was fitted with, or None for the length of juldates
+    :return: tuple of the filename of the mask and the mask
+
+    """
+    juldate, image, projection, geotransform = read_new_image(img_file, coeffs, juldate=juldate)
+
+    # The inter-annual period of the model is the length of the series it was fitted to
+    if num_days is None:
+        num_days = int(juldates[-1] - juldates[0])
+    predicted = calculate_tmask_model(np.array([juldate]), coeffs, num_days=num_days)
+
+    return mask_image(img_file, image, predicted, projection, geotransform, threshold_info, results_folder,
+                      filter_size=filter_size, min_clump=min_clump, creation_options=creation_options)
+
+
+def apply_tmask(img_file, threshold_info, coefficients_folder, results_folder, juldate=None,
+                filter_size=3, min_clump=0, creation_options=None):
+    """
+    Create the cloud/cloud shadow mask of a new image from the stored TMASK model
+
+    :param img_file: TOAR image to mask, of the same AOI as the model
+    :param threshold_info: tuple containing array of threshold value and flat if dynamic thresholding is used
+    :param coefficients_folder: Folder where coefficients were stored by the TMASK model
+    :param results_folder: Folder where the mask is stored
+    :param juldate: julian date of the image, or None to take it from the file name
+    :param filter_size: size of the majority filter which removes very small clumps
+    :param min_clump: clumps of fewer pixels are removed after the majority filter
+    :param creation_options: list of GDAL creation options of the mask
+    :return: filename of the mask
+
+    """
+    juldates, coeffs = load_tmask_model(coefficients_folder)
+    fn, cloud_byte = score_image(img_file, juldates, coeffs, threshold_info, results_folder, juldate=juldate,
+                                 filter_size=filter_size, min_clump=min_clump, creation_options=creation_options,
+                                 num_days=load_num_days(coefficients_folder))
+
+    print('Clouds: %.1f%%, cloud shadows: %.1f%%' %
+          (100.0 * np.mean(cloud_byte == 2), 100.0 * np.mean(cloud_byte == 1)))
+    return fn
+
+
+def parse_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images',
+                        nargs='+',
+                        help='new TOAR images to mask')
+    parser.add_argument('--juldate',
+                        type=float,
+                        help='julian date of the image (default: taken from the file name)',
+                        default=None)
+    parser.add_argument('--dynamic-threshold',
+                        action='store_true',
+                        help='use a dynamic threshold based on RMSE instead of static ones',
+                        default=False)
+    parser.add_argument('--filter-size',
+                        type=int,
+                        help='size of the majority filter which removes very small clumps from the masks',
+                        default=3)
+    parser.add_argument('--min-clump',
+                        type=int,
+                        help='remove clumps of fewer pixels from the masks after filtering',
+                        default=0)
+    parser.add_argument('--co',
+                        action='append',
+                        metavar='NAME=VALUE',
+                        help='GDAL creation option of the masks; can be given more than once',
+                        default=[])
+
+    args = parser.parse_args()
+    if args.juldate is not None and len(args.images) > 1:
+        parser.error('--juldate can only be given for a single image')
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_params()
+    if not os.path.exists(RESULTS_FOLDER):
+        os.makedirs(RESULTS_FOLDER)
+    threshold_info = get_threshold_info(args, COEFFICIENTS_FOLDER)
+    for img_file in args.images:
+        start = time.time()
+        apply_tmask(img_file, threshold_info, COEFFICIENTS_FOLDER, RESULTS_FOLDER, juldate=args.juldate,
+                    filter_size=args.filter_size, min_clump=args.min_clump, creation_options=args.co)
+
+        elapsed = time.time() - start
+        print('Elapsed time (applying TMASK to %s): %g seconds' % (img_file, elapsed))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare the coarse-to-fine fit with a full fit of a synthetic image stack of land
+cover patches, for a range of tolerances. For each, the fraction of pixels fitted at
+full resolution, the time taken, and how far the predictions and RMSE are from those
+of the full fit are reported.
+"""
+
+import numpy
+import time
+import argparse
+
+from tmask import robustregression
+from tmask import tile_fit
+from tmask import coarse_fit
+from tmask.tests.synthetic import make_stack
+
+
+def fit_full(x, stack, numThreads, backend):
+    numImages, numBands, numRows, numCols = stack.shape
+    c = numpy.zeros((numBands, len(x), numRows, numCols), dtype=numpy.float32)
+    rmse = numpy.zeros((numBands, numRows, numCols), dtype=numpy.float32)
+    tile_fit.fit_stack(x, stack, c, rmse, numThreads=numThreads, backend=backend)
+    return c, rmse
+
+
+def fit_coarse(x, stack, factor, tolerance, numThreads, backend):
+    numImages, numBands, numRows, numCols = stack.shape
+    c = numpy.zeros((numBands, len(x), numRows, numCols), dtype=numpy.float32)
+    rmse = numpy.zeros((numBands, numRows, numCols), dtype=numpy.float32)
+    results = coarse_fit.fit_stack_coarse(x, stack, c, rmse, factor, tolerance=tolerance, numThreads=numThreads,
+                                          backend=backend, sampleFraction=0)
+    return c, rmse, results
+
+
+def parse_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size',
+                        type=int,
+                        help='width of the square AOI to fit, in pixels',
+                        default=256)
+    parser.add_argument('--images',
+                        type=int,
+                        help='number of images in the stack',
+                        default=100)
+    parser.add_argument('--patch-size',
+                        type=int,
+                        help='width of the square land cover patches, in pixels',
+                        default=32)
+    parser.add_argument('--factor',
+                        type=int,
+                        help='width of the blocks of the coarse grid, in pixels',
+                        default=4)
+    parser.add_argument('--tolerances',
+                        type=float,
+                        nargs='+',
+                        help='tolerances of the robust RMSE of the interpolated model, in TOAR units',
+                        default=[0, 30, 50, 100, 200])
+    parser.add_argument('--threads',
+                        type=int,
+                        help='number of threads used to fit the regressions',
+                        default=1)
+    parser.add_argument('--backend',
+                        choices=robustregression.BACKENDS,
+                        help='regression implementation: the GSL C extension, or batched numpy IRLS',
+                        default=robustregression.BACKEND_GSL)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_params()
+    numBands = 4
+
+    x, stack = make_stack(args.images, numBands, args.size, args.size, patchSize=args.patch_size,
+                          cloudFraction=0.05, nullFraction=0.05)
+    start = time.time()
+    (fullC, fullRmse) = fit_full(x, stack, args.threads, args.backend)
+    fullTime = time.time() - start
+    fullPredicted = numpy.einsum('pd,bprc->dbrc', x, fullC)
+    print('Full fit of %dx%d pixels: %.3f s' % (args.size, args.size, fullTime))
+
+    print('%10s %10s %10s %8s %16s %16s %10s' % ('tolerance', 'refit (%)', 'time (s)', 'speedup',
+                                                 'mean pred diff', 'max pred diff', 'RMSE ratio'))
+    for tolerance in args.tolerances:
+        start = time.time()
+        (c, rmse, results) = fit_coarse(x, stack, args.factor, tolerance, args.threads, args.backend)
+        elapsed = time.time() - start
+        diff = numpy.abs(numpy.einsum('pd,bprc->dbrc', x, c) - fullPredicted)
+        fitted = fullRmse > 0
+        print('%10g %10.1f %10.3f %8.2f %16.2f %16.2f %10.3f' %
+              (tolerance, 100.0 * results.numRefitted / results.numPixels, elapsed, fullTime / elapsed,
+               diff.mean(), diff.max(), rmse[fitted].mean() / fullRmse[fitted].mean()))
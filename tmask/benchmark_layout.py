@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare the time taken to fit a synthetic image stack in the image-major layout,
+as it is read from the images, and in the pixel-major layout, where the stack is
+transposed tile by tile as tmask_model does. The pixel-major times include the
+time taken by the transposes.
+"""
+
+import numpy
+import time
+import argparse
+
+from tmask import robustregression
+from tmask import tile_fit
+from tmask.tests.synthetic import make_stack
+
+
+def fit_image_major(x, stack, numThreads):
+    robustregression.gsl_multifit_robust_multiband(x, stack, nullVal=0, numThreads=numThreads,
+                                                   regStats=robustregression.REGSTATS_MINIMAL)
+
+
+def fit_pixel_major(x, stack, numThreads, blockBytes):
+    numImages, numBands, numRows, numCols = stack.shape
+    c = numpy.zeros((numBands, len(x), numRows, numCols), dtype=numpy.float32)
+    rmse = numpy.zeros((numBands, numRows, numCols), dtype=numpy.float32)
+    tile_fit.fit_stack(x, stack, c, rmse, numThreads=numThreads, blockBytes=blockBytes)
+
+
+def best_time(func, repeats, *args):
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def parse_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        help='widths of the square AOIs to fit, in pixels',
+                        default=[64, 256, 1024])
+    parser.add_argument('--images',
+                        type=int,
+                        help='number of images in the stack',
+                        default=200)
+    parser.add_argument('--threads',
+                        type=int,
+                        help='number of threads used to fit the regressions',
+                        default=1)
+    parser.add_argument('--repeats',
+                        type=int,
+                        help='number of timings of each fit, of which the best is reported',
+                        default=3)
+    parser.add_argument('--block-mb',
+                        type=int,
+                        help='size of the pixel-major blocks, in MB',
+                        default=64)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_params()
+    numBands = 4
+
+    print('%10s %10s %16s %16s %8s' % ('AOI', 'stack MB', 'image-major (s)', 'pixel-major (s)', 'speedup'))
+    for size in args.sizes:
+        x, stack = make_stack(args.images, numBands, size, size)
+        imageMajor = best_time(fit_image_major, args.repeats, x, stack, args.threads)
+        pixelMajor = best_time(fit_pixel_major, args.repeats, x, stack, args.threads,
+                               args.block_mb * 1024 * 1024)
+        print('%10s %10.1f %16.3f %16.3f %8.2f' % ('%dx%d' % (size, size), stack.nbytes / 1e6,
+                                                   imageMajor, pixelMajor, imageMajor / pixelMajor))
@@ -0,0 +1,304 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Coarse-to-fine fitting of the TMASK regressions.
+
+Neighbouring pixels usually have almost the same seasonal curves. The stack is first
+reduced to the median of blocks of factor x factor pixels, and the regressions are
+fitted on this coarse grid. The coarse coefficients are interpolated bilinearly to
+every pixel, and each pixel's robust RMSE about the interpolated model is worked out
+from its own observations. Only the pixels where this is more than a tolerance are
+fitted at full resolution, and get the same coefficients as a full fit. The others
+keep the interpolated model, with the rmse which a full fit ending at it reports.
+"""
+
+import numpy
+
+from tmask import irls
+from tmask import robustregression
+from tmask import tile_fit
+
+# Robust RMSE of the interpolated model, in TOAR units, above which a pixel is fitted
+# at full resolution
+COARSE_TOLERANCE = 100.0
+
+# Fraction of the interpolated pixels which are also fitted at full resolution, to
+# measure the accuracy of the interpolated model
+SAMPLE_FRACTION = 0.01
+
+MAD_SCALE = 0.6745
+
+
+def block_values(a, factor):
+    """
+    Rearrange an array of shape (..., numRows, numCols) into blocks of factor x factor
+    pixels, with shape (..., coarseRows, coarseCols, factor * factor). The blocks at the
+    bottom and right edges are padded with zeros if the image size is not a multiple of
+    factor.
+    """
+    (numRows, numCols) = a.shape[-2:]
+    coarseRows = -(-numRows // factor)
+    coarseCols = -(-numCols // factor)
+    padded = numpy.zeros(a.shape[:-2] + (coarseRows * factor, coarseCols * factor), dtype=a.dtype)
+    padded[..., :numRows, :numCols] = a
+    padded = padded.reshape(a.shape[:-2] + (coarseRows, factor, coarseCols, factor))
+    padded = numpy.moveaxis(padded, -3, -2)
+    return padded.reshape(padded.shape[:-2] + (factor * factor,))
+
+
+def masked_median(values, valid):
+    """
+    Return the median over the last axis of values, of those which are valid, which is
+    broadcast against values. The median of none is NaN.
+
+    This is much faster than numpy.nanmedian() over a short axis.
+    """
+    n = values.shape[-1]
+    valid = numpy.broadcast_to(valid, values.shape)
+    count = valid.sum(axis=-1).ravel()
+    ordered = numpy.sort(numpy.where(valid, values, numpy.inf), axis=-1).reshape((-1, n))
+    pixels = numpy.arange(len(ordered))
+    lower = ordered[pixels, numpy.maximum(count - 1, 0) // 2]
+    upper = ordered[pixels, numpy.minimum(count // 2, n - 1)]
+    with numpy.errstate(invalid='ignore'):
+        median = numpy.where(count > 0, (lower + upper) / 2, numpy.nan)
+    return median.reshape(values.shape[:-1])
+
+
+def valid_observations(stack, excludeMask=None):
+    """
+    Return the boolean array, of shape (numImages, numRows, numCols), of the observations
+    of the stack which the fit uses: those which are not 0 in any band, and not in the
+    packed excludeMask if it is given (see robustregression.pack_mask()).
+    """
+    valid = numpy.all(stack != 0, axis=1)
+    if excludeMask is not None:
+        valid &= numpy.unpackbits(excludeMask, axis=-1)[..., :stack.shape[3]] == 0
+    return valid
+
+
+def aggregate_stack(stack, factor, excludeMask=None):
+    """
+    Take the median of the uint16 stack, of shape (numImages, numBands, numRows, numCols),
+    over blocks of factor x factor pixels, leaving out the observations which the fit
+    would (see valid_observations()). The median, unlike the mean, isn't pulled away by
+    a few cloudy pixels of a block. A block with no valid observations is 0, so it is
+    left out of the coarse fit. The images are aggregated one at a time, so the working
+    memory is a few images.
+    """
+    (numImages, numBands, numRows, numCols) = stack.shape
+    coarse = numpy.zeros((numImages, numBands, -(-numRows // factor), -(-numCols // factor)), dtype=numpy.uint16)
+    for i in range(numImages):
+        mask = None if excludeMask is None else excludeMask[i:i + 1]
+        valid = block_values(valid_observations(stack[i:i + 1], mask)[0], factor)
+        median = masked_median(block_values(stack[i], factor), valid)
+        coarse[i] = numpy.where(numpy.isnan(median), 0, numpy.round(median))
+    return coarse
+
+
+def interpolation_weights(size, coarseSize, factor):
+    """
+    Return the (lower, upper, weight) of bilinear interpolation of a coarse axis of
+    coarseSize blocks at the centres of the size pixels of the full resolution axis
+    """
+    position = numpy.clip((numpy.arange(size) + 0.5) / factor - 0.5, 0, coarseSize - 1)
+    lower = numpy.floor(position).astype(numpy.int64)
+    upper = numpy.minimum(lower + 1, coarseSize - 1)
+    return lower, upper, position - lower
+
+
+def interpolate_coeffs(coarseC, factor, numRows, numCols):
+    """
+    Interpolate coefficients of shape (..., coarseRows, coarseCols), fitted to blocks of
+    factor x factor pixels, bilinearly to the numRows x numCols pixels
+    """
+    (rowLower, rowUpper, rowWeight) = interpolation_weights(numRows, coarseC.shape[-2], factor)
+    (colLower, colUpper, colWeight) = interpolation_weights(numCols, coarseC.shape[-1], factor)
+    rows = (coarseC[..., rowLower, :] * (1 - rowWeight)[:, None] + coarseC[..., rowUpper, :] * rowWeight[:, None])
+    return rows[..., colLower] * (1 - colWeight) + rows[..., colUpper] * colWeight
+
+
+def residual_rmse(x, stack, c, valid):
+    """
+    Return the robust RMSE of each pixel about the model c, from the median absolute
+    residual of its valid observations, and the RMSE to store for it, both with shape
+    (numBands, numRows, numCols). stack and valid are as for valid_observations(), and
+    c has shape (numBands, numParams, numRows, numCols). The robust RMSE of pixels with
+    no valid observations is NaN, and the stored RMSE of pixels with no more valid
+    observations than parameters is 0.
+
+    The stored RMSE is the one a full fit reports if it ends at the model c (see
+    irls.model_rmse()), so it is on the same scale as those of the refitted pixels.
+    """
+    numParams = len(x)
+    numImages = len(valid)
+    enough = (valid.sum(axis=0) > numParams).ravel()
+    xT = numpy.ascontiguousarray(x.T, dtype=numpy.double)
+    validFit = valid.reshape((numImages, -1)).compress(enough, axis=1)
+
+    # The time series of each pixel is made the last axis, so its median is contiguous
+    pixelValid = numpy.moveaxis(valid, 0, -1)
+    robust = numpy.empty(c.shape[:1] + c.shape[2:], dtype=numpy.float64)
+    rmse = numpy.zeros(robust.shape, dtype=numpy.float64)
+    rmseFlat = rmse.reshape((len(rmse), -1))
+    for band in range(c.shape[0]):
+        predicted = numpy.einsum('prc,pd->rcd', c[band], x)
+        residual = numpy.abs(numpy.moveaxis(stack[:, band], 0, -1) - predicted)
+        robust[band] = masked_median(residual, pixelValid) / MAD_SCALE
+        if enough.any():
+            y = stack[:, band].reshape((numImages, -1)).compress(enough, axis=1).astype(numpy.double)
+            cFit = c[band].reshape((numParams, -1)).compress(enough, axis=1).astype(numpy.double)
+            rmseFlat[band, enough] = irls.model_rmse(xT, y, validFit, cFit)
+    return robust, rmse
+
+
+def fit_selected(x, stack, c, rmse, selected, numThreads=1, backend=robustregression.BACKEND_GSL,
+                 excludeMask=None):
+    """
+    Fit the selected pixels of the stack at full resolution, writing their coefficients
+    and rmse into c and rmse, which are as for tile_fit.fit_stack(). selected is a
+    boolean array of shape (numRows, numCols), and excludeMask is as for
+    tile_fit.fit_rows().
+
+    The selected pixels are gathered into a pixel-major stack of one row per thread,
+    and fitted just as they are by a full fit, so their results are the same.
+
+    Returns the number of GSL allocations avoided.
+    """
+    (rows, cols) = numpy.nonzero(selected)
+    numSelected = len(rows)
+    numRows = max(1, min(numThreads, numSelected))
+    numCols = -(-numSelected // numRows)
+    (numImages, numBands) = stack.shape[:2]
+
+    # The padding pixels at the end are all zeros, so they are not fitted
+    block = numpy.zeros((numRows * numCols, numImages, numBands), dtype=stack.dtype)
+    block[:numSelected] = stack[:, :, rows, cols].transpose((2, 0, 1))
+    block = block.reshape((numRows, numCols, numImages, numBands))
+    mask = None
+    if excludeMask is not None:
+        excluded = numpy.zeros((numImages, numRows * numCols), dtype=bool)
+        excluded[:, :numSelected] = numpy.unpackbits(excludeMask, axis=-1)[:, :, :stack.shape[3]][:, rows, cols]
+        mask = robustregression.pack_mask(excluded.reshape((numImages, numRows, numCols)))
+
+    regObj = robustregression.gsl_multifit_robust_multiband(x, block, method=robustregression.GSL_METHOD_BISQUARE,
+                                                            nullVal=0, numThreads=numThreads, backend=backend,
+                                                            regStats=robustregression.REGSTATS_MINIMAL,
+                                                            layout=robustregression.LAYOUT_PIXEL_MAJOR,
+                                                            excludeMask=mask)
+    numParams = len(x)
+    c[:, :, rows, cols] = regObj.coeffs.reshape((numBands, numParams, -1))[:, :, :numSelected]
+    rmse[:, rows, cols] = regObj.rmse.reshape((numBands, -1))[:, :numSelected]
+    return regObj.numAllocsAvoided
+
+
+class CoarseFitResults(object):
+    """
+    Summary of a coarse-to-fine fit.
+
+    Attributes:
+        numAllocsAvoided    Number of GSL allocations saved by reusing workspaces
+        numPixels           Number of pixels in the stack
+        numRefitted         Number of pixels fitted at full resolution
+        numSampled          Number of the interpolated pixels which were also fitted at
+                            full resolution, to estimate the accuracy of the others
+        meanPredictionDiff  Mean absolute difference between the predictions of the
+                            interpolated and full fits of the sampled pixels, over all
+                            dates and bands, in TOAR units
+        maxPredictionDiff   Largest absolute difference of the predictions
+        meanRmseDiff        Mean difference between the rmse of the interpolated and
+                            full fits of the sampled pixels
+
+    """
+
+
+def fit_stack_coarse(x, stack, c, rmse, factor, tolerance=COARSE_TOLERANCE, numThreads=1,
+                     backend=robustregression.BACKEND_GSL, blockBytes=tile_fit.FIT_BLOCK_BYTES, excludeMask=None,
+                     sampleFraction=SAMPLE_FRACTION):
+    """
+    Fit the whole stack coarse-to-fine, filling c and rmse in place as
+    tile_fit.fit_stack() does. The stack is fitted on a grid of blocks of
+    factor x factor pixels, and each pixel where the robust RMSE of the interpolated
+    model is more than tolerance, in any band, is fitted again at full resolution.
+    Pixels with fewer valid observations than parameters are left as zeros, as in a
+    full fit. excludeMask is as for tile_fit.fit_rows().
+
+    A random sampleFraction of the pixels which keep the interpolated model are also
+    fitted at full resolution, without changing their results, to measure how far the
+    interpolated model is from a full fit.
+
+    Returns a CoarseFitResults.
+    """
+    (numImages, numBands, numRows, numCols) = stack.shape
+    numParams = len(x)
+
+    coarse = aggregate_stack(stack, factor, excludeMask)
+    coarseC = numpy.zeros((numBands, numParams) + coarse.shape[2:], dtype=numpy.float32)
+    coarseRmse = numpy.zeros((numBands,) + coarse.shape[2:], dtype=numpy.float32)
+    numAllocsAvoided = tile_fit.fit_stack(x, coarse, coarseC, coarseRmse, numThreads=numThreads, backend=backend,
+                                          blockBytes=blockBytes)
+    coarse = None
+    c[...] = interpolate_coeffs(coarseC, factor, numRows, numCols)
+
+    # Each tile of rows is checked against the interpolated model, and its outlying
+    # pixels fitted again. The residuals are worked out in double precision.
+    rows = tile_fit.tile_rows(stack.shape, numpy.dtype(numpy.float64).itemsize, numThreads=numThreads,
+                              blockBytes=blockBytes)
+    rng = numpy.random.RandomState(0)
+    numRefitted = 0
+    numSampled = 0
+    (sumPredictionDiff, maxPredictionDiff, sumRmseDiff) = (0.0, 0.0, 0.0)
+    for rowStart in range(0, numRows, rows):
+        rowEnd = min(rowStart + rows, numRows)
+        tileStack = stack[:, :, rowStart:rowEnd]
+        tileMask = None if excludeMask is None else excludeMask[:, rowStart:rowEnd]
+        tileC = c[:, :, rowStart:rowEnd]
+        tileRmse = rmse[:, rowStart:rowEnd]
+        valid = valid_observations(tileStack, tileMask)
+        enough = valid.sum(axis=0) >= numParams
+
+        (interpRmse, storedRmse) = residual_rmse(x, tileStack, tileC, valid)
+        tileRmse[...] = numpy.where(enough, storedRmse, 0)
+        tileC *= enough
+
+        selected = enough & numpy.any(interpRmse > tolerance, axis=0)
+        sampled = enough & ~selected & (rng.uniform(size=selected.shape) < sampleFraction)
+        if sampled.any():
+            fullC = numpy.zeros(tileC.shape, dtype=numpy.float32)
+            fullRmse = numpy.zeros(tileRmse.shape, dtype=numpy.float32)
+            numAllocsAvoided += fit_selected(x, tileStack, fullC, fullRmse, sampled, numThreads=numThreads,
+                                             backend=backend, excludeMask=tileMask)
+            diff = numpy.abs(numpy.einsum('pd,bpn->dbn', x, (tileC - fullC)[:, :, sampled]))
+            sumPredictionDiff += diff.mean() * sampled.sum()
+            maxPredictionDiff = max(maxPredictionDiff, float(diff.max()))
+            sumRmseDiff += (tileRmse - fullRmse)[:, sampled].mean() * sampled.sum()
+            numSampled += int(sampled.sum())
+
+        if selected.any():
+            numAllocsAvoided += fit_selected(x, tileStack, tileC, tileRmse, selected, numThreads=numThreads,
+                                             backend=backend, excludeMask=tileMask)
+            numRefitted += int(selected.sum())
+
+    results = CoarseFitResults()
+    results.numAllocsAvoided = numAllocsAvoided
+    results.numPixels = numRows * numCols
+    results.numRefitted = numRefitted
+    results.numSampled = numSampled
+    results.meanPredictionDiff = sumPredictionDiff / max(numSampled, 1)
+    results.maxPredictionDiff = maxPredictionDiff
+    results.meanRmseDiff = sumRmseDiff / max(numSampled, 1)
+    return results
@@ -0,0 +1,204 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+A georeferenced store of the arrays written by the TMASK model.
+
+Each array, of shape (..., numRows, numCols), is written to a tiled and compressed
+GeoTIFF with one band for each element of the leading dimensions, e.g. the coefficients
+of shape (bands, params, numRows, numCols) are bands*params bands. The GeoTIFF has the
+projection and geotransform of the images, and its metadata records the shape.
+
+A RasterArray opens a stored array lazily, and indexing it reads only the bands and
+the window of pixels that are asked for, so it can be used in place of the memory
+mapped .npy files. Opened for update, assigning to it writes the same bands and window
+back in place.
+"""
+
+import os
+import itertools
+import threading
+
+import numpy
+from osgeo import gdal
+
+# Formats the TMASK model can write the whole arrays in
+FORMAT_NPY = 'npy'
+FORMAT_GEOTIFF = 'geotiff'
+FORMATS = [FORMAT_NPY, FORMAT_GEOTIFF]
+
+COEFFS_STORE_FILE = 'tmask_coeffs.tif'
+RMSE_STORE_FILE = 'tmask_rmse.tif'
+ANALYTIC_STORE_FILE = 'tmask_analytic.tif'
+
+SHAPE_METADATA = 'TMASK_SHAPE'
+STORE_BLOCK_SIZE = 256
+STORE_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=%d' % STORE_BLOCK_SIZE, 'BLOCKYSIZE=%d' % STORE_BLOCK_SIZE,
+                 'COMPRESS=DEFLATE', 'INTERLEAVE=BAND', 'BIGTIFF=IF_SAFER']
+
+GDAL_TYPES = {numpy.dtype(numpy.uint8): gdal.GDT_Byte,
+              numpy.dtype(numpy.uint16): gdal.GDT_UInt16,
+              numpy.dtype(numpy.float32): gdal.GDT_Float32}
+
+
+def write_array(fn, array, projection, geotransform, options=STORE_OPTIONS):
+    """
+    Write an array of shape (..., numRows, numCols) to the store fn, a band at a time,
+    so a memory mapped array is never read all at once. The floating point predictor
+    is used for float arrays and the horizontal one for integers.
+    """
+    dtype = numpy.dtype(array.dtype)
+    leadShape = array.shape[:-2]
+    (numRows, numCols) = array.shape[-2:]
+    numBands = int(numpy.prod(leadShape))
+    predictor = 'PREDICTOR=3' if dtype.kind == 'f' else 'PREDICTOR=2'
+
+    print('Writing file "%s"' % fn)
+    drv = gdal.GetDriverByName('GTiff')
+    ds = drv.Create(fn, numCols, numRows, numBands, GDAL_TYPES[dtype], options=list(options) + [predictor])
+    ds.SetProjection(projection)
+    ds.SetGeoTransform(geotransform)
+    ds.SetMetadataItem(SHAPE_METADATA, ','.join(str(n) for n in array.shape))
+    for band, index in enumerate(numpy.ndindex(*leadShape)):
+        ds.GetRasterBand(band + 1).WriteArray(numpy.asarray(array[index]))
+    ds.FlushCache()
+    ds = None
+
+
+def axis_window(key, size):
+    """
+    Return the (start, stop) of the range of indices which key selects from an axis
+    of the given size, and the key which selects the same indices from that range
+    """
+    if isinstance(key, slice):
+        indices = range(size)[key]
+        if len(indices) == 0:
+            return 0, 0, slice(0, 0)
+        (start, stop) = (min(indices[0], indices[-1]), max(indices[0], indices[-1]) + 1)
+        if key.step is not None and key.step < 0:
+            return start, stop, slice(stop - start - 1, None, key.step)
+        return start, stop, slice(0, stop - start, key.step)
+    if numpy.ndim(key) == 0 and not isinstance(key, (bool, numpy.bool_)):
+        start = range(size)[int(key)]
+        return start, start + 1, 0
+    indices = numpy.arange(size)[key]
+    if indices.size == 0:
+        return 0, 0, indices
+    start = int(indices.min())
+    return start, int(indices.max()) + 1, indices - start
+
+
+class RasterArray(object):
+    """
+    An array held in the store fn, which is read lazily. Indexing it gives the same
+    result as indexing the array that was written, but only reads the bands and the
+    window of pixels that are selected. If update is True, assigning to it writes the
+    selected elements back to the store, as for a memory map opened with mode 'r+'.
+    """
+    def __init__(self, fn, update=False):
+        self.fn = fn
+        self.ds = gdal.Open(fn, gdal.GA_Update if update else gdal.GA_ReadOnly)
+        shape = self.ds.GetMetadataItem(SHAPE_METADATA)
+        if shape is None:
+            shape = '%d,%d,%d' % (self.ds.RasterCount, self.ds.RasterYSize, self.ds.RasterXSize)
+        self.shape = tuple(int(n) for n in shape.split(','))
+        self.dtype = numpy.dtype(self.ds.GetRasterBand(1).ReadAsArray(0, 0, 1, 1).dtype)
+        self.projection = self.ds.GetProjection()
+        self.geotransform = self.ds.GetGeoTransform()
+
+        # GDAL datasets can't be read from more than one thread at a time
+        self.lock = threading.Lock()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def windows(self, key):
+        """
+        Return the axis_window() of each axis for key
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return [axis_window(k, n) for k, n in zip(key, self.shape)]
+
+    def bands(self, windows):
+        """
+        Return the (index, band) of each band selected by windows, where index is its
+        position in the leading dimensions of the window
+        """
+        # Only the bands which are selected from the leading dimensions are used
+        leadIndices = [numpy.unique(numpy.arange(stop - start)[k]) for (start, stop, k) in windows[:-2]]
+        for index in itertools.product(*leadIndices):
+            band = numpy.ravel_multi_index([start + i for (start, stop, k), i in zip(windows, index)],
+                                           self.shape[:-2])
+            yield index, self.ds.GetRasterBand(int(band) + 1)
+
+    def read_window(self, windows):
+        """
+        Read the window of the array given by windows
+        """
+        data = numpy.zeros([stop - start for (start, stop, k) in windows], dtype=self.dtype)
+        if data.size:
+            (rowStart, rowStop, rowKey) = windows[-2]
+            (colStart, colStop, colKey) = windows[-1]
+            for index, band in self.bands(windows):
+                data[index] = band.ReadAsArray(colStart, rowStart, colStop - colStart, rowStop - rowStart)
+        return data
+
+    def __getitem__(self, key):
+        windows = self.windows(key)
+        with self.lock:
+            data = self.read_window(windows)
+        return data[tuple(k for (start, stop, k) in windows)]
+
+    def __setitem__(self, key, value):
+        windows = self.windows(key)
+        (rowStart, rowStop, rowKey) = windows[-2]
+        (colStart, colStop, colKey) = windows[-1]
+        with self.lock:
+            data = self.read_window(windows)
+            data[tuple(k for (start, stop, k) in windows)] = value
+            if data.size:
+                for index, band in self.bands(windows):
+                    band.WriteArray(data[index], colStart, rowStart)
+
+    def flush(self):
+        with self.lock:
+            self.ds.FlushCache()
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+
+def open_array(folder, npyFile, storeFile, update=False):
+    """
+    Open an array written by the TMASK model, memory mapping the .npy file if it was
+    written, and otherwise opening the store. Returns None if there is neither. If
+    update is True, the array can be written to in place.
+    """
+    if os.path.exists(os.path.join(folder, npyFile)):
+        return numpy.load(os.path.join(folder, npyFile), mmap_mode='r+' if update else 'r')
+    if os.path.exists(os.path.join(folder, storeFile)):
+        return RasterArray(os.path.join(folder, storeFile), update=update)
+    return None
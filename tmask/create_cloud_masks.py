@@ -22,37 +22,114 @@ import argparse
 
 from osgeo import gdal
 import numpy as np
-import scipy.ndimage.filters as filters
 
+from tmask.majority_filter import majority_filter
+from tmask.image_writer import ImageWriter
+from tmask.mask_cube import MaskCube, MASK_CUBE_FILE
+from tmask.roi import bbox_window, read_geojson_bbox, window_geotransform
+from tmask.datacube import Datacube, DatacubeError
+from tmask.coeff_store import open_array, RasterArray, COEFFS_STORE_FILE, RMSE_STORE_FILE, ANALYTIC_STORE_FILE
 from tools.folders_handle import (create_or_clean_folder,
                                   COEFFICIENTS_FOLDER,
                                   ANALYTIC_LIST_FILE,
+                                  DATACUBE_FOLDER,
                                   RESULTS_FOLDER)
 
 
-def calculate_tmask_model(juldates, coeffs):
-    fits = []
-    num_days = int(juldates[-1] - juldates[0])
-    constant_fitted = coeffs[:, 0]
+# Number of dates predicted at a time, which bounds the size of the temporaries
+PREDICTION_CHUNK_DATES = 16
 
-    for juldate in juldates:
-        cosT_fitted = np.multiply(np.cos(2.0 * np.pi * juldate / 365), coeffs[:, 1])
-        sinT_fitted = np.multiply(np.sin(2.0 * np.pi * juldate / 365), coeffs[:, 2])
-        cosNT_fitted = np.multiply(np.cos(2.0 * np.pi * juldate / num_days), coeffs[:, 3])
-        sinNT_fitted = np.multiply(np.sin(2.0 * np.pi * juldate / num_days), coeffs[:, 4])
-        val = constant_fitted + cosT_fitted + sinT_fitted + cosNT_fitted + sinNT_fitted
-        fits += [val]
 
-    return np.array(fits)
+def harmonic_basis(juldates, num_days):
+    """
+    Evaluate the TMASK regressors for each date, in the order of the coefficients
+
+    :param juldates: julian dates to evaluate
+    :param num_days: length of the whole time series in days, which sets the inter-annual period
+    :return: array of shape (5, dates)
+
+    """
+    return np.array([np.ones(len(juldates)),
+                     np.cos(2.0 * np.pi * juldates / 365),
+                     np.sin(2.0 * np.pi * juldates / 365),
+                     np.cos(2.0 * np.pi * juldates / num_days),
+                     np.sin(2.0 * np.pi * juldates / num_days)])
+
+
+def calculate_tmask_model(juldates, coeffs, dates=None, window=None, chunk_dates=PREDICTION_CHUNK_DATES,
+                          num_days=None):
+    """
+    Predict the images from the TMASK model
+
+    The basis is evaluated once for all the dates, and contracted with the coefficients
+    in float32, a chunk of dates at a time. The terms are added in the order of the
+    coefficients, so the predictions are the same as adding them one date at a time.
+
+    :param juldates: julian dates of the whole time series
+    :param coeffs: coefficients of shape (bands, 5, rows, cols)
+    :param dates: indices of the dates to predict, or None for all of them
+    :param window: (xoff, yoff, xsize, ysize) of the part of the image to predict, or None
+    :param chunk_dates: number of dates predicted at a time
+    :param num_days: length in days of the time series the model was fitted to, if that is not juldates
+    :return: float32 array of shape (dates, bands, rows, cols)
+
+    """
+    juldates = np.asarray(juldates)
+    if num_days is None:
+        num_days = int(juldates[-1] - juldates[0])
+    if dates is not None:
+        juldates = juldates[dates]
+    basis = harmonic_basis(juldates, num_days).T.astype(np.float32)
 
+    if window is not None:
+        xoff, yoff, xsize, ysize = window
+        coeffs = coeffs[:, :, yoff:yoff + ysize, xoff:xoff + xsize]
+    coeffs = np.asarray(coeffs, dtype=np.float32)
 
-def get_fitted_curve(coefficients_folder):
+    fits = np.empty((len(juldates),) + coeffs[:, 0].shape, dtype=np.float32)
+    for start in range(0, len(juldates), chunk_dates):
+        chunk = fits[start:start + chunk_dates]
+        chunk[:] = coeffs[:, 0]
+        for param in range(1, coeffs.shape[1]):
+            chunk += basis[start:start + chunk_dates, param, None, None, None] * coeffs[:, param]
+
+    return fits
+
+
+def load_tmask_model(coefficients_folder):
+    """
+    Load the julian dates and the memory mapped coefficients of the TMASK model
+
+    :param coefficients_folder: Folder where coefficients were stored by the TMASK model
+    :return: tuple (juldates, coeffs), where coeffs is memory mapped or read lazily from the coefficient store
+
+    """
     outDatefile = os.path.join(coefficients_folder, "tmask_date.npy")
     juldates = np.load(outDatefile)
-    outCoeffile = os.path.join(coefficients_folder, "tmask_coeffs_complete.npy")
-    coeffs = np.load(outCoeffile)
+    coeffs = open_array(coefficients_folder, "tmask_coeffs_complete.npy", COEFFS_STORE_FILE)
 
-    return calculate_tmask_model(juldates, coeffs)
+    return juldates, coeffs
+
+
+def load_num_days(coefficients_folder):
+    """
+    Load the inter-annual period the TMASK model was fitted with
+
+    :param coefficients_folder: Folder where coefficients were stored by the TMASK model
+    :return: the period in days, or None if the model did not store it, in which case it is the length of its dates
+
+    """
+    outDaysfile = os.path.join(coefficients_folder, "tmask_num_days.npy")
+    if not os.path.exists(outDaysfile):
+        return None
+    return int(np.load(outDaysfile))
+
+
+def get_fitted_curve(coefficients_folder, dates=None, window=None):
+    juldates, coeffs = load_tmask_model(coefficients_folder)
+
+    return calculate_tmask_model(juldates, coeffs, dates=dates, window=window,
+                                 num_days=load_num_days(coefficients_folder))
 
 
 def get_analytic_img_filelist(analytic_list_file):
@@ -70,16 +147,37 @@ def get_analytic_img_filelist(analytic_list_file):
     return [fn.rstrip() for fn in img_files]
 
 
+def open_analytic_stack(coefficients_folder, img_files, datacube_folder=DATACUBE_FOLDER):
+    """
+    Open the analytic image stack without reading it all into memory
+
+    :param coefficients_folder: Folder where coefficients were stored by the TMASK model
+    :param img_files: list of input TOAR images
+    :param datacube_folder: Folder of the datacube, used if the TMASK model did not save the stack
+    :return: memory mapped stack, coefficient store or datacube, of shape (images, bands, rows, cols)
+
+    """
+    outAnfile = os.path.join(coefficients_folder, "tmask_analytic_complete.npy")
+    analytic_stack = open_array(coefficients_folder, "tmask_analytic_complete.npy", ANALYTIC_STORE_FILE)
+    if analytic_stack is not None:
+        return analytic_stack
+
+    # The TMASK model was run with --datacube, so the stack is only held there
+    datacube = Datacube(datacube_folder, img_files)
+    if not datacube.is_complete():
+        raise DatacubeError("Neither %s nor an up to date datacube in %s was found" % (outAnfile, datacube_folder))
+    return datacube
+
+
 def get_threshold_info(args, coef_folder, default_threshold=0.04):
-    outRMSEfile = os.path.join(coef_folder, "tmask_rmse.npy")
-    rmse = np.load(outRMSEfile)
+    rmse = open_array(coef_folder, "tmask_rmse.npy", RMSE_STORE_FILE)
 
     # Start thresholding
     if args.dynamic_threshold:
         thresholds_cloud = rmse
     else:
         # need to multiply by 10000 because of scaling of TOAR
-        thresholds_cloud = np.ones_like(rmse) * default_threshold * 10000
+        thresholds_cloud = np.ones(rmse.shape, dtype=rmse.dtype) * default_threshold * 10000
 
     return (thresholds_cloud, args.dynamic_threshold)
 
@@ -91,110 +189,168 @@ def get_projection_data(ref_img):
     return projection, geotransform
 
 
+def get_model_projection_data(coefficients_folder, ref_img):
+    """
+    Return the projection and geotransform of the TMASK model, from the coefficient
+    store if it was written, and otherwise from the reference image
+    """
+    coeffs_store = os.path.join(coefficients_folder, COEFFS_STORE_FILE)
+    if os.path.exists(coeffs_store):
+        coeffs = RasterArray(coeffs_store)
+        return coeffs.projection, coeffs.geotransform
+    return get_projection_data(ref_img)
+
+
 def get_filename(folder, prefix, img_file):
     return os.path.join(folder, prefix.join(os.path.splitext(os.path.split(img_file)[1])))
 
 
-def write_image(fn, img_info, datatype, image, bands):
+def threshold_images(images, predicted, thresholds_cloud, dynamic):
     """
-    Write an image to disk
+    Find the clouds and cloud shadows in a batch of images
 
-    :param fn: filename
-    :param img_info: tuple with all necessary image information
-    :param datatype: image datatype
-    :param image: numpy array with image values
-    :param bands: number of bands
-    :return: no return value
+    :param images: analytic images of shape (dates, bands, rows, cols)
+    :param predicted: predicted images from the TMASK model, of the same shape
+    :param thresholds_cloud: array of threshold values of shape (bands, rows, cols)
+    :param dynamic: flag if dynamic thresholding is used
+    :return: tuple of boolean arrays (clouds, cloud_shadows), of shape (dates, rows, cols)
 
     """
-    drv, height, width, projection, geotransform = img_info
-    print('Writing file "%s"' % fn)
-    ds = drv.Create(fn, height, width, bands, datatype)
-    ds.SetProjection(projection)
-    ds.SetGeoTransform(geotransform)
-    if bands == 1:
-        outband = ds.GetRasterBand(bands)
-        outband.WriteArray(image)
+    # Apply thresholds therefore creating two boolean arrays for each band
+    residuals = images - predicted
+    above_t = residuals > thresholds_cloud
+    below_minus_t = residuals < -thresholds_cloud
+
+    # Combine boolean arrays
+    if dynamic:
+        # for PlanetScope it often seems to work better using a dynamic threshold to all bands
+        # 1- clouds if the values are above the threshold for all bands in one image
+        # 2- cloud shadows if the values are below the threshold for all bands in one image
+        clouds = np.all(above_t, axis=1)
+        cloud_shadows = np.all(below_minus_t, axis=1)
     else:
-        for band in range(bands):
-            outband = ds.GetRasterBand(band + 1)
-            outband.WriteArray(image[band])
-    del ds
+        # Here we follow the original TMASK paper
+        # We can't compute the snow index as we don't have a SWIR band therefore we omit the whole cloud vs snow check
+        clouds = above_t[:, 1]
+        cloud_shadows = np.logical_and(np.logical_not(above_t[:, 1]), below_minus_t[:, 3])
 
+    return clouds, cloud_shadows
 
-def create_cloud_masks(img_files, threshold_info, coefficients_folder, results_folder):
+
+def cloud_mask_bytes(images, predicted, thresholds_cloud, dynamic, filter_size=3, min_clump=0):
     """
-    Create synthetic prediction images and cloud/cloud shadow masks
+    Create the cloud/cloud shadow masks of a batch of images
+
+    :param images: analytic images of shape (dates, bands, rows, cols)
+    :param predicted: predicted images from the TMASK model, of the same shape
+    :param thresholds_cloud: array of threshold values of shape (bands, rows, cols)
+    :param dynamic: flag if dynamic thresholding is used
+    :param filter_size: size of the majority filter which removes very small clumps
+    :param min_clump: clumps of fewer pixels are removed after the majority filter
+    :return: byte array of shape (dates, rows, cols) with 2 for clouds and 1 for cloud shadows
+
+    """
+    clouds, cloud_shadows = threshold_images(images, predicted, thresholds_cloud, dynamic)
+
+    # set all values in clouds to 2, and cloud_shadows to 1
+    # use a majority filter, the same as a median filter of boolean arrays, to get rid of very small clumps
+    return majority_filter(clouds, filter_size, min_clump).astype(np.byte) * 2 \
+        + majority_filter(cloud_shadows, filter_size, min_clump).astype(np.byte)
+
+
+def create_cloud_masks(img_files, threshold_info, coefficients_folder, results_folder, batch_dates=1,
+                       filter_size=3, min_clump=0, write_threads=2, creation_options=None,
+                       write_predictions=False, mask_cube=False, window=None):
+    """
+    Create cloud/cloud shadow masks, and optionally synthetic prediction images
+
+    The images are handled batch_dates at a time: each batch is predicted, thresholded,
+    filtered and queued to be written before the next is read, so the memory used does
+    not grow with the length of the time series. The images are written by
+    write_threads background threads while the next batch is computed.
 
     :param img_files: list of input TOAR images
     :param threshold_info: tuple containing array of threshold value and flat if dynamic thresholding is used
     :param coefficients_folder: Folder where coefficients were stored by the TMASK model
     :param results_folder: Folder where result images are stored
+    :param batch_dates: number of images handled at a time
+    :param filter_size: size of the majority filter which removes very small clumps
+    :param min_clump: clumps of fewer pixels are removed after the majority filter
+    :param write_threads: number of threads writing the images
+    :param creation_options: list of GDAL creation options of the images, e.g. ['COMPRESS=DEFLATE']
+    :param write_predictions: flag if the prediction images are written too (see render_predictions.py)
+    :param mask_cube: flag if the masks of all the dates are also written to one cube (see mask_cube.py)
+    :param window: (xoff, yoff, xsize, ysize) of the region of interest to mask, or None for the whole AOI.
+                   Clumps crossing its edge are measured within it for min_clump.
     :return: no return value
 
     """
 
     # Dims like image slices, bands, pix X, pix Y
-    outAnfile = os.path.join(coefficients_folder, "tmask_analytic_complete.npy")
-    analytic_stack = np.load(outAnfile)
+    analytic_stack = open_analytic_stack(coefficients_folder, img_files)
     num_imgs, bands, width, height = analytic_stack.shape
     gtiff_drv = gdal.GetDriverByName('GTiff')
-    projection, geotransform = get_projection_data(img_files[0])
-
-    image_info = (gtiff_drv, height, width, projection, geotransform)
-
-    # Write out prediction images for visualisation/debugging purposes
-    predicted_stack = get_fitted_curve(coefficients_folder)
-    for i, image in enumerate(predicted_stack):
-        fn = get_filename(results_folder, '_pred', img_files[i])
-        write_image(fn, image_info, gdal.GDT_Float32, image, bands)
-
-    band1_above_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band2_above_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band3_above_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band4_above_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band1_below_minus_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band2_below_minus_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band3_below_minus_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-    band4_below_minus_t = np.zeros((num_imgs, 1, width, height), dtype=bool)
-
+    projection, geotransform = get_model_projection_data(coefficients_folder, img_files[0])
+
+    # Only the region of interest of the arrays is read, with a margin for the majority
+    # filter, so the filtered masks are the same as those of the whole AOI. Clumps are
+    # only measured within the margin though, so with min_clump a clump which crosses
+    # the edge of the region may be removed when it would be kept for the whole AOI.
+    if window is None:
+        window = (0, 0, height, width)
+    xoff, yoff, xsize, ysize = window
+    margin = filter_size // 2
+    rows = slice(max(0, yoff - margin), min(width, yoff + ysize + margin))
+    cols = slice(max(0, xoff - margin), min(height, xoff + xsize + margin))
+    read_window = (cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+    crop = (slice(yoff - rows.start, yoff - rows.start + ysize), slice(xoff - cols.start, xoff - cols.start + xsize))
+
+    image_info = (gtiff_drv, xsize, ysize, projection, window_geotransform(geotransform, xoff, yoff))
+
+    juldates, coeffs = load_tmask_model(coefficients_folder)
+    num_days = load_num_days(coefficients_folder)
     thresholds_cloud, dynamic = threshold_info
-    # Apply thresholds therefore creating eight boolean arrays
-    for i in range(num_imgs):
-        band1_above_t[i][0] = (analytic_stack[i][0] - predicted_stack[i][0]) > thresholds_cloud[0]
-        band2_above_t[i][0] = (analytic_stack[i][1] - predicted_stack[i][1]) > thresholds_cloud[1]
-        band3_above_t[i][0] = (analytic_stack[i][2] - predicted_stack[i][2]) > thresholds_cloud[2]
-        band4_above_t[i][0] = (analytic_stack[i][3] - predicted_stack[i][3]) > thresholds_cloud[3]
-
-        band1_below_minus_t[i][0] = (analytic_stack[i][0] - predicted_stack[i][0]) < -thresholds_cloud[0]
-        band2_below_minus_t[i][0] = (analytic_stack[i][1] - predicted_stack[i][1]) < -thresholds_cloud[1]
-        band3_below_minus_t[i][0] = (analytic_stack[i][2] - predicted_stack[i][2]) < -thresholds_cloud[2]
-        band4_below_minus_t[i][0] = (analytic_stack[i][3] - predicted_stack[i][3]) < -thresholds_cloud[3]
-
-    # Combine boolean arrays
-    if dynamic:
-        # for PlanetScope it often seems to work better using a dynamic threshold to all bands
-        # 1- clouds if the values are above the threshold for all bands in one image
-        # 2- cloud shadows if the values are below the threshold for all bands in one image
-        clouds = band1_above_t * band2_above_t * band3_above_t * band4_above_t
-        cloud_shadows = band1_below_minus_t * band2_below_minus_t * band3_below_minus_t * band4_below_minus_t
-    else:
-        # Here we follow the original TMASK paper
-        # We can't compute the snow index as we don't have a SWIR band therefore we omit the whole cloud vs snow check
-        clouds = band2_above_t
-        cloud_shadows = np.logical_and(np.logical_not(band2_above_t), band4_below_minus_t)
-
-    # create output mask images
-    for i in range(num_imgs):
-        # set all values in clouds to 2, and cloud_shadows to 1
-        # use a median filter to get rid of very small clumps
-        cloud_byte = filters.median_filter(clouds[i][0], size=(3,3)).astype(np.byte) \
-                     * 2 + filters.median_filter(cloud_shadows[i][0], size=(3,3)).astype(np.byte)
-
-        # only write cloud/shadow masks if anything is detected
-        if np.any(cloud_byte):
-            fn = get_filename(results_folder, '_cloud', img_files[i])
-            write_image(fn, image_info, gdal.GDT_Byte, cloud_byte, 1)
+    thresholds_cloud = thresholds_cloud[:, rows, cols]
+
+    # The coefficient store is decompressed whenever it is read, so its window is read once
+    coeffs_window = read_window
+    if isinstance(coeffs, RasterArray):
+        coeffs = coeffs[:, :, rows, cols]
+        coeffs_window = None
+
+    cube = None
+    if mask_cube:
+        cube = MaskCube(os.path.join(results_folder, MASK_CUBE_FILE), image_info, juldates, img_files)
+
+    # The cube is closed even if a batch fails, so what was written to it is flushed
+    try:
+        with ImageWriter(numThreads=write_threads, options=creation_options) as writer:
+            for start in range(0, num_imgs, batch_dates):
+                dates = np.arange(start, min(start + batch_dates, num_imgs))
+                predicted_stack = calculate_tmask_model(juldates, coeffs, dates=dates, window=coeffs_window,
+                                                        num_days=num_days)
+
+                # Write out prediction images for visualisation/debugging purposes
+                if write_predictions:
+                    for i, predicted in zip(dates, predicted_stack):
+                        fn = get_filename(results_folder, '_pred', img_files[i])
+                        writer.write(fn, image_info, gdal.GDT_Float32, predicted[(slice(None),) + crop], bands)
+
+                cloud_bytes = cloud_mask_bytes(analytic_stack[dates[0]:dates[-1] + 1, :, rows, cols], predicted_stack,
+                                               thresholds_cloud, dynamic, filter_size, min_clump)
+                cloud_bytes = cloud_bytes[(slice(None),) + crop]
+
+                for i, cloud_byte in zip(dates, cloud_bytes):
+                    if cube is not None:
+                        cube.write(i, cloud_byte)
+
+                    # only write cloud/shadow masks if anything is detected
+                    if np.any(cloud_byte):
+                        fn = get_filename(results_folder, '_cloud', img_files[i])
+                        writer.write(fn, image_info, gdal.GDT_Byte, cloud_byte, 1)
+    finally:
+        if cube is not None:
+            cube.close()
 
 
 def parse_params():
@@ -203,8 +359,79 @@ def parse_params():
                         action='store_true',
                         help='use a dynamic threshold based on RMSE instead of static ones',
                         default=False)
-
-    return parser.parse_args()
+    parser.add_argument('--filter-size',
+                        type=int,
+                        help='size of the majority filter which removes very small clumps from the masks',
+                        default=3)
+    parser.add_argument('--min-clump',
+                        type=int,
+                        help='remove clumps of fewer pixels from the masks after filtering',
+                        default=0)
+    parser.add_argument('--write-threads',
+                        type=int,
+                        help='number of threads writing the result images',
+                        default=2)
+    parser.add_argument('--co',
+                        action='append',
+                        metavar='NAME=VALUE',
+                        help='GDAL creation option of the result images, e.g. TILED=YES, COMPRESS=DEFLATE '
+                             'or PREDICTOR=2; can be given more than once',
+                        default=[])
+    parser.add_argument('--write-predictions',
+                        action='store_true',
+                        help='also write the prediction images, for visualisation and debugging',
+                        default=False)
+    parser.add_argument('--mask-cube',
+                        action='store_true',
+                        help='also write the masks of all the dates to one 2 bit GeoTIFF, with a date index',
+                        default=False)
+    roi = parser.add_mutually_exclusive_group()
+    roi.add_argument('--bbox',
+                     type=float,
+                     nargs=4,
+                     metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                     help='only mask this bounding box, in the coordinates of the images',
+                     default=None)
+    roi.add_argument('--geojson',
+                     help='only mask the bounding box of the geometry in this GeoJSON file, in WGS84 '
+                          'longitude and latitude or the CRS named by its crs member',
+                     default=None)
+    roi.add_argument('--window',
+                     type=int,
+                     nargs=4,
+                     metavar=('XOFF', 'YOFF', 'XSIZE', 'YSIZE'),
+                     help='only mask this window of the AOI, in pixels',
+                     default=None)
+
+    args = parser.parse_args()
+    if args.min_clump > 1 and (args.bbox is not None or args.geojson is not None or args.window is not None):
+        print('Warning: --min-clump measures the clumps within the region of interest, so clumps crossing '
+              'its edge may be removed when they would be kept for the whole AOI')
+
+    return args
+
+
+def roi_window(args, img_files, coefficients_folder):
+    """
+    Return the pixel window of the region of interest given by args, or None for the whole AOI
+    """
+    if args.window is not None:
+        return tuple(args.window)
+    if args.bbox is None and args.geojson is None:
+        return None
+
+    projection, geotransform = get_model_projection_data(coefficients_folder, img_files[0])
+    if args.bbox is not None:
+        bbox = args.bbox
+    elif not projection:
+        raise ValueError("The images have no projection, so %s can't be transformed to their coordinates" %
+                         args.geojson)
+    else:
+        bbox = read_geojson_bbox(args.geojson, projection)
+    juldates, coeffs = load_tmask_model(coefficients_folder)
+    window = bbox_window(geotransform, bbox, coeffs.shape[3], coeffs.shape[2])
+    print('Masking the window %s of the AOI' % (window,))
+    return window
 
 
 if __name__ == "__main__":
@@ -213,7 +440,11 @@ if __name__ == "__main__":
     create_or_clean_folder(RESULTS_FOLDER)
     analytic_img_filelist = get_analytic_img_filelist(ANALYTIC_LIST_FILE)
     threshold_info = get_threshold_info(args, COEFFICIENTS_FOLDER)
-    create_cloud_masks(analytic_img_filelist, threshold_info, COEFFICIENTS_FOLDER, RESULTS_FOLDER)
+    create_cloud_masks(analytic_img_filelist, threshold_info, COEFFICIENTS_FOLDER, RESULTS_FOLDER,
+                       filter_size=args.filter_size, min_clump=args.min_clump,
+                       write_threads=args.write_threads, creation_options=args.co,
+                       write_predictions=args.write_predictions, mask_cube=args.mask_cube,
+                       window=roi_window(args, analytic_img_filelist, COEFFICIENTS_FOLDER))
 
     elapsed = time.time() - start
     print('Elapsed time (cloud mask creation): %g seconds' % (elapsed))
\ No newline at end of file
@@ -43,6 +43,8 @@ def draw_plots(plots_folder, coeff_folder):
         juldate_end = int(d[-1])
         juldate = np.linspace(juldate_start, juldate_end, juldate_end - juldate_start)
         num_days = juldate_end - juldate_start
+        if os.path.exists(os.path.join(coeff_folder, 'tmask_num_days.npy')):
+            num_days = int(np.load(os.path.join(coeff_folder, 'tmask_num_days.npy')))
         daysPerYear = 365
 
         constant = np.ones(juldate.shape)
@@ -0,0 +1,263 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Reading of the analytic images and UDMs, and a persistent on-disk datacube of them.
+
+The datacube holds each image as its own uint16 .npy chunk, of shape
+(bands, numRows, numCols), which is memory mapped when it is used. The cloud bits
+of the UDMs are held in the same way, as chunks packed 8 columns to a byte. A
+manifest records the path, mtime and size of the file each chunk was read from, so
+a chunk is only read again when its file changes, and adding scenes to the image
+list only reads the new ones. Both the fit and the mask stage can open the cube, and
+only the parts they touch are paged in.
+"""
+
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from osgeo import gdal
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class DatacubeError(Exception):
+    """
+    Raised when the datacube can't be used for the given images.
+    """
+    pass
+
+
+def read_image(fn, out, bands=4, window=None, img=None):
+    """
+    Read the bands of the analytic image fn into out, which has shape
+    (bands, numRows, numCols). If window is given, it is the (xoff, yoff, xsize, ysize)
+    of the part of the image to read. img is the GDAL dataset of fn if it is already
+    open. Returns the number of bytes read.
+    """
+    if img is None:
+        img = gdal.Open(fn.rstrip(), gdal.GA_ReadOnly)
+    if window is None:
+        window = ()
+
+    for band in range(1, bands+1):
+        # Read raster as arrays
+        if 'RapidEye' in fn and band >= 4:
+            print ('RE case')
+            banddataraster = img.GetRasterBand(band + 1)
+        else:
+            banddataraster = img.GetRasterBand(band)
+
+        out[band - 1] = banddataraster.ReadAsArray(*window)
+
+    img = None
+    return out.nbytes
+
+
+def udm_filename(fn):
+    """
+    Return the name of the UDM which goes with the analytic image fn
+    """
+    udm_fn = fn.replace('_resampled_toar', '_udm_resampled')
+    udm_fn = udm_fn.replace('_toar', '_udm')
+
+    udm_fn = udm_fn.replace('toar_images', 'input')
+    return udm_fn.rstrip()
+
+
+def read_cloud_mask(fn, window=None):
+    """
+    Return the cloud bit of the UDM which goes with the analytic image fn, as a boolean
+    array. window is as for read_image().
+    """
+    # Open UDM and extract cloud bit
+    udm = gdal.Open(udm_filename(fn), gdal.GA_ReadOnly)
+    udm_band = udm.GetRasterBand(1)
+    if window is None:
+        window = ()
+    udmraster = udm_band.ReadAsArray(*window)
+    udm = None
+
+    # Extract cloud bit in a boolean array
+    return (numpy.bitwise_and(udmraster, 2)).astype(numpy.bool)
+
+
+def file_state(fn):
+    """
+    Return the (mtime, size) of a file, which change whenever it is rewritten
+    """
+    stat = os.stat(fn)
+    return [stat.st_mtime, stat.st_size]
+
+
+def chunk_name(fn, suffix):
+    """
+    Return the name of the chunk file for the image fn. It is derived from the path, so
+    the same image always goes to the same chunk.
+    """
+    return '%s_%s.npy' % (hashlib.sha1(fn.encode('utf-8')).hexdigest()[:20], suffix)
+
+
+class Datacube(object):
+    """
+    A persistent memory mapped stack of the images in analyticFiles, held in folder.
+
+    Indexing the cube with an image number gives that image, with shape
+    (bands, numRows, numCols), as a read only memory map. Indexing with a tuple whose
+    first element is a slice, e.g. cube[:, :, row, col], gives the same result as
+    indexing the whole stack of shape (numImages, bands, numRows, numCols).
+
+    update() must be called to bring the chunks up to date before the cube is used.
+    """
+    def __init__(self, folder, analyticFiles, bands=4):
+        self.folder = folder
+        self.analyticFiles = [fn.rstrip() for fn in analyticFiles]
+        self.bands = bands
+        self.manifest = {'bands': bands, 'images': {}}
+        self.chunks = {}
+
+        manifestFile = os.path.join(folder, MANIFEST_FILE)
+        if os.path.exists(manifestFile):
+            with open(manifestFile) as f:
+                manifest = json.load(f)
+            if manifest.get('bands') == bands:
+                self.manifest = manifest
+
+    def is_current(self, fn, useUdm=False):
+        """
+        Return True if the chunk of image fn, and its cloud mask if useUdm is True, were
+        read from the files as they are now
+        """
+        entry = self.manifest['images'].get(fn)
+        if entry is None or not os.path.exists(fn) or entry['state'] != file_state(fn):
+            return False
+        if not os.path.exists(os.path.join(self.folder, entry['chunk'])):
+            return False
+        if useUdm:
+            udm_fn = udm_filename(fn)
+            if ('udmState' not in entry or 'cloudChunk' not in entry or not os.path.exists(udm_fn) or
+                    entry['udmState'] != file_state(udm_fn) or
+                    not os.path.exists(os.path.join(self.folder, entry['cloudChunk']))):
+                return False
+        return True
+
+    def ingest(self, fn, useUdm):
+        """
+        Read one image, and its cloud mask if useUdm is True, into their chunks. Returns the
+        new manifest entry and the number of bytes read.
+        """
+        entry = {'state': file_state(fn), 'chunk': chunk_name(fn, 'analytic')}
+        img = gdal.Open(fn, gdal.GA_ReadOnly)
+        shape = (self.bands, img.RasterYSize, img.RasterXSize)
+        img = None
+
+        chunk = numpy.lib.format.open_memmap(os.path.join(self.folder, entry['chunk']), mode='w+',
+                                             dtype=numpy.uint16, shape=shape)
+        numBytes = read_image(fn, chunk, bands=self.bands)
+        chunk.flush()
+        chunk = None
+
+        if useUdm:
+            udm_fn = udm_filename(fn)
+            entry['udmState'] = file_state(udm_fn)
+            entry['cloudChunk'] = chunk_name(fn, 'cloud')
+            cloud_mask = read_cloud_mask(fn)
+            numpy.save(os.path.join(self.folder, entry['cloudChunk']), numpy.packbits(cloud_mask, axis=-1))
+            numBytes += cloud_mask.size
+
+        return entry, numBytes
+
+    def update(self, useUdm=False, numThreads=1):
+        """
+        Read every image whose chunk is missing or out of date, using a pool of numThreads
+        threads, and save the manifest. Returns the number of images read.
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        stale = [fn for fn in self.analyticFiles if not self.is_current(fn, useUdm)]
+        with ThreadPoolExecutor(max_workers=numThreads) as executor:
+            results = list(executor.map(lambda fn: self.ingest(fn, useUdm), stale))
+
+        for fn, (entry, numBytes) in zip(stale, results):
+            self.manifest['images'][fn] = entry
+        self.chunks = {}
+
+        # Write the manifest under a temporary name first, so it is never left half written
+        manifestFile = os.path.join(self.folder, MANIFEST_FILE)
+        with open(manifestFile + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.rename(manifestFile + '.tmp', manifestFile)
+
+        print('Datacube: read %d of %d images, %.1f MB' %
+              (len(stale), len(self.analyticFiles), sum(numBytes for entry, numBytes in results) / 1e6))
+        return len(stale)
+
+    def is_complete(self, useUdm=False):
+        """
+        Return True if every image is in the cube and up to date
+        """
+        return all(self.is_current(fn, useUdm) for fn in self.analyticFiles)
+
+    def chunk(self, i, key='chunk'):
+        """
+        Return the memory map of a chunk of image i, opening it the first time it is used
+        """
+        fn = self.analyticFiles[i]
+        if (fn, key) not in self.chunks:
+            entry = self.manifest['images'].get(fn)
+            if entry is None or key not in entry:
+                raise DatacubeError("Image %s is not in the datacube in %s" % (fn, self.folder))
+            self.chunks[(fn, key)] = numpy.load(os.path.join(self.folder, entry[key]), mmap_mode='r')
+        return self.chunks[(fn, key)]
+
+    def cloud_mask(self, i):
+        """
+        Return the cloud mask of image i, packed along the columns as by numpy.packbits(),
+        with shape (numRows, (numCols + 7) // 8)
+        """
+        return self.chunk(i, 'cloudChunk')
+
+    @property
+    def shape(self):
+        return (len(self.analyticFiles),) + self.chunk(0).shape
+
+    def __len__(self):
+        return len(self.analyticFiles)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if isinstance(key[0], slice):
+            return numpy.array([self.chunk(i)[key[1:]] for i in range(len(self))[key[0]]])
+        return self.chunk(key[0])[key[1:]]
+
+    def read_block(self, out, rowStart=0, rowEnd=None, cloudMask=None):
+        """
+        Copy rows rowStart to rowEnd of every image into out, of shape
+        (numImages, bands, rowEnd - rowStart, numCols). If cloudMask is given, the same
+        rows of the packed cloud masks are copied into it, with shape
+        (numImages, rowEnd - rowStart, (numCols + 7) // 8).
+        """
+        if rowEnd is None:
+            rowEnd = self.shape[2]
+        for i in range(len(self)):
+            out[i] = self.chunk(i)[:, rowStart:rowEnd]
+            if cloudMask is not None:
+                cloudMask[i] = self.cloud_mask(i)[rowStart:rowEnd]
@@ -0,0 +1,134 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Writing of the result images, in background threads.
+
+GDAL releases the GIL while it encodes and writes an image, so with an ImageWriter the
+next image can be computed while the last ones are written. The queues of images
+waiting to be written are bounded, so the images don't pile up in memory when the
+writes are slower than the computation.
+"""
+
+import time
+import queue
+import threading
+
+
+def write_image(fn, img_info, datatype, image, bands, options=None):
+    """
+    Write an image to disk
+
+    :param fn: filename
+    :param img_info: tuple with all necessary image information
+    :param datatype: image datatype
+    :param image: numpy array with image values
+    :param bands: number of bands
+    :param options: list of GDAL creation options, e.g. ['TILED=YES', 'COMPRESS=DEFLATE']
+    :return: no return value
+
+    """
+    drv, height, width, projection, geotransform = img_info
+    print('Writing file "%s"' % fn)
+    ds = drv.Create(fn, height, width, bands, datatype, options=options or [])
+    ds.SetProjection(projection)
+    ds.SetGeoTransform(geotransform)
+    if bands == 1:
+        outband = ds.GetRasterBand(bands)
+        outband.WriteArray(image)
+    else:
+        for band in range(bands):
+            outband = ds.GetRasterBand(band + 1)
+            outband.WriteArray(image[band])
+    del ds
+
+
+class ImageWriter(object):
+    """
+    Write images with write_image() in a pool of numThreads threads. Each thread has its
+    own queue, of up to queueSize images, and the images with the same filename always
+    go to the same thread, so they are written in the order they were queued. options
+    are the GDAL creation options for every image.
+
+    close() must be called once all the images have been queued, or the writer used as
+    a context manager. It waits for the writes to finish, raises the first error from
+    any of them, and prints the write latencies.
+    """
+    def __init__(self, numThreads=2, queueSize=8, options=None):
+        self.options = options
+        self.queues = [queue.Queue(maxsize=queueSize) for i in range(numThreads)]
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = []
+        self.threads = [threading.Thread(target=self.run, args=(q,)) for q in self.queues]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def write(self, fn, img_info, datatype, image, bands):
+        """
+        Queue an image to be written, as for write_image(). The image must not be changed
+        afterwards.
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.queues[hash(fn) % len(self.queues)].put((fn, img_info, datatype, image, bands))
+
+    def run(self, imageQueue):
+        while True:
+            item = imageQueue.get()
+            if item is None:
+                break
+
+            start = time.time()
+            try:
+                write_image(*item, options=self.options)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+                continue
+
+            elapsed = time.time() - start
+            print('Wrote file "%s" in %.1f ms' % (item[0], elapsed * 1000))
+            with self.lock:
+                self.latencies.append(elapsed)
+
+    def close(self):
+        for imageQueue in self.queues:
+            imageQueue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        if self.latencies:
+            print('Wrote %d files, mean %.1f ms, max %.1f ms per file' %
+                  (len(self.latencies), 1000 * sum(self.latencies) / len(self.latencies),
+                   1000 * max(self.latencies)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            # Let the queued writes finish, but report the original error
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
@@ -0,0 +1,428 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Batched bisquare iteratively reweighted least squares (IRLS), written in numpy.
+
+This follows the same algorithm as gsl_multifit_robust() with the bisquare weighting
+function, but fits a whole chunk of pixels at once by solving the weighted normal
+equations for every pixel in a single batched call. The work is then spread over
+whatever threads the BLAS/LAPACK library numpy is linked against uses, and it does
+not need GSL to be installed.
+
+Compared with the GSL routine, coefficients and RMSE agree to a relative tolerance of
+GSL_AGREEMENT_RTOL for pixels where both converge. The differences come from solving
+the normal equations instead of using an SVD, so pixels with badly conditioned design
+matrices (e.g. very few valid dates) may differ by more, and numIter can differ by
+one for pixels which are right on the convergence threshold.
+
+"""
+
+import numpy
+
+# Constants used by GSL for the bisquare method
+BISQUARE_TUNE = 4.685
+MAX_ITER = 100
+TOLERANCE = numpy.sqrt(numpy.finfo(numpy.double).eps)
+MAD_SCALE = 0.6745
+MAX_LEVERAGE = 0.9999
+
+GSL_AGREEMENT_RTOL = 1e-6
+
+# Upper limit on the size of the working arrays for one chunk of pixels
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Number of (numImages, numPixels) double arrays alive at once while fitting a chunk
+NUM_WORK_ARRAYS = 8
+
+# Pixels sharing a validity pattern with fewer than this many others are fitted
+# individually, as the per-group overhead outweighs the saving
+MIN_GROUP_SIZE = 8
+
+
+def bisquare_weights(u):
+    """
+    Bisquare weighting function, w(u) = (1 - u^2)^2 for |u| < 1, otherwise 0
+    """
+    inside = numpy.abs(u) < 1.0
+    return numpy.where(inside, (1.0 - u * u) ** 2, 0.0)
+
+
+def bisquare_dpsi(u):
+    """
+    Derivative of the bisquare psi function, psi(u) = u * w(u)
+    """
+    inside = numpy.abs(u) < 1.0
+    return numpy.where(inside, (1.0 - u * u) * (1.0 - 5.0 * u * u), 0.0)
+
+
+def outer_products(x):
+    """
+    Products x[i, p] * x[i, q] for every observation, with shape (numImages, numParams**2).
+    Multiplying the transpose of this by a (numImages, numPixels) weights array gives
+    X^T W X for every pixel as a single matrix product.
+
+    """
+    numImages, numParams = x.shape
+    return (x[:, :, None] * x[:, None, :]).reshape((numImages, numParams * numParams))
+
+
+def solve_normal_equations(x, xx, weights, y):
+    """
+    Solve the weighted least squares problem for every pixel.
+
+    x has shape (numImages, numParams), and xx holds its outer_products(). weights and
+    y have shape (numImages, numPixels). Returns the coefficients with shape
+    (numParams, numPixels).
+
+    """
+    numParams = x.shape[1]
+    a = xx.T.dot(weights).T.reshape((-1, numParams, numParams))
+    b = x.T.dot(weights * y).T
+    try:
+        c = numpy.linalg.solve(a, b[..., None])[..., 0]
+    except numpy.linalg.LinAlgError:
+        # At least one pixel has too few non-zero weights. Use the pseudo-inverse,
+        # which gives the minimum norm solution as the GSL SVD solver does.
+        c = numpy.einsum('kpq,kq->kp', numpy.linalg.pinv(a), b)
+    return c.T
+
+
+def mad_sigma(r, valid, numValid, numParams):
+    """
+    Robust estimate of sigma from the median absolute residual. As in GSL, the
+    smallest (numParams - 1) absolute residuals are skipped, since they will be
+    close to zero.
+
+    """
+    absR = numpy.where(valid, numpy.abs(r), numpy.inf)
+    absR.sort(axis=0)
+    m = numValid - numParams + 1
+    lo = numParams - 1 + (m - 1) // 2
+    hi = numParams - 1 + m // 2
+    cols = numpy.arange(r.shape[1])
+    return 0.5 * (absR[lo, cols] + absR[hi, cols]) / MAD_SCALE
+
+
+def validity_groups(valid):
+    """
+    Group pixels by which observations are valid.
+
+    The valid mask of each pixel is bit-packed along the time axis, and the packed
+    bytes are used as the key, so pixels with identical patterns of null dates fall
+    in the same group. Returns (first, inverse), where first[g] is the index of one
+    pixel in group g, and inverse[k] is the group of pixel k.
+
+    """
+    packed = numpy.ascontiguousarray(numpy.packbits(valid, axis=0).T)
+    keys = packed.view(numpy.dtype((numpy.void, packed.shape[1]))).ravel()
+    _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    return first, inverse.ravel()
+
+
+def ols_fit(x, xx, y, valid):
+    """
+    Initial ordinary least squares fit, and the leverage adjustment factors
+    1 / sqrt(1 - h) of each observation.
+
+    The design matrix of a pixel only depends on which of its observations are valid,
+    so pixels are grouped by their validity pattern, and the factorization of X and
+    the leverages are calculated once for each group. The remaining pixels, whose
+    pattern is shared with fewer than MIN_GROUP_SIZE others, are solved as a batch.
+
+    y must be zero where valid is False. Returns (c, resfac), with shapes
+    (numParams, numPixels) and (numImages, numPixels).
+
+    """
+    numImages, numParams = x.shape
+    numPixels = y.shape[1]
+    c = numpy.zeros((numParams, numPixels), dtype=numpy.double)
+    resfac = numpy.zeros(y.shape, dtype=numpy.double)
+
+    first, inverse = validity_groups(valid)
+    groupSize = numpy.bincount(inverse, minlength=len(first))
+    for g in numpy.nonzero(groupSize >= MIN_GROUP_SIZE)[0]:
+        inGroup = inverse == g
+        m = valid[:, first[g]]
+        xg = x * m[:, None]
+        aInv = numpy.linalg.pinv(xg.T.dot(xg))
+        h = xx.dot(aInv.ravel())
+        c[:, inGroup] = aInv.dot(xg.T).dot(y.compress(inGroup, axis=1))
+        resfac[:, inGroup] = numpy.where(m, 1.0 / numpy.sqrt(1.0 - numpy.minimum(h, MAX_LEVERAGE)), 0.0)[:, None]
+
+    ungrouped = groupSize[inverse] < MIN_GROUP_SIZE
+    if ungrouped.any():
+        v = valid.compress(ungrouped, axis=1)
+        a = xx.T.dot(v.astype(numpy.double)).T.reshape((-1, numParams, numParams))
+        aInv = numpy.linalg.pinv(a)
+        c[:, ungrouped] = numpy.einsum('kpq,kq->kp', aInv, x.T.dot(y.compress(ungrouped, axis=1)).T).T
+        h = xx.dot(aInv.reshape((-1, numParams * numParams)).T)
+        resfac[:, ungrouped] = numpy.where(v, 1.0 / numpy.sqrt(1.0 - numpy.minimum(h, MAX_LEVERAGE)), 0.0)
+
+    return c, resfac
+
+
+def final_sigma(r, resfac, valid, numValid, numParams, sigmaOls):
+    """
+    Final estimate of sigma of a robust fit with residuals r, see DuMouchel and O'Brien,
+    and Street et al. As in GSL, the robust sigma is combined with the sigma sigmaOls of
+    the ordinary least squares fit, and the result is not allowed to fall below the
+    robust sigma.
+
+    r, resfac and valid have shape (numImages, numPixels), and numValid and sigmaOls
+    have shape (numPixels,).
+
+    """
+    dof = numValid - numParams
+    sigmaMad = mad_sigma(r, valid, numValid, numParams)
+    st = sigmaMad * BISQUARE_TUNE
+    u = r * resfac / st
+    psi = u * bisquare_weights(u)
+    dpsi = numpy.where(valid, bisquare_dpsi(u), 0.0)
+    meanDpsi = dpsi.sum(axis=0) / numValid
+    b = (numpy.where(valid, psi * psi / (resfac * resfac), 0.0)).sum(axis=0) / dof
+    lam = 1.0 + numParams / numValid * (1.0 - meanDpsi) / meanDpsi
+    sigmaRob = lam * numpy.sqrt(b) * st / meanDpsi
+
+    p2 = float(numParams * numParams)
+    return numpy.maximum(sigmaRob, numpy.sqrt((sigmaOls * sigmaOls * p2 + sigmaRob * sigmaRob * numValid) /
+                                              (p2 + numValid)))
+
+
+def model_rmse(x, y, valid, c):
+    """
+    Return the rmse which a robust fit of the pixels reports, if it ends at the
+    coefficients c, with shape (numParams, numPixels). This is the final sigma of
+    the fit (see final_sigma()), which depends on the ordinary least squares fit as
+    well as on the residuals about c. x, y and valid are as for fit_pixels(), and every
+    pixel must have more valid observations than parameters.
+
+    """
+    numParams = x.shape[1]
+    y = numpy.where(valid, y, 0.0)
+    numValid = valid.sum(axis=0).astype(numpy.int64)
+    dof = numValid - numParams
+
+    xx = outer_products(x)
+    cOls, resfac = ols_fit(x, xx, y, valid)
+    r = numpy.where(valid, y - x.dot(cOls), 0.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sigmaOls = numpy.sqrt((r * r).sum(axis=0) / dof)
+        r = numpy.where(valid, y - x.dot(c), 0.0)
+        return final_sigma(r, resfac, valid, numValid, numParams, sigmaOls)
+
+
+def fit_pixels(x, y, valid, maxIter=MAX_ITER, c0=None):
+    """
+    Fit bisquare robust regressions for a set of pixels.
+
+    x is the design matrix with shape (numImages, numParams). y and valid have shape
+    (numImages, numPixels), and valid is False for observations to be left out of the
+    fit. Every pixel must have at least numParams valid observations.
+
+    c0, if given, is an estimate of the coefficients with shape (numParams, numPixels),
+    e.g. from an earlier fit of the same pixels, which the iterations start from instead
+    of the ordinary least squares fit. This is a warm start, which converges in fewer
+    iterations when c0 is already close.
+
+    Returns a tuple (coeffs, adj_Rsqrd, numIter, rmse, converged), where coeffs has
+    shape (numParams, numPixels) and the others have shape (numPixels,).
+
+    """
+    numParams = x.shape[1]
+    numPixels = y.shape[1]
+    weights = valid.astype(numpy.double)
+    y = numpy.where(valid, y, 0.0)
+    numValid = weights.sum(axis=0).astype(numpy.int64)
+    dof = numValid - numParams
+
+    # Initial estimate using ordinary least squares, and the statistical leverage
+    # of each point in that fit
+    xx = outer_products(x)
+    c, resfac = ols_fit(x, xx, y, valid)
+
+    r = numpy.where(valid, y - x.dot(c), 0.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sigmaOls = numpy.sqrt((r * r).sum(axis=0) / dof)
+
+    if c0 is not None:
+        c = numpy.array(c0, dtype=numpy.double)
+        r = numpy.where(valid, y - x.dot(c), 0.0)
+
+    numIter = numpy.zeros(numPixels, dtype=numpy.int32)
+    converged = numpy.zeros(numPixels, dtype=bool)
+
+    # Working copies for the pixels which have not converged yet. These are compacted
+    # as pixels converge, and the results copied back into c and r.
+    active = numpy.arange(numPixels)
+    ya, va, resfacA, ra, ca, nA = y, valid, resfac, r, c.copy(), numValid
+    iteration = 0
+    while len(active) > 0 and iteration < maxIter:
+        iteration += 1
+
+        # Scale the leverage adjusted residuals by a robust estimate of sigma
+        rAdj = ra * resfacA
+        sig = mad_sigma(rAdj, va, nA, numParams)
+        u = rAdj / (numpy.maximum(sig, TOLERANCE) * BISQUARE_TUNE)
+        w = numpy.where(va, bisquare_weights(u), 0.0)
+
+        cPrev = ca
+        ca = solve_normal_equations(x, xx, w, ya)
+        ra = numpy.where(va, ya - x.dot(ca), 0.0)
+
+        done = numpy.all(numpy.abs(ca - cPrev) <=
+                         TOLERANCE * numpy.maximum(numpy.abs(ca), numpy.abs(cPrev)), axis=0)
+        if done.any() or iteration == maxIter:
+            c[:, active] = ca
+            r[:, active] = ra
+            numIter[active] = iteration
+            converged[active[done]] = True
+
+            keep = ~done
+            active = active[keep]
+            ya, va, resfacA, ra, ca = [a.compress(keep, axis=1) for a in (ya, va, resfacA, ra, ca)]
+            nA = nA[keep]
+
+    # GSL reports one more iteration than the maximum when it fails to converge
+    numIter[active] += 1
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sigma = final_sigma(r, resfac, valid, numValid, numParams, sigmaOls)
+
+        yMean = y.sum(axis=0) / numValid
+        ssTot = (numpy.where(valid, y - yMean, 0.0) ** 2).sum(axis=0)
+        ssErr = sigma * sigma * dof
+        rsq = 1.0 - ssErr / ssTot
+        adj_Rsqrd = 1.0 - (1.0 - rsq) * (numValid - 1.0) / dof
+        rmse = numpy.sqrt(ssErr / dof)
+
+    return c, adj_Rsqrd, numIter, rmse, converged
+
+
+def multifit_robust_bisquare(x, y, nullVal, chunkSize=None):
+    """
+    Fit a bisquare robust regression through an image stack, on a per-pixel basis.
+
+    x has shape (numParams, numImages), as for robustregression.gsl_multifit_robust()
+    with perPixelX False, and y has shape (numImages, numRows, numCols). Values of y
+    equal to nullVal are left out of the fit.
+
+    The pixels are fitted chunkSize at a time, so the working memory is bounded.
+    If chunkSize is None, it is chosen so that the working arrays of one chunk
+    use about DEFAULT_CHUNK_BYTES.
+
+    As with the GSL wrapper, pixels with fewer valid observations than parameters,
+    or which fail to converge, are left as zeros in the outputs.
+
+    Returns a tuple (coeffs, adj_Rsqrd, numIter, rmse) with the same shapes and
+    types as the GSL wrapper.
+
+    """
+    (coeffs, adj_Rsqrd, numIter, rmse) = multifit_robust_bisquare_multiband(x, y[:, None], nullVal, chunkSize)
+    return coeffs[0], adj_Rsqrd[0], numIter[0], rmse[0]
+
+
+def multifit_robust_bisquare_multiband(x, y, nullVal, chunkSize=None, out=None, excludeMask=None,
+                                       initCoeffs=None, maxIter=MAX_ITER):
+    """
+    Multiband version of multifit_robust_bisquare(). y has shape
+    (numImages, numBands, numRows, numCols), and an observation is left out of the
+    fit for all bands if it equals nullVal in any band. All bands of a pixel share
+    the same validity pattern, so they are fitted together in one batch.
+
+    chunkSize is the number of pixels in each chunk, including all their bands.
+
+    excludeMask, if given, is a bitmask of observations to leave out of the fit, of shape
+    (numImages, numRows, (numCols + 7) // 8), as made by numpy.packbits(mask, axis=-1).
+
+    If out is given, it is a tuple of C-contiguous arrays (coeffs, adj_Rsqrd,
+    numIter, rmse) which are zeroed and filled in place, instead of allocating new
+    ones. Any of the statistics arrays may be None, in which case that statistic is
+    not stored.
+
+    initCoeffs, if given, is a warm start for the fit (see fit_pixels()), with the same
+    shape as the coeffs. The fit is usually then stopped well before maxIter, so pixels
+    which reach maxIter keep their last estimate, instead of being left as zeros.
+
+    Returns a tuple (coeffs, adj_Rsqrd, numIter, rmse), where coeffs has shape
+    (numBands, numParams, numRows, numCols), and the others have shape
+    (numBands, numRows, numCols).
+
+    """
+    numParams, numImages = x.shape
+    numBands, numRows, numCols = y.shape[1:]
+    numPixels = numRows * numCols
+    if chunkSize is None:
+        chunkSize = max(1, DEFAULT_CHUNK_BYTES // (numImages * numBands * 8 * NUM_WORK_ARRAYS))
+
+    xT = numpy.ascontiguousarray(x.T, dtype=numpy.double)
+    yFlat = y.reshape((numImages, numBands, numPixels))
+    excluded = None
+    if excludeMask is not None:
+        excluded = numpy.unpackbits(excludeMask, axis=2)[:, :, :numCols].reshape((numImages, numPixels))
+
+    if out is None:
+        out = (numpy.zeros((numBands, numParams, numRows, numCols), dtype=numpy.double),
+               numpy.zeros((numBands, numRows, numCols), dtype=numpy.double),
+               numpy.zeros((numBands, numRows, numCols), dtype=numpy.int32),
+               numpy.zeros((numBands, numRows, numCols), dtype=numpy.double))
+    else:
+        for outArr in out:
+            if outArr is not None:
+                outArr.fill(0)
+
+    # Flat views of the outputs, one (pixel, band) per column
+    coeffs = out[0].reshape((numBands, numParams, numPixels))
+    initFlat = None if initCoeffs is None else initCoeffs.reshape((numBands, numParams, numPixels))
+    stats = [None if outArr is None else outArr.reshape((numBands, numPixels)) for outArr in out[1:]]
+
+    for start in range(0, numPixels, chunkSize):
+        stop = min(start + chunkSize, numPixels)
+        yChunk = yFlat[:, :, start:stop].astype(numpy.double)
+        valid = numpy.all(yChunk != nullVal, axis=1)
+        if excluded is not None:
+            valid &= (excluded[:, start:stop] == 0)
+
+        # Only fit the pixels with enough points
+        enough = valid.sum(axis=0) >= numParams
+        numFit = enough.sum()
+        if numFit == 0:
+            continue
+        outNdx = start + numpy.nonzero(enough)[0]
+
+        # Lay the bands side by side, so each (pixel, band) is one column
+        yFit = yChunk.compress(enough, axis=2).reshape((numImages, numBands * numFit))
+        validFit = numpy.tile(valid.compress(enough, axis=1), (1, numBands))
+        c0 = None
+        if initFlat is not None:
+            c0 = initFlat[:, :, outNdx].transpose((1, 0, 2)).reshape((numParams, numBands * numFit))
+        (c, adjR, nIter, rm, converged) = fit_pixels(xT, yFit, validFit, maxIter=maxIter, c0=c0)
+        if initFlat is not None:
+            converged[:] = True
+
+        # Non-converged pixels are an error in GSL, and are left as zeros
+        c = c.reshape((numParams, numBands, numFit))
+        converged = converged.reshape((numBands, numFit))
+        chunkStats = [adjR.reshape((numBands, numFit)), nIter.reshape((numBands, numFit)),
+                      rm.reshape((numBands, numFit))]
+        for band in range(numBands):
+            ok = converged[band]
+            coeffs[band][:, outNdx[ok]] = c[:, band, ok]
+            for (stat, chunkStat) in zip(stats, chunkStats):
+                if stat is not None:
+                    stat[band, outNdx[ok]] = chunkStat[band, ok]
+
+    return out
@@ -0,0 +1,79 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Clean up boolean cloud and shadow masks.
+
+The median of a square window of a boolean mask is the majority of its pixels, so
+instead of sorting each window, as scipy's median_filter does, the set pixels are
+counted with integer box sums. The edges are extended by reflection, as median_filter
+does by default, so for an odd size the result is the same, at least for images as
+large as the window.
+"""
+
+import numpy
+from scipy import ndimage
+
+
+def box_sum(masks, size):
+    """
+    Return the number of set pixels in the size x size window around each pixel of the
+    boolean masks, of shape (..., numRows, numCols). The window is reflected at the
+    edges. The sums are uint8 when they fit, so they take no more memory than the masks.
+    """
+    (numRows, numCols) = masks.shape[-2:]
+    radius = size // 2
+    padWidth = [(0, 0)] * (masks.ndim - 2) + [(radius, radius), (radius, radius)]
+    padded = numpy.pad(masks.view(numpy.uint8), padWidth, mode='symmetric')
+    dtype = numpy.uint8 if size * size < 256 else numpy.int32
+
+    # Sum along the rows, and then along the columns, adding shifted slices
+    rowSums = padded[..., 0:numCols].astype(dtype)
+    for offset in range(1, size):
+        rowSums += padded[..., offset:offset + numCols]
+    sums = rowSums[..., 0:numRows, :].copy()
+    for offset in range(1, size):
+        sums += rowSums[..., offset:offset + numRows, :]
+    return sums
+
+
+def remove_small_clumps(masks, minClump):
+    """
+    Clear the clumps of fewer than minClump 8-connected pixels in each of the boolean
+    masks, of shape (..., numRows, numCols)
+    """
+    structure = numpy.zeros((3,) * masks.ndim, dtype=bool)
+    structure[(1,) * (masks.ndim - 2)] = True
+    labels, numLabels = ndimage.label(masks, structure=structure)
+    keep = numpy.bincount(labels.ravel()) >= minClump
+    keep[0] = False
+    return keep[labels]
+
+
+def majority_filter(masks, size=3, minClump=0):
+    """
+    Set each pixel of the boolean masks, of shape (..., numRows, numCols), to the
+    majority of the size x size window around it, which is the same as
+    median_filter(mask, size=(size, size)) of each mask. All the masks are filtered in
+    one pass. If minClump is more than 1, the clumps of fewer pixels are then cleared.
+    """
+    if size < 1 or size % 2 == 0:
+        raise ValueError("The filter size must be odd, not %d" % size)
+
+    filtered = box_sum(masks, size) > (size * size) // 2
+    if minClump > 1:
+        filtered = remove_small_clumps(filtered, minClump)
+    return filtered
@@ -0,0 +1,109 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+A single GeoTIFF holding the cloud masks of every date.
+
+Each date is one band of the cube, in the order of the image list, with the same
+values as the _cloud images: 2 for clouds, 1 for cloud shadows and 0 otherwise. The
+bands are stored with 2 bits per pixel, band interleaved and tiled, so one date can
+be read as one band, and the history of a pixel or window with one windowed read of
+the dataset. The date index, a CSV file next to the cube, gives the julian date and
+image of each band, which are also set as the band descriptions and metadata.
+"""
+
+import os
+import csv
+
+from osgeo import gdal
+
+MASK_CUBE_FILE = 'mask_cube.tif'
+MASK_CUBE_OPTIONS = ['NBITS=2', 'INTERLEAVE=BAND', 'TILED=YES', 'COMPRESS=DEFLATE']
+
+
+def date_index_filename(fn):
+    """
+    Return the name of the date index of the mask cube fn
+    """
+    return os.path.splitext(fn)[0] + '_dates.csv'
+
+
+class MaskCube(object):
+    """
+    A mask cube being written to fn, for the images img_files taken on juldates.
+    img_info is the tuple used by image_writer.write_image(). write() must be called
+    for each date, and close() once they have all been written, or it can be used as
+    a context manager, which closes it on exit.
+    """
+    def __init__(self, fn, img_info, juldates, img_files, options=MASK_CUBE_OPTIONS):
+        drv, width, height, projection, geotransform = img_info
+        print('Writing mask cube "%s"' % fn)
+        self.ds = drv.Create(fn, width, height, len(img_files), gdal.GDT_Byte, options=options)
+        self.ds.SetProjection(projection)
+        self.ds.SetGeoTransform(geotransform)
+
+        with open(date_index_filename(fn), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['band', 'juldate', 'image'])
+            for i, (juldate, img_file) in enumerate(zip(juldates, img_files)):
+                band = self.ds.GetRasterBand(i + 1)
+                band.SetDescription(os.path.basename(img_file))
+                band.SetMetadataItem('JULDATE', '%.6f' % juldate)
+                writer.writerow([i + 1, '%.6f' % juldate, img_file])
+
+    def write(self, i, mask):
+        """
+        Write the mask of date i, counting from 0
+        """
+        self.ds.GetRasterBand(i + 1).WriteArray(mask)
+
+    def close(self):
+        if self.ds is not None:
+            self.ds.FlushCache()
+            self.ds = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def read_date_index(fn):
+    """
+    Read the date index of the mask cube fn
+
+    :param fn: filename of the mask cube
+    :return: list of (band, juldate, image) tuples
+
+    """
+    with open(date_index_filename(fn)) as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [(int(band), float(juldate), image) for band, juldate, image in reader]
+
+
+def read_mask_history(fn, xoff, yoff, xsize=1, ysize=1):
+    """
+    Read the masks of every date for a window of the mask cube fn
+
+    :return: array of shape (dates, ysize, xsize)
+
+    """
+    ds = gdal.Open(fn, gdal.GA_ReadOnly)
+    history = ds.ReadAsArray(xoff, yoff, xsize, ysize)
+    ds = None
+    return history.reshape((-1, ysize, xsize))
@@ -0,0 +1,145 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Incremental refresh of a fitted TMASK model when new acquisitions arrive.
+
+The stored model is matched to the image list by path, and the observations of each
+pixel in the images which are new, or have been rewritten since the model was fitted,
+are compared with the model. Only the pixels where one of them is further from the
+model than its stored RMSE are fitted again, over the whole time series. The refit
+starts from the stored coefficients, and its iterations are capped, so it costs a
+fraction of a full fit. The basis keeps the num_days of the original fit, so the
+refitted and the untouched pixels share one model.
+
+GSL's robust fit always starts from ordinary least squares, so the refits use the
+batched numpy IRLS (see irls.multifit_robust_bisquare_multiband()).
+"""
+
+import numpy
+
+from tmask import irls
+
+# Maximum number of IRLS iterations of a warm started refit
+REFRESH_MAX_ITER = 10
+
+# A pixel is refitted if a new observation is further from the model than this many RMSEs
+REFRESH_RMSE_FACTOR = 1.0
+
+
+class RefreshError(Exception):
+    """
+    Raised when the stored model can't be refreshed for the given dates, and has to be
+    fitted again from scratch.
+    """
+    pass
+
+
+def new_images(prevImages, images):
+    """
+    Match the images of the stored model to the images it is refreshed with, by path.
+    prevImages and images are lists of (path, state), where state is the
+    datacube.file_state() of the file, which changes whenever it is rewritten. Images
+    may share a date, e.g. two scenes of one day.
+
+    Returns the indices in images of the images which are new, or have changed since
+    the model was fitted, and the arrays (prevKept, kept) of the indices in prevImages
+    and in images of the others.
+    """
+    paths = [path for (path, state) in images]
+    if len(set(paths)) != len(paths):
+        raise RefreshError("The image list has repeated images")
+    index = dict((path, i) for (i, path) in enumerate(paths))
+    missing = [path for (path, state) in prevImages if path not in index]
+    if missing:
+        raise RefreshError("%d images of the stored model are not in the image list, e.g. %s" %
+                           (len(missing), missing[0]))
+
+    prevKept = [j for (j, (path, state)) in enumerate(prevImages) if list(images[index[path]][1]) == list(state)]
+    kept = [index[prevImages[j][0]] for j in prevKept]
+    isNew = numpy.ones(len(images), dtype=bool)
+    isNew[kept] = False
+    return numpy.nonzero(isNew)[0], numpy.array(prevKept, dtype=int), numpy.array(kept, dtype=int)
+
+
+def exceeds_rmse(x, newStack, c, rmse, excluded=None, factor=REFRESH_RMSE_FACTOR):
+    """
+    Return a boolean array of shape (numRows, numCols) which is True for the pixels
+    where a new observation is further from the model than factor times its RMSE, in
+    any band.
+
+    x is the design matrix of the new dates, with shape (numParams, numNew), and
+    newStack holds their images, with shape (numNew, numBands, numRows, numCols). c and
+    rmse are the stored coefficients and RMSE of the same pixels. excluded, if given, is
+    a boolean array of shape (numNew, numRows, numCols) of observations to ignore, e.g.
+    the clouds in the UDMs. Observations which are 0 in any band are ignored, as they
+    are in the fit.
+    """
+    predicted = numpy.einsum('pd,bprc->dbrc', x, c)
+    valid = numpy.all(newStack != 0, axis=1)
+    if excluded is not None:
+        valid &= ~excluded
+
+    outside = numpy.any(numpy.abs(newStack - predicted) > factor * rmse, axis=1)
+    return numpy.any(outside & valid, axis=0)
+
+
+def refit_pixels(x, stack, c, rmse, selected, excludeMask=None, maxIter=REFRESH_MAX_ITER):
+    """
+    Fit the selected pixels of the uint16 stack, of shape
+    (numImages, numBands, numRows, numCols), again, updating their coefficients and
+    RMSE in the float32 arrays c and rmse, of shape (numBands, numParams, numRows, numCols)
+    and (numBands, numRows, numCols). selected is a boolean array of shape
+    (numRows, numCols), and excludeMask is as for robustregression.gsl_multifit_robust().
+
+    Pixels with a stored fit start from it, and are fitted for at most maxIter
+    iterations. Pixels which were not fitted before, e.g. because they had too few
+    valid observations, are fitted from scratch.
+
+    Returns a tuple (numWarm, meanIter) of the number of warm started pixels, and their
+    mean number of iterations over the bands.
+    """
+    (rows, cols) = numpy.nonzero(selected)
+    numCols = stack.shape[3]
+
+    # Gather the pixels into a stack of one row, which is what the fit expects
+    y = stack[:, :, rows, cols][:, :, None, :]
+    mask = None
+    if excludeMask is not None:
+        excluded = numpy.unpackbits(excludeMask, axis=2)[:, :, :numCols][:, rows, cols]
+
+    warm = numpy.all(rmse[:, rows, cols] > 0, axis=0)
+    numWarm = int(warm.sum())
+    meanIter = 0.0
+    for group in (warm, ~warm):
+        if not group.any():
+            continue
+        if excludeMask is not None:
+            mask = numpy.packbits(excluded[:, None, group], axis=-1)
+        initCoeffs = None
+        groupIter = irls.MAX_ITER
+        if group is warm:
+            initCoeffs = c[:, :, rows[group], cols[group]][:, :, None, :].astype(numpy.double)
+            groupIter = maxIter
+
+        (coeffs, adj_Rsqrd, numIter, groupRmse) = irls.multifit_robust_bisquare_multiband(
+            x, y[..., group], 0, excludeMask=mask, initCoeffs=initCoeffs, maxIter=groupIter)
+        c[:, :, rows[group], cols[group]] = coeffs[:, :, 0]
+        rmse[:, rows[group], cols[group]] = groupRmse[:, 0]
+        if group is warm:
+            meanIter = float(numpy.mean(numIter))
+
+    return numWarm, meanIter
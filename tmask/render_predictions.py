@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Script to render the prediction images of the TMASK model from the stored coefficients,
+for some of the images or a window of the AOI
+
+"""
+
+import os
+import time
+import argparse
+
+from osgeo import gdal
+
+from tmask.create_cloud_masks import (calculate_tmask_model, get_analytic_img_filelist, get_filename,
+                                      get_model_projection_data, load_num_days, load_tmask_model,
+                                      PREDICTION_CHUNK_DATES)
+from tmask.image_writer import ImageWriter
+from tmask.roi import window_geotransform
+from tools.folders_handle import (ANALYTIC_LIST_FILE,
+                                  COEFFICIENTS_FOLDER,
+                                  PREDICTIONS_FOLDER)
+
+
+def select_dates(img_files, images):
+    """
+    Return the indices of the images with the given file names, or base names
+
+    :param img_files: list of input TOAR images
+    :param images: file names of the images to select
+    :return: list of indices into img_files
+
+    """
+    dates = []
+    for image in images:
+        matches = [i for i, fn in enumerate(img_files) if image in (fn, os.path.basename(fn))]
+        if not matches:
+            raise ValueError("Image %s is not in the image list" % image)
+        dates += matches
+    return dates
+
+
+def render_predictions(img_files, coefficients_folder, predictions_folder, dates=None, window=None,
+                       write_threads=2, creation_options=None):
+    """
+    Write the prediction images of the TMASK model
+
+    :param img_files: list of input TOAR images
+    :param coefficients_folder: Folder where coefficients were stored by the TMASK model
+    :param predictions_folder: Folder where the prediction images are stored
+    :param dates: indices of the images to predict, or None for all of them
+    :param window: (xoff, yoff, xsize, ysize) of the part of the AOI to predict, or None for all of it
+    :param write_threads: number of threads writing the images
+    :param creation_options: list of GDAL creation options of the images
+    :return: no return value
+
+    """
+    juldates, coeffs = load_tmask_model(coefficients_folder)
+    num_days = load_num_days(coefficients_folder)
+    bands, params, rows, cols = coeffs.shape
+    if dates is None:
+        dates = list(range(len(juldates)))
+    if window is None:
+        window = (0, 0, cols, rows)
+    xoff, yoff, xsize, ysize = window
+
+    projection, geotransform = get_model_projection_data(coefficients_folder, img_files[0])
+    image_info = (gdal.GetDriverByName('GTiff'), xsize, ysize, projection,
+                  window_geotransform(geotransform, xoff, yoff))
+
+    with ImageWriter(numThreads=write_threads, options=creation_options) as writer:
+        for start in range(0, len(dates), PREDICTION_CHUNK_DATES):
+            batch = dates[start:start + PREDICTION_CHUNK_DATES]
+            predicted_stack = calculate_tmask_model(juldates, coeffs, dates=batch, window=window,
+                                                    num_days=num_days)
+            for i, predicted in zip(batch, predicted_stack):
+                fn = get_filename(predictions_folder, '_pred', img_files[i])
+                writer.write(fn, image_info, gdal.GDT_Float32, predicted, bands)
+
+
+def parse_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images',
+                        nargs='+',
+                        help='file names of the images to predict (default: all of them)',
+                        default=None)
+    parser.add_argument('--window',
+                        type=int,
+                        nargs=4,
+                        metavar=('XOFF', 'YOFF', 'XSIZE', 'YSIZE'),
+                        help='part of the AOI to predict, in pixels (default: all of it)',
+                        default=None)
+    parser.add_argument('--write-threads',
+                        type=int,
+                        help='number of threads writing the prediction images',
+                        default=2)
+    parser.add_argument('--co',
+                        action='append',
+                        metavar='NAME=VALUE',
+                        help='GDAL creation option of the prediction images; can be given more than once',
+                        default=[])
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    start = time.time()
+    args = parse_params()
+    if not os.path.exists(PREDICTIONS_FOLDER):
+        os.makedirs(PREDICTIONS_FOLDER)
+    analytic_img_filelist = get_analytic_img_filelist(ANALYTIC_LIST_FILE)
+    dates = None
+    if args.images is not None:
+        dates = select_dates(analytic_img_filelist, args.images)
+    render_predictions(analytic_img_filelist, COEFFICIENTS_FOLDER, PREDICTIONS_FOLDER, dates=dates,
+                       window=args.window, write_threads=args.write_threads, creation_options=args.co)
+
+    elapsed = time.time() - start
+    print('Elapsed time (prediction rendering): %g seconds' % (elapsed))
@@ -16,13 +16,202 @@
  */
 
 #include <stdio.h>
+#include <stdlib.h>
 
 #include <gsl/gsl_matrix.h>
 #include <gsl/gsl_multifit.h>
 #include <math.h>
 
+#include "robreg.h"
 
-/*  A wrapper around the GSL multi-variate robust regression routine.
+
+/*  Fetch element ndx of the y array, whose element type is given by yType, as a double */
+static inline double get_y(const void *y, int yType, long ndx) {
+    switch (yType) {
+        case ROBREG_FLOAT32: return ((const float *) y)[ndx];
+        case ROBREG_UINT16: return ((const unsigned short *) y)[ndx];
+        default: return ((const double *) y)[ndx];
+    }
+}
+
+
+/*  Store a value into element ndx of an output array, whose element type is given by
+    outType. Outputs which were not requested are passed as NULL, and are skipped.
+*/
+static inline void set_out(void *out, int outType, long ndx, double value) {
+    if (out == NULL) return;
+    if (outType == ROBREG_FLOAT32) {
+        ((float *) out)[ndx] = (float) value;
+    } else {
+        ((double *) out)[ndx] = value;
+    }
+}
+
+
+/*  A cache of the GSL structures needed to fit one pixel, keyed by the number of
+    non-null values n. Allocating a workspace, X matrix and Y vector for every pixel
+    is expensive, and there are only ever numImages+1 possible sizes, so each size is
+    allocated the first time it is needed and then reused for all following pixels.
+    Each thread owns its own pool. The pool also holds a buffer for the indexes of the
+    valid images of the current pixel.
+*/
+typedef struct {
+    int numImages;
+    gsl_multifit_robust_workspace **workspace;
+    gsl_matrix **gslX;
+    gsl_vector **gslY;
+    int *validNdx;
+    long numAllocsAvoided;
+} workspace_pool;
+
+
+static void pool_init(workspace_pool *pool, int numImages) {
+    pool->numImages = numImages;
+    pool->workspace = calloc(numImages + 1, sizeof(gsl_multifit_robust_workspace *));
+    pool->gslX = calloc(numImages + 1, sizeof(gsl_matrix *));
+    pool->gslY = calloc(numImages + 1, sizeof(gsl_vector *));
+    pool->validNdx = calloc(numImages, sizeof(int));
+    pool->numAllocsAvoided = 0;
+}
+
+
+/*  Make sure the structures for n non-null values exist, allocating them if this is
+    the first pixel with that many values.
+*/
+static void pool_get(workspace_pool *pool, const gsl_multifit_robust_type *regressionType,
+        int n, int numParams) {
+    if (pool->workspace[n] == NULL) {
+        pool->workspace[n] = gsl_multifit_robust_alloc(regressionType, n, numParams);
+        pool->gslX[n] = gsl_matrix_calloc(n, numParams);
+        pool->gslY[n] = gsl_vector_calloc(n);
+    } else {
+        /* One workspace, one matrix and one vector */
+        pool->numAllocsAvoided += 3;
+    }
+}
+
+
+static void pool_free(workspace_pool *pool) {
+    int n;
+
+    for (n=0; n<=pool->numImages; n++) {
+        if (pool->workspace[n] != NULL) {
+            gsl_multifit_robust_free(pool->workspace[n]);
+            gsl_matrix_free(pool->gslX[n]);
+            gsl_vector_free(pool->gslY[n]);
+        }
+    }
+    free(pool->workspace);
+    free(pool->gslX);
+    free(pool->gslY);
+    free(pool->validNdx);
+}
+
+
+/*  Fit a single pixel, for every band. The gslC and gslCov structures and the pool of
+    per-size structures are supplied by the caller, so that each thread can hold its own
+    copies.
+
+    An observation is left out of the fit if it is null in any band, so the set of valid
+    dates, and hence the X matrix, is the same for all bands of the pixel. It is built
+    once and only the Y vector is refilled for each band.
+*/
+static void fit_pixel(double *x, const void *y, int yType, int layout, const unsigned char *excludeMask,
+        void *c, void *adj_Rsqrd, int *numIter, void *rmse, int outType,
+        const gsl_multifit_robust_type *regressionType, int perPixelX, int row, int col,
+        int numRows, int numCols, int numImages, int numBands, int numParams, int numRowsX,
+        int numColsX, double nullVal, gsl_vector *gslC, gsl_matrix *gslCov, workspace_pool *pool) {
+    int img, band, param, n, i, valid;
+    long xNdx, pixNdx, numPixels = (long) numRows * numCols;
+    long yStart, imgStride, bandStride;
+    long maskRowBytes = (numCols + 7) / 8;
+    unsigned char maskBit = 0x80 >> (col % 8);
+    int *validNdx = pool->validNdx;
+    gsl_matrix *gslX;
+    gsl_vector *gslY;
+    gsl_multifit_robust_workspace *workspace;
+    gsl_multifit_robust_stats stats;
+    int gslErrorCode;
+
+    pixNdx = row*numCols + col;
+
+    /* Work out where this pixel's time series is in the y array. In the pixel-major
+       layout, it is one contiguous block */
+    if (layout == ROBREG_PIXEL_MAJOR) {
+        yStart = pixNdx * numImages * numBands;
+        imgStride = numBands;
+        bandStride = 1;
+    } else {
+        yStart = pixNdx;
+        imgStride = (long) numBands * numPixels;
+        bandStride = numPixels;
+    }
+
+    /* Find the images where none of the bands is null, and which are not excluded */
+    n = 0;
+    for (img=0; img<numImages; img++) {
+        valid = 1;
+        if (excludeMask != NULL &&
+                (excludeMask[((long) img*numRows + row)*maskRowBytes + col/8] & maskBit)) {
+            continue;
+        }
+        for (band=0; band<numBands; band++) {
+            if (get_y(y, yType, yStart + img*imgStride + band*bandStride) == nullVal) valid = 0;
+        }
+        if (valid) validNdx[n++] = img;
+    }
+
+    /* Not enough points to fit this pixel */
+    if (n < numParams) return;
+
+    /* Fetch the structures for this many non-nulls */
+    pool_get(pool, regressionType, n, numParams);
+    workspace = pool->workspace[n];
+    gslX = pool->gslX[n];
+    gslY = pool->gslY[n];
+
+    /* Copy the independent variables for the valid images into the X matrix */
+    for (i=0; i<n; i++) {
+        img = validNdx[i];
+        for (param=0; param<numParams; param++) {
+            if (perPixelX == 0) {
+                xNdx = param * numImages + img;
+            } else {
+                xNdx = (long) param * numRowsX * numColsX * numImages +
+                    (long) img * numRowsX * numColsX + (long) row * numColsX + col;
+            }
+            gslX->data[i*gslX->tda + param] = x[xNdx];
+        }
+    }
+
+    for (band=0; band<numBands; band++) {
+        /* Copy the dependent variable for this band into the Y vector */
+        for (i=0; i<n; i++) {
+            gslY->data[i*gslY->stride] = get_y(y, yType, yStart + validNdx[i]*imgStride + band*bandStride);
+        }
+
+        /* Do the regression fit */
+        gslErrorCode = gsl_multifit_robust(gslX, gslY, gslC, gslCov, workspace);
+
+        if (gslErrorCode == 0) {
+            /* Copy the coefficients back into the image stack of coefficients */
+            for (param=0; param<numParams; param++) {
+                set_out(c, outType, ((long) band*numParams + param)*numPixels + pixNdx,
+                    gslC->data[param*gslC->stride]);
+            }
+
+            /* Copy the requested statistics into their arrays */
+            stats = gsl_multifit_robust_statistics(workspace);
+            set_out(adj_Rsqrd, outType, band*numPixels + pixNdx, stats.adj_Rsq);
+            set_out(rmse, outType, band*numPixels + pixNdx, stats.rmse);
+            if (numIter != NULL) numIter[band*numPixels + pixNdx] = stats.numit;
+        }
+    }
+}
+
+
+/*  A wrapper around the GSL multi-variate robust regression routine, fitting all the
+    bands of an image stack in one pass.
 
     This routine should only ever be called from the Python wrapper function, so if the
     parameters need to be changed, only these two files have to be changed.
@@ -38,6 +227,7 @@
         to the number of independent variables
     numImages is the number of images in the stack, and corresponds to the number
         of points in each fit (before removing nulls)
+    numBands is the number of bands in each image
     numRows is the number of rows in the image
     numCols is the number of columns in the image
 
@@ -51,13 +241,35 @@
     and it is assumed that the independent variables are constant over all pixels.
     This latter is the most likely case.
 
-    The Y variable is notionally a 3-dimensional array of doubles.
-    The shape should be
-        (numImages, numRows, numCols)
-    It contains the values of the dependent variable.
+    The Y variable is notionally a 4-dimensional array. With a layout of
+    ROBREG_IMAGE_MAJOR, the shape should be
+        (numImages, numBands, numRows, numCols)
+    and with ROBREG_PIXEL_MAJOR it should be
+        (numRows, numCols, numImages, numBands)
+    The pixel-major layout keeps each pixel's time series contiguous, so the values for
+    one pixel are read from a few cache lines rather than one per image and band.
+    It contains the values of the dependent variable. Its element type is given by
+    yType, one of ROBREG_FLOAT64, ROBREG_FLOAT32 or ROBREG_UINT16, and values are
+    converted to double as each pixel is copied into the GSL structures, so the stack
+    can be passed in its native type.
 
     The nullVal parameter is a scalar double value. Any occurrence of this value in the
-    y array will exclude that point from the fit.
+    y array will exclude that point from the fit, for all bands of that pixel.
+
+    The excludeMask, if not NULL, excludes further points from the fit, for all bands,
+    without having to change the y array (e.g. the clouds flagged in the UDMs). It is a
+    bitmask of shape (numImages, numRows, (numCols + 7) / 8), packed along the columns
+    with the first column in the most significant bit, as numpy.packbits() does. Its
+    layout does not depend on the layout of y.
+
+    numThreads is the number of worker threads used for the pixel loop. Rows are
+    handed out to the threads dynamically, and each thread holds its own coefficient
+    and covariance buffers, so the results are identical to the serial case. If the
+    module was built without OpenMP, the loop always runs serially.
+
+    The GSL workspaces are pooled by the number of non-null values, and are reused
+    from one pixel to the next. numAllocsAvoided is set to the number of GSL
+    allocations which were saved by this, summed over all threads.
 
     Output Variables
     ****************
@@ -65,25 +277,31 @@
     The following variables are calculated within this routine, and passed back via the
     pointers in the parameter list.
 
-    The c array is a 3-dimensional array of doubles. It corresponds to an image
-    stack of the fitted coefficients, and its shape is
-        (numParams, numRows, numCols)
+    The c array is a 4-dimensional array. It corresponds to an image stack of the
+    fitted coefficients, and its shape is
+        (numBands, numParams, numRows, numCols)
 
     The adj_Rsqrd array stores the adjusted R^2 coefficient of determination
-        statistic.
+        statistic, with shape (numBands, numRows, numCols). The numIter and rmse
+        arrays have the same shape.
+
+    The c, adj_Rsqrd and rmse arrays are all of the type given by outType, either
+    ROBREG_FLOAT64 or ROBREG_FLOAT32, so that the caller can have the results written
+    straight into its own arrays. The adj_Rsqrd, numIter and rmse arrays may be NULL
+    if those statistics are not wanted. Pixels which are not fitted are left untouched.
 
 */
-void wrap_gsl_multifit_robust(double *x, double *y, double *c, double *adj_Rsqrd,
-        int *numIter, double *rmse, int method, int perPixelX,
-        int numRows, int numCols, int numImages, int numParams,
-        int numRowsX, int numColsX, double nullVal) {
-    int row, col, img, param, n, xNdx, yNdx, pixNdx;
-    gsl_matrix *gslX, *gslCov;
-    gsl_vector *gslY, *gslC;
-    gsl_multifit_robust_workspace *workspace;
-    gsl_multifit_robust_type *regressionType;
-    gsl_multifit_robust_stats stats;
-    int gslErrorCode;
+void wrap_gsl_multifit_robust_multiband(double *x, const void *y, int yType, int layout,
+        const unsigned char *excludeMask, void *c, void *adj_Rsqrd, int *numIter, void *rmse,
+        int outType, int method, int perPixelX,
+        int numRows, int numCols, int numImages, int numBands, int numParams,
+        int numRowsX, int numColsX, double nullVal, int numThreads,
+        long *numAllocsAvoided) {
+    int row, col;
+    gsl_matrix *gslCov;
+    gsl_vector *gslC;
+    workspace_pool pool;
+    const gsl_multifit_robust_type *regressionType;
 
     /* Turn off the default error handler, which aborts at the first error. */
     gsl_set_error_handler_off();
@@ -98,73 +316,32 @@ void wrap_gsl_multifit_robust(double *x, double *y, double *c, double *adj_Rsqrd
         case 6: regressionType = gsl_multifit_robust_welsch; break;
     }
 
-    /* These structures can be allocated outside the pixel loop */
-    gslCov = gsl_matrix_calloc(numParams, numParams);
-    gslC = gsl_vector_calloc(numParams);
-
-    /* Loop over all pixels */
-    for (row=0; row<numRows; row++) {
-        for (col=0; col<numCols; col++) {
-            /* Count how many non-null y values we have. */
-            n = 0;
-            for (img=0; img<numImages; img++) {
-                if (y[img*numRows*numCols+row*numCols+col] != nullVal) n++;
-            }
+    if (numThreads < 1) numThreads = 1;
+    *numAllocsAvoided = 0;
+
+    /* Loop over all pixels. Each thread takes whole rows at a time. */
+    #pragma omp parallel num_threads(numThreads) if (numThreads > 1) private(row, col, gslC, gslCov, pool)
+    {
+        /* These structures can be allocated outside the pixel loop, once per thread */
+        gslCov = gsl_matrix_calloc(numParams, numParams);
+        gslC = gsl_vector_calloc(numParams);
+        pool_init(&pool, numImages);
 
-            /* Allocate various structures, now we know how many non-nulls */
-            if (n >= numParams) {
-                workspace = gsl_multifit_robust_alloc(regressionType, n, numParams);
-                gslX = gsl_matrix_calloc(n, numParams);
-                gslY = gsl_vector_calloc(n);
-
-                /* Copy the data from this pixel into the relevant GSL structures. Note
-                   that we skip over null values, based on nulls in the y variable.
-                */
-                n = 0;
-                for (img=0; img<numImages; img++) {
-                    yNdx = img*numRows*numCols+row*numCols+col;
-                    if (y[yNdx] != nullVal) {
-                        gslY->data[n*gslY->stride] = y[yNdx];
-                        for (param=0; param<numParams; param++) {
-                            if (perPixelX == 0) {
-                                xNdx = param * numImages + img;
-                            } else {
-                                xNdx = param * numRowsX * numColsX * numImages +
-                                    img * numRowsX * numColsX + row * numColsX + col;
-                            }
-                            gslX->data[n*gslX->tda + param] = x[xNdx];
-                        }
-                        n++;
-                    }
-                }
-
-                /* Do the regression fit */
-                gslErrorCode = gsl_multifit_robust(gslX, gslY, gslC, gslCov, workspace);
-
-                if (gslErrorCode == 0) {
-                    /* Copy the coefficients back into the image stack of coefficients */
-                    for (param=0; param<numParams; param++) {
-                        c[param*numRows*numCols + row*numCols + col] = gslC->data[param*gslC->stride];
-                    }
-
-                    /* Copy some useful statistics into their arrays */
-                    stats = gsl_multifit_robust_statistics(workspace);
-                    pixNdx = row*numCols + col;
-                    adj_Rsqrd[pixNdx] = stats.adj_Rsq;
-                    numIter[pixNdx] = stats.numit;
-                    rmse[pixNdx] = stats.rmse;
-                }
-
-                /* Free per-pixel structures */
-                gsl_matrix_free(gslX);
-                gsl_vector_free(gslY);
-                gsl_multifit_robust_free(workspace);
+        #pragma omp for schedule(dynamic)
+        for (row=0; row<numRows; row++) {
+            for (col=0; col<numCols; col++) {
+                fit_pixel(x, y, yType, layout, excludeMask, c, adj_Rsqrd, numIter, rmse, outType,
+                    regressionType, perPixelX, row, col, numRows, numCols, numImages, numBands,
+                    numParams, numRowsX, numColsX, nullVal, gslC, gslCov, &pool);
             }
         }
-    }
 
+        #pragma omp atomic
+        *numAllocsAvoided += pool.numAllocsAvoided;
 
-    /* Free the other structures */
-    gsl_vector_free(gslC);
-    gsl_matrix_free(gslCov);
+        /* Free the other structures */
+        pool_free(&pool);
+        gsl_vector_free(gslC);
+        gsl_matrix_free(gslCov);
+    }
 }
@@ -21,7 +21,18 @@
 #include <gsl/gsl_multifit.h>
 #include <math.h>
 
-void wrap_gsl_multifit_robust(double *x, double *y, double *c, double *adj_Rsqrd,
-        int *numIter, double *rmse, int method, int perPixelX,
-        int numRows, int numCols, int numImages, int numParams,
-        int numRowsX, int numColsX, double nullVal);
\ No newline at end of file
+/* Element types of the y array, and of the floating point output arrays */
+#define ROBREG_FLOAT64 0
+#define ROBREG_FLOAT32 1
+#define ROBREG_UINT16 2
+
+/* Memory layouts of the y array */
+#define ROBREG_IMAGE_MAJOR 0
+#define ROBREG_PIXEL_MAJOR 1
+
+void wrap_gsl_multifit_robust_multiband(double *x, const void *y, int yType, int layout,
+        const unsigned char *excludeMask, void *c, void *adj_Rsqrd, int *numIter, void *rmse,
+        int outType, int method, int perPixelX,
+        int numRows, int numCols, int numImages, int numBands, int numParams,
+        int numRowsX, int numColsX, double nullVal, int numThreads,
+        long *numAllocsAvoided);
\ No newline at end of file
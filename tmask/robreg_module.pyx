@@ -8,60 +8,149 @@ np.import_array()
 
 # cdefine the signature of our c function
 cdef extern from "robreg.h":
-    void wrap_gsl_multifit_robust(
+    enum:
+        ROBREG_FLOAT64
+        ROBREG_FLOAT32
+        ROBREG_UINT16
+        ROBREG_IMAGE_MAJOR
+        ROBREG_PIXEL_MAJOR
+
+    void wrap_gsl_multifit_robust_multiband(
             double *x,
-            double *y,
-            double *c,
-            double *adj_Rsqrd,
+            const void *y,
+            int yType,
+            int layout,
+            const unsigned char *excludeMask,
+            void *c,
+            void *adj_Rsqrd,
             int *numIter,
-            double *rmse,
+            void *rmse,
+            int outType,
             int method,
             int perPixelX,
             int numRows,
             int numCols,
             int numImages,
+            int numBands,
             int numParams,
             int numRowsX,
             int numColsX,
-            double nullVal)
+            double nullVal,
+            int numThreads,
+            long *numAllocsAvoided) nogil
+
+# The image stack can be passed in any of these types. The C code converts each
+# value to double as it is copied into the GSL structures.
+ctypedef fused stack_t:
+    double
+    float
+    unsigned short
+
+
+# Return the data pointer of an optional output array, or NULL if it is not wanted
+cdef void *optional_data(np.ndarray out):
+    if out is None:
+        return NULL
+    return np.PyArray_DATA(out)
 
-# input: x, y, method, perPixelX_asInt, nullVal
-# output: (c, adj_Rsqrd, numIter, rmse)
 
-def wrap_gsl_multifit_robust_func(
+# input: x, y, method, perPixelX_asInt, nullVal, numThreads, c, adj_Rsqrd, numIter, rmse,
+#        pixelMajor, excludeMask
+# output: numAllocsAvoided
+#
+# y has shape (numImages, numBands, numRows, numCols), or (numRows, numCols, numImages,
+# numBands) if pixelMajor is true.
+#
+# excludeMask is None, or a C-contiguous uint8 array of shape
+# (numImages, numRows, (numCols + 7) // 8), as made by numpy.packbits(mask, axis=-1).
+# Observations whose bit is set are left out of the fit.
+#
+# The c array, and the adj_Rsqrd, numIter and rmse arrays if they are not None, are
+# filled in place. They must be C-contiguous with the right shapes. c, adj_Rsqrd and
+# rmse must all be either float64 or float32, and numIter must be int32.
+
+def wrap_gsl_multifit_robust_multiband_func(
         np.ndarray[double, ndim=4, mode="c"] x not None,
-        np.ndarray[double, ndim=3, mode="c"] y not None,
+        np.ndarray[stack_t, ndim=4, mode="c"] y not None,
         int method,
         int perPixelX,
-        double nullVal
+        double nullVal,
+        int numThreads,
+        np.ndarray c not None,
+        np.ndarray adj_Rsqrd,
+        np.ndarray numIter,
+        np.ndarray rmse,
+        bint pixelMajor=False,
+        np.ndarray excludeMask=None
 ):
-    cdef numParams = x.shape[0];
-    cdef numImages = x.shape[1];
-    cdef numRows = y.shape[1];
-    cdef numCols = y.shape[2];
-    cdef numRowsX = x.shape[2];
-    cdef numColsX = x.shape[3];
+    cdef int numParams = x.shape[0];
+    cdef int numImages = x.shape[1];
+    cdef int numBands
+    cdef int numRows
+    cdef int numCols
+    cdef int numRowsX = x.shape[2];
+    cdef int numColsX = x.shape[3];
+    cdef int yType
+    cdef int outType
+    cdef int layout
+
+    if pixelMajor:
+        layout = ROBREG_PIXEL_MAJOR
+        numRows = y.shape[0]
+        numCols = y.shape[1]
+        numBands = y.shape[3]
+    else:
+        layout = ROBREG_IMAGE_MAJOR
+        numBands = y.shape[1]
+        numRows = y.shape[2]
+        numCols = y.shape[3]
+
+    if stack_t is double:
+        yType = ROBREG_FLOAT64
+    elif stack_t is float:
+        yType = ROBREG_FLOAT32
+    else:
+        yType = ROBREG_UINT16
+
+    if c.dtype == np.float32:
+        outType = ROBREG_FLOAT32
+    else:
+        outType = ROBREG_FLOAT64
 
-    cdef np.ndarray[double, ndim=3, mode="c"] c = np.zeros([numParams, numRows, numCols], dtype=np.double);
-    cdef np.ndarray[int, ndim=2, mode="c"] numIter = np.zeros([numRows, numCols], dtype=np.int32);
-    cdef np.ndarray[double, ndim=2, mode="c"] rmse = np.zeros([numRows, numCols], dtype=np.double);
-    cdef np.ndarray[double, ndim=2, mode="c"] adj_Rsqrd = np.zeros([numRows, numCols], dtype=np.double);
+    cdef double *xData = <double*> np.PyArray_DATA(x);
+    cdef void *yData = np.PyArray_DATA(y);
+    cdef void *cData = np.PyArray_DATA(c);
+    cdef void *adj_RsqrdData = optional_data(adj_Rsqrd);
+    cdef int *numIterData = <int*> optional_data(numIter);
+    cdef void *rmseData = optional_data(rmse);
+    cdef const unsigned char *excludeMaskData = <const unsigned char*> optional_data(excludeMask);
+    cdef long numAllocsAvoided = 0;
 
-    wrap_gsl_multifit_robust(
-        <double*> np.PyArray_DATA(x),
-        <double*> np.PyArray_DATA(y),
-        <double*> np.PyArray_DATA(c),
-        <double*> np.PyArray_DATA(adj_Rsqrd),
-        <int*> np.PyArray_DATA(numIter),
-        <double*> np.PyArray_DATA(rmse),
-        method,
-        perPixelX,
-        numRows,
-        numCols,
-        numImages,
-        numParams,
-        numRowsX,
-        numColsX,
-        nullVal
-    )
-    return c, adj_Rsqrd, numIter, rmse
\ No newline at end of file
+    # The C routine does not touch any Python objects, so let other threads run
+    # while the pixels are being fitted
+    with nogil:
+        wrap_gsl_multifit_robust_multiband(
+            xData,
+            yData,
+            yType,
+            layout,
+            excludeMaskData,
+            cData,
+            adj_RsqrdData,
+            numIterData,
+            rmseData,
+            outType,
+            method,
+            perPixelX,
+            numRows,
+            numCols,
+            numImages,
+            numBands,
+            numParams,
+            numRowsX,
+            numColsX,
+            nullVal,
+            numThreads,
+            &numAllocsAvoided
+        )
+    return numAllocsAvoided
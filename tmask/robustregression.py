@@ -14,9 +14,16 @@
 # limitations under the License.
 #
 
-import robreg
 import numpy
 
+try:
+    import robreg
+except ImportError:
+    # The C extension has not been built, only the numpy backend is available
+    robreg = None
+
+from tmask import irls
+
 
 class RegressionError(Exception):
     """
@@ -36,6 +43,20 @@ GSL_METHOD_HUBER = 4
 GSL_METHOD_OLS = 5
 GSL_METHOD_WELSCH = 6
 
+BACKEND_GSL = 'gsl'
+BACKEND_NUMPY = 'numpy'
+BACKENDS = (BACKEND_GSL, BACKEND_NUMPY)
+
+# Memory layouts of the y array. Image-major is the natural stack of images, and
+# pixel-major keeps the time series of each pixel contiguous.
+LAYOUT_IMAGE_MAJOR = 'image'
+LAYOUT_PIXEL_MAJOR = 'pixel'
+LAYOUTS = (LAYOUT_IMAGE_MAJOR, LAYOUT_PIXEL_MAJOR)
+
+# Element types of the y array which the C extension reads directly. Anything else
+# is converted to double first.
+NATIVE_STACK_TYPES = (numpy.float64, numpy.float32, numpy.uint16)
+
 
 class GslRegressionResults(object):
     """
@@ -46,11 +67,18 @@ class GslRegressionResults(object):
         adj_Rsqrd       Adjusted R-squared of fit, shape (numRows, numCols)
         numIter         Number of iterations required, shape (numRows, numCols)
         rmse            Root mean square residual, shape (numRows, numCols)
+        numAllocsAvoided    Number of GSL allocations saved by reusing workspaces
+
+    For the multiband fits, all the arrays have an extra leading dimension of numBands.
+    Statistics which were not asked for (see the regStats parameter) are None.
 
     """
 
 
-def gsl_multifit_robust(x, y, method=GSL_METHOD_BISQUARE, nullVal=None, perPixelX=False):
+def gsl_multifit_robust(x, y, method=GSL_METHOD_BISQUARE, nullVal=None, perPixelX=False, numThreads=1,
+                        backend=BACKEND_GSL, chunkSize=None, regStats=REGSTATS_FULL, coeffsOut=None,
+                        adj_RsqrdOut=None, numIterOut=None, rmseOut=None, layout=LAYOUT_IMAGE_MAJOR,
+                        excludeMask=None):
     """
     This is a wrapper around the GSL routine for multivariate robust regression
         gsl_multifit_robust()
@@ -61,8 +89,14 @@ def gsl_multifit_robust(x, y, method=GSL_METHOD_BISQUARE, nullVal=None, perPixel
 
     The y variable is the dependant variable, and should be a 3-d numpy array of shape
         (numImages, numRows, numCols)
+    It can be of any of the NATIVE_STACK_TYPES (e.g. the uint16 TOAR values), in which
+    case it is passed to the C code without making a double precision copy.
     Conceptually, for each pixel (i, j), a separate regression is fitted to the y values
         y[:, i, j]
+    If layout is LAYOUT_PIXEL_MAJOR, y should instead have shape
+        (numRows, numCols, numImages)
+    so the values for each pixel are contiguous in memory, and are read with far
+    fewer cache misses. See pixel_major_stack().
 
     The x parameter is a numpy array holding all the values of all the independent
     variables. Its shape depends on the value of the perPixelX flag. If perPixelX is False,
@@ -84,16 +118,134 @@ def gsl_multifit_robust(x, y, method=GSL_METHOD_BISQUARE, nullVal=None, perPixel
 
     The nullVal, if given, will be removed from the data for that pixel before fitting.
 
+    The excludeMask, if given, marks further observations to be removed, without having
+    to change y (e.g. the clouds flagged in the UDMs). It is a bitmask packed along the
+    columns, as made by pack_mask(), of shape
+        (numImages, numRows, (numCols + 7) // 8)
+    whatever the layout of y.
+
+    The numThreads parameter sets how many threads share the pixel loop. Rows of the
+    image are handed out to the threads, each of which has its own GSL workspace, so
+    the results are identical to the single threaded case.
+
+    The backend parameter selects the implementation. BACKEND_GSL calls the GSL routine
+    through the robreg C extension. BACKEND_NUMPY uses the batched IRLS in the irls
+    module, which fits chunkSize pixels at a time with numpy and so does not need GSL.
+    It only supports GSL_METHOD_BISQUARE with perPixelX False, ignores numThreads (it
+    uses the BLAS threads instead), and matches the GSL results to within
+    irls.GSL_AGREEMENT_RTOL.
+
+    The regStats parameter selects which statistics are calculated and stored. With
+    REGSTATS_MINIMAL only the coeffs and rmse are returned, REGSTATS_PARTIAL adds the
+    numIter, and REGSTATS_FULL adds the adj_Rsqrd. Statistics which are not wanted are
+    None in the results, and no memory is allocated for them.
+
+    The coeffsOut, adj_RsqrdOut, numIterOut and rmseOut parameters are optional
+    C-contiguous arrays, of the same shapes as the corresponding results, into which
+    the results are written instead of allocating new arrays. This allows results to
+    go straight into preallocated arrays, or slices of them. The coeffs, adj_Rsqrd and
+    rmse arrays can be float64 or float32, but must all be the same type, and numIter
+    must be int32. Giving an array for a statistic also asks for that statistic,
+    whatever regStats is.
+
     The return value is an instance of the GslRegressionResults class.
 
     """
     # Some basic error checking on the shape of the arrays
     if len(y.shape) != 3:
         raise RegressionError("Y variable has shape %s. It should be 3-d" % str(y.shape))
-    if perPixelX and (len(x.shape) != 4):
-        raise RegressionError("X variable has shape %s, but perPixelX is True. It should be 4-d" % str(x.shape))
-    elif (not perPixelX) and (len(x.shape) != 2):
-        raise RegressionError("X variable has shape %s, but perPixelX is False. It should be 2-d" % str(y.shape))
+
+    # The single band fit is the multiband fit with one band, so add a band dimension
+    # to the inputs and to any output arrays
+    outArrays = (coeffsOut, adj_RsqrdOut, numIterOut, rmseOut)
+    bandOutArrays = [None if outArr is None else outArr[None] for outArr in outArrays]
+    yBands = y[..., None] if layout == LAYOUT_PIXEL_MAJOR else y[:, None]
+    regObj = gsl_multifit_robust_multiband(x, yBands, method=method, nullVal=nullVal,
+                                           perPixelX=perPixelX, numThreads=numThreads, backend=backend,
+                                           chunkSize=chunkSize, regStats=regStats, coeffsOut=bandOutArrays[0],
+                                           adj_RsqrdOut=bandOutArrays[1], numIterOut=bandOutArrays[2],
+                                           rmseOut=bandOutArrays[3], layout=layout, excludeMask=excludeMask)
+
+    # Hand back the caller's own arrays where they were given
+    results = []
+    for (outArr, result) in zip(outArrays, (regObj.coeffs, regObj.adj_Rsqrd, regObj.numIter, regObj.rmse)):
+        if outArr is not None:
+            results.append(outArr)
+        elif result is not None:
+            results.append(result[0])
+        else:
+            results.append(None)
+
+    return make_results(results[0], results[1], results[2], results[3], regObj.numAllocsAvoided)
+
+
+def gsl_multifit_robust_multiband(x, y, method=GSL_METHOD_BISQUARE, nullVal=None, perPixelX=False,
+                                  numThreads=1, backend=BACKEND_GSL, chunkSize=None, regStats=REGSTATS_FULL,
+                                  coeffsOut=None, adj_RsqrdOut=None, numIterOut=None, rmseOut=None,
+                                  layout=LAYOUT_IMAGE_MAJOR, excludeMask=None):
+    """
+    Multiband version of gsl_multifit_robust(), which fits every band of a stack in a
+    single pass over the data.
+
+    The y variable should be a 4-d numpy array of shape
+        (numImages, numBands, numRows, numCols)
+    or, if layout is LAYOUT_PIXEL_MAJOR,
+        (numRows, numCols, numImages, numBands)
+    An observation equal to nullVal in any band is left out of the fit for all bands of
+    that pixel, so the valid observations and the X matrix of each pixel are only
+    worked out once, and shared between its bands. When the nulls are the same in all
+    bands (e.g. nodata and masked clouds), this gives the same fits as calling
+    gsl_multifit_robust() separately for each band.
+
+    The other parameters are as for gsl_multifit_robust(). The return value is an
+    instance of the GslRegressionResults class, where the coeffs have shape
+        (numBands, numParams, numRows, numCols)
+    and the adj_Rsqrd, numIter and rmse have shape
+        (numBands, numRows, numCols)
+    The same shapes apply to the coeffsOut, adj_RsqrdOut, numIterOut and rmseOut arrays.
+
+    """
+    if len(y.shape) != 4:
+        raise RegressionError("Y variable has shape %s. It should be 4-d" % str(y.shape))
+    check_parameters(x, method, perPixelX, numThreads, backend)
+    if layout not in LAYOUTS:
+        raise RegressionError("Unknown layout '%s'. It should be one of %s" % (layout, str(LAYOUTS)))
+    if regStats not in (REGSTATS_MINIMAL, REGSTATS_PARTIAL, REGSTATS_FULL):
+        raise RegressionError("Unknown regStats %s" % str(regStats))
+
+    if nullVal is None:
+        nullVal = float(y.max()) + 1
+
+    numParams = x.shape[0]
+    if layout == LAYOUT_PIXEL_MAJOR:
+        (numRows, numCols, numImages, numBands) = y.shape
+    else:
+        (numImages, numBands, numRows, numCols) = y.shape
+    statShape = (numBands, numRows, numCols)
+    if excludeMask is not None:
+        maskShape = (numImages, numRows, (numCols + 7) // 8)
+        if excludeMask.shape != maskShape or excludeMask.dtype != numpy.uint8:
+            raise RegressionError("excludeMask has shape %s and type %s. It should be uint8 with shape %s" %
+                                  (str(excludeMask.shape), excludeMask.dtype, str(maskShape)))
+        excludeMask = numpy.ascontiguousarray(excludeMask)
+    coeffs = output_array('coeffs', coeffsOut, (numBands, numParams, numRows, numCols), None)
+    floatType = coeffs.dtype
+    rmse = output_array('rmse', rmseOut, statShape, floatType)
+    numIter = None
+    if regStats >= REGSTATS_PARTIAL or numIterOut is not None:
+        numIter = output_array('numIter', numIterOut, statShape, numpy.int32)
+    adj_Rsqrd = None
+    if regStats >= REGSTATS_FULL or adj_RsqrdOut is not None:
+        adj_Rsqrd = output_array('adj_Rsqrd', adj_RsqrdOut, statShape, floatType)
+
+    if backend == BACKEND_NUMPY:
+        # The irls module works through the stack in chunks of pixels, and the
+        # image-major view of a pixel-major stack can be used without copying it
+        if layout == LAYOUT_PIXEL_MAJOR:
+            y = y.transpose((2, 3, 0, 1))
+        irls.multifit_robust_bisquare_multiband(x, y, nullVal, chunkSize=chunkSize,
+                                                out=(coeffs, adj_Rsqrd, numIter, rmse), excludeMask=excludeMask)
+        return make_results(coeffs, adj_Rsqrd, numIter, rmse, 0)
 
     # Don't assume Python's boolean equates to C's int
     perPixelX_asInt = 1 if perPixelX else 0
@@ -105,18 +257,106 @@ def gsl_multifit_robust(x, y, method=GSL_METHOD_BISQUARE, nullVal=None, perPixel
             x[..., None, None],
             dtype=numpy.double)
 
-    # If no nullVal given, then make one which does not appear in the data. This is
-    # a bit inefficient, but mostly won't happen, as we ought to be giving a null val
-    if nullVal is None:
-        nullVal = y.max() + 1
+    numAllocsAvoided = robreg.wrap_gsl_multifit_robust_multiband_func(
+        x, native_stack(y), method, perPixelX_asInt, nullVal, numThreads, coeffs, adj_Rsqrd, numIter, rmse,
+        layout == LAYOUT_PIXEL_MAJOR, excludeMask)
 
-    (coeffs, adj_Rsqrd, numIter, rmse) = robreg.wrap_gsl_multifit_robust_func(x, y, method, perPixelX_asInt, nullVal)
+    return make_results(coeffs, adj_Rsqrd, numIter, rmse, numAllocsAvoided)
 
-    # Assemble an object of the various pieces of output
+
+def check_parameters(x, method, perPixelX, numThreads, backend):
+    """
+    Check the parameters shared by all the regression wrappers, and raise a
+    RegressionError if they can't be used.
+    """
+    if perPixelX and (len(x.shape) != 4):
+        raise RegressionError("X variable has shape %s, but perPixelX is True. It should be 4-d" % str(x.shape))
+    elif (not perPixelX) and (len(x.shape) != 2):
+        raise RegressionError("X variable has shape %s, but perPixelX is False. It should be 2-d" % str(x.shape))
+    if numThreads < 1:
+        raise RegressionError("numThreads is %d. It should be at least 1" % numThreads)
+    if backend not in BACKENDS:
+        raise RegressionError("Unknown backend '%s'. It should be one of %s" % (backend, str(BACKENDS)))
+    if backend == BACKEND_GSL and robreg is None:
+        raise RegressionError("The robreg extension is not built, so the GSL backend is not available")
+    if backend == BACKEND_NUMPY and (perPixelX or method != GSL_METHOD_BISQUARE):
+        raise RegressionError("The numpy backend only supports the bisquare method, with perPixelX False")
+
+
+def native_stack(y):
+    """
+    Return y as a C-contiguous array which the C extension can read, only making a copy
+    if it is not contiguous or not one of the NATIVE_STACK_TYPES.
+    """
+    if y.dtype.type in NATIVE_STACK_TYPES:
+        return numpy.ascontiguousarray(y)
+    return numpy.ascontiguousarray(y, dtype=numpy.double)
+
+
+def output_array(name, outArr, shape, dtype):
+    """
+    Return the array to write one of the results into. If outArr is None, this is a new
+    zeroed array of the given shape and dtype (float64 for coeffs, where dtype is None).
+    Otherwise outArr is checked, and zeroed, so pixels which are not fitted come out as
+    zero just as in a new array.
+    """
+    if outArr is None:
+        return numpy.zeros(shape, dtype=(numpy.double if dtype is None else dtype))
+
+    if outArr.shape != shape:
+        raise RegressionError("%sOut has shape %s. It should be %s" % (name, str(outArr.shape), str(shape)))
+    if not outArr.flags.c_contiguous:
+        raise RegressionError("%sOut is not C-contiguous" % name)
+    if dtype is None:
+        if outArr.dtype not in (numpy.float64, numpy.float32):
+            raise RegressionError("%sOut has type %s. It should be float64 or float32" % (name, outArr.dtype))
+    elif outArr.dtype != dtype:
+        raise RegressionError("%sOut has type %s. It should be %s" % (name, outArr.dtype, numpy.dtype(dtype)))
+    outArr.fill(0)
+    return outArr
+
+
+def pixel_major_stack(y, rowStart=0, rowEnd=None, out=None):
+    """
+    Return a C-contiguous pixel-major copy of rows rowStart to rowEnd of the image-major
+    stack y, of shape (numImages, numBands, numRows, numCols). The result has shape
+        (rowEnd - rowStart, numCols, numImages, numBands)
+    and keeps the type of y. Transposing a block of rows at a time keeps the copy small,
+    for fitting a large stack block by block with LAYOUT_PIXEL_MAJOR.
+
+    If out is given, the copy is written into it and it is returned. Reusing the same
+    array for each block saves allocating (and page faulting) a new one each time.
+    """
+    if rowEnd is None:
+        rowEnd = y.shape[2]
+    block = y[:, :, rowStart:rowEnd].transpose((2, 3, 0, 1))
+    if out is None:
+        return numpy.ascontiguousarray(block)
+    if out.shape != block.shape or not out.flags.c_contiguous:
+        raise RegressionError("out has shape %s. It should be C-contiguous with shape %s" %
+                              (str(out.shape), str(block.shape)))
+    out[...] = block
+    return out
+
+
+def pack_mask(mask):
+    """
+    Pack a boolean mask of shape (numImages, numRows, numCols) into the bitmask used for
+    the excludeMask, with 8 columns to a byte. This takes 1/16 of the memory of a single
+    band of a uint16 stack.
+    """
+    return numpy.packbits(mask, axis=-1)
+
+
+def make_results(coeffs, adj_Rsqrd, numIter, rmse, numAllocsAvoided):
+    """
+    Assemble an object of the various pieces of output
+    """
     regObj = GslRegressionResults()
     regObj.coeffs = coeffs
     regObj.adj_Rsqrd = adj_Rsqrd
     regObj.numIter = numIter
     regObj.rmse = rmse
+    regObj.numAllocsAvoided = numAllocsAvoided
 
     return regObj
@@ -0,0 +1,144 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Regions of interest within the AOI.
+
+A region of interest is given as a bounding box in the coordinates of the images, or
+as a GeoJSON geometry, whose points are transformed into the coordinates of the images
+before their bounding box is taken. It is turned into the pixel window
+(xoff, yoff, xsize, ysize) which covers it, and which the other modules use to read
+only the part of the arrays they need.
+"""
+
+import json
+import math
+
+from osgeo import osr
+
+# RFC 7946 GeoJSON is in WGS84 longitude and latitude, unless it has the crs member of
+# the older GeoJSON specification
+GEOJSON_CRS = 'EPSG:4326'
+
+
+def window_geotransform(geotransform, xoff, yoff):
+    """
+    Return the geotransform of a window of an image, whose top left pixel is (xoff, yoff)
+    """
+    return (geotransform[0] + xoff * geotransform[1] + yoff * geotransform[2], geotransform[1], geotransform[2],
+            geotransform[3] + xoff * geotransform[4] + yoff * geotransform[5], geotransform[4], geotransform[5])
+
+
+def bbox_window(geotransform, bbox, width, height):
+    """
+    Return the pixel window covering a bounding box
+
+    :param geotransform: geotransform of the images, which must be north up
+    :param bbox: (minx, miny, maxx, maxy) in the coordinates of the images
+    :param width: width of the images in pixels
+    :param height: height of the images in pixels
+    :return: tuple (xoff, yoff, xsize, ysize), clipped to the images
+
+    """
+    if geotransform[2] != 0 or geotransform[4] != 0:
+        raise ValueError("Rotated images are not supported")
+    minx, miny, maxx, maxy = bbox
+
+    # Pixel coordinates of the corners, for either sign of the pixel sizes
+    cols = sorted([(minx - geotransform[0]) / geotransform[1], (maxx - geotransform[0]) / geotransform[1]])
+    rows = sorted([(miny - geotransform[3]) / geotransform[5], (maxy - geotransform[3]) / geotransform[5]])
+    xoff = max(0, int(math.floor(cols[0])))
+    yoff = max(0, int(math.floor(rows[0])))
+    xend = min(width, int(math.ceil(cols[1])))
+    yend = min(height, int(math.ceil(rows[1])))
+    if xend <= xoff or yend <= yoff:
+        raise ValueError("The region of interest %s does not overlap the AOI" % (bbox,))
+
+    return (xoff, yoff, xend - xoff, yend - yoff)
+
+
+def geojson_points(geojson):
+    """
+    Return the list of the points of a GeoJSON geometry, feature or feature collection
+    """
+    if geojson['type'] == 'FeatureCollection':
+        return [p for feature in geojson['features'] for p in geojson_points(feature)]
+    elif geojson['type'] == 'Feature':
+        return geojson_points(geojson['geometry'])
+    elif geojson['type'] == 'GeometryCollection':
+        return [p for geometry in geojson['geometries'] for p in geojson_points(geometry)]
+
+    points = []
+    coords = [geojson['coordinates']]
+    while coords:
+        item = coords.pop()
+        if isinstance(item[0], (int, float)):
+            points.append(item)
+        else:
+            coords.extend(item)
+    return points
+
+
+def geojson_crs(geojson):
+    """
+    Return the definition of the coordinate reference system of a GeoJSON object, from
+    its crs member if it has one, and otherwise the WGS84 of RFC 7946
+    """
+    crs = geojson.get('crs')
+    if crs is not None and crs.get('type') == 'name':
+        return crs['properties']['name']
+    return GEOJSON_CRS
+
+
+def spatial_reference(definition):
+    """
+    Return the osr.SpatialReference of a definition such as "EPSG:4326" or WKT, with
+    the axes in longitude, latitude (or easting, northing) order
+    """
+    srs = osr.SpatialReference()
+    if srs.SetFromUserInput(definition) != 0:
+        raise ValueError("Unknown coordinate reference system %s" % definition)
+
+    # GDAL 3 otherwise follows the axis order of the authority, which is latitude first for EPSG:4326
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def geojson_bbox(geojson, projection=None):
+    """
+    Return the (minx, miny, maxx, maxy) bounding box of a GeoJSON geometry, feature or
+    feature collection. If projection, the WKT of the images, is given, the points are
+    transformed from the GeoJSON's coordinate reference system into it first, and
+    otherwise they are used as they are.
+    """
+    points = geojson_points(geojson)
+    if projection:
+        transform = osr.CoordinateTransformation(spatial_reference(geojson_crs(geojson)),
+                                                 spatial_reference(projection))
+        points = [transform.TransformPoint(float(p[0]), float(p[1]))[:2] for p in points]
+
+    return (min(p[0] for p in points), min(p[1] for p in points),
+            max(p[0] for p in points), max(p[1] for p in points))
+
+
+def read_geojson_bbox(fn, projection=None):
+    """
+    Return the bounding box of the geometry in the GeoJSON file fn, in the coordinates
+    of projection if it is given (see geojson_bbox())
+    """
+    with open(fn) as f:
+        return geojson_bbox(json.load(f), projection)
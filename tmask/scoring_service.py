@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Local HTTP service which masks new images with the stored TMASK model
+
+The coefficients and RMSE are memory mapped, or read from the coefficient store, once when
+the service starts, and each image is masked as by apply_tmask.py, by a pool of worker
+threads. A request can carry a batch of images, which are read and masked concurrently,
+and predicted together by one evaluation of the model at all their dates. Images of
+separate requests are predicted separately. The API is JSON:
+
+    POST /score    {"images": [{"image": <TOAR image>, "juldate": <optional julian date>}, ...]}
+                   or {"images": [<TOAR image>, ...]}
+                   Masks a batch of images, and returns
+                   {"results": [{"image", "mask", "clouds", "shadows", "seconds"} or {"image", "error"}, ...]}
+    GET /metrics   Returns the number of images masked and failed, and the latencies
+    GET /health    Returns {"status": "ok"}
+
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import numpy as np
+
+from tmask.apply_tmask import mask_image, read_new_image
+from tmask.coeff_store import RasterArray
+from tmask.create_cloud_masks import calculate_tmask_model, get_threshold_info, load_num_days, load_tmask_model
+from tools.folders_handle import (COEFFICIENTS_FOLDER,
+                                  RESULTS_FOLDER)
+
+# Number of recent latencies the metrics are computed from
+LATENCY_WINDOW = 1000
+
+
+class Metrics(object):
+    """
+    Counts of the images masked, and their recent latencies, shared by the request threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scored = 0
+        self.failed = 0
+        self.requests = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, seconds, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.scored += 1
+                self.latencies.append(seconds)
+
+    def add_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def report(self):
+        with self.lock:
+            report = {'requests': self.requests, 'scored': self.scored, 'failed': self.failed}
+            if self.latencies:
+                latencies = np.array(self.latencies) * 1000
+                report['latency_ms'] = {'mean': float(np.mean(latencies)),
+                                        'p50': float(np.percentile(latencies, 50)),
+                                        'p95': float(np.percentile(latencies, 95)),
+                                        'max': float(np.max(latencies))}
+        return report
+
+
+class ScoringService(object):
+    """
+    The stored TMASK model, and the pool of numWorkers threads which mask images with it
+    """
+    def __init__(self, coefficients_folder, results_folder, threshold_info, numWorkers=4,
+                 filter_size=3, min_clump=0, creation_options=None):
+        self.juldates, self.coeffs = load_tmask_model(coefficients_folder)
+        self.num_days = load_num_days(coefficients_folder)
+        if self.num_days is None:
+            self.num_days = int(self.juldates[-1] - self.juldates[0])
+        thresholds_cloud, dynamic = threshold_info
+        self.threshold_info = (np.asarray(thresholds_cloud), dynamic)
+
+        # The coefficient store is decompressed whenever it is read, so it is read once
+        if isinstance(self.coeffs, RasterArray):
+            self.coeffs = np.asarray(self.coeffs)
+
+        self.results_folder = results_folder
+        self.filter_size = filter_size
+        self.min_clump = min_clump
+        self.creation_options = creation_options
+        self.executor = ThreadPoolExecutor(max_workers=numWorkers)
+        self.metrics = Metrics()
+
+    def failed(self, img_file, error, start):
+        self.metrics.add(time.time() - start, failed=True)
+        return {'image': img_file, 'error': str(error)}
+
+    def mask(self, img_file, new_image, predicted, start):
+        """
+        Mask one image which has been read and predicted, returning its result as a dict
+        """
+        juldate, image, projection, geotransform = new_image
+        try:
+            fn, cloud_byte = mask_image(img_file, image, predicted, projection, geotransform, self.threshold_info,
+                                        self.results_folder, filter_size=self.filter_size,
+                                        min_clump=self.min_clump, creation_options=self.creation_options)
+        except Exception as e:
+            return self.failed(img_file, e, start)
+
+        elapsed = time.time() - start
+        self.metrics.add(elapsed)
+        return {'image': img_file, 'mask': fn, 'clouds': float(np.mean(cloud_byte == 2)),
+                'shadows': float(np.mean(cloud_byte == 1)), 'seconds': elapsed}
+
+    def score_batch(self, images):
+        """
+        Mask a batch of images. images is a list of file names, or of dicts with the "image"
+        and optionally its "juldate". The images are read in the worker pool, predicted
+        together by one evaluation of the model at all their dates, and then masked in the
+        worker pool. The seconds of each result are from the start of the batch.
+        """
+        start = time.time()
+        self.metrics.add_request()
+        images = [image if isinstance(image, dict) else {'image': image} for image in images]
+        reads = [self.executor.submit(read_new_image, image['image'], self.coeffs, image.get('juldate'))
+                 for image in images]
+
+        results = [None] * len(images)
+        new_images = []
+        for (i, future) in enumerate(reads):
+            try:
+                new_images.append((i, future.result()))
+            except Exception as e:
+                results[i] = self.failed(images[i]['image'], e, start)
+        if not new_images:
+            return results
+
+        juldates = np.array([new_image[0] for (i, new_image) in new_images], dtype=np.float64)
+        predicted = calculate_tmask_model(juldates, self.coeffs, num_days=self.num_days)
+        masks = [(i, self.executor.submit(self.mask, images[i]['image'], new_image, predicted[k:k + 1], start))
+                 for (k, (i, new_image)) in enumerate(new_images)]
+        for (i, future) in masks:
+            results[i] = future.result()
+        return results
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics.report())
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            images = json.loads(self.rfile.read(length).decode('utf-8'))['images']
+            if not isinstance(images, list):
+                raise ValueError('"images" must be a list')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': 'Bad request: %s' % e})
+            return
+
+        self.send_json(200, {'results': self.server.service.score_batch(images)})
+
+
+class ScoringServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+
+
+def parse_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',
+                        help='address the service listens on',
+                        default='127.0.0.1')
+    parser.add_argument('--port',
+                        type=int,
+                        help='port the service listens on',
+                        default=8470)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='number of threads masking images',
+                        default=4)
+    parser.add_argument('--dynamic-threshold',
+                        action='store_true',
+                        help='use a dynamic threshold based on RMSE instead of static ones',
+                        default=False)
+    parser.add_argument('--filter-size',
+                        type=int,
+                        help='size of the majority filter which removes very small clumps from the masks',
+                        default=3)
+    parser.add_argument('--min-clump',
+                        type=int,
+                        help='remove clumps of fewer pixels from the masks after filtering',
+                        default=0)
+    parser.add_argument('--co',
+                        action='append',
+                        metavar='NAME=VALUE',
+                        help='GDAL creation option of the masks; can be given more than once',
+                        default=[])
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_params()
+    if not os.path.exists(RESULTS_FOLDER):
+        os.makedirs(RESULTS_FOLDER)
+    threshold_info = get_threshold_info(args, COEFFICIENTS_FOLDER)
+    service = ScoringService(COEFFICIENTS_FOLDER, RESULTS_FOLDER, threshold_info, numWorkers=args.workers,
+                             filter_size=args.filter_size, min_clump=args.min_clump, creation_options=args.co)
+    server = ScoringServer((args.host, args.port), service)
+    print('Scoring service listening on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.executor.shutdown()
@@ -24,6 +24,8 @@ setup(
                            sources=["robreg_module.pyx", "robreg.c"],
                            include_dirs=[numpy.get_include(), '/usr/include'],
                            library_dirs=['/usr/lib'],
-                           libraries=['gsl', 'gslcblas', 'm'])
+                           libraries=['gsl', 'gslcblas', 'm'],
+                           extra_compile_args=['-fopenmp'],
+                           extra_link_args=['-fopenmp'])
                  ],
 )
@@ -0,0 +1,60 @@
+"""
+Synthetic image stacks and GeoTIFFs for the tests and benchmarks
+"""
+
+from osgeo import gdal
+import numpy as np
+
+
+# The coefficients of the annual cycle followed by the synthetic stacks
+COEFFS = np.array([1500.0, 300.0, -80.0, 20.0, 10.0])
+
+
+def make_design_matrix(numImages, rng):
+    """
+    Return the design matrix of the TMASK regression, of shape (5, numImages), for
+    numImages sorted dates drawn from rng over a period of about 1000 days.
+    """
+    juldate = np.sort(rng.uniform(2457000, 2458000, numImages))
+    num_days = int(juldate[-1] - juldate[0])
+    return np.array([np.ones(numImages),
+                     np.cos(2.0 * np.pi * juldate / 365),
+                     np.sin(2.0 * np.pi * juldate / 365),
+                     np.cos(2.0 * np.pi * juldate / num_days),
+                     np.sin(2.0 * np.pi * juldate / num_days)], order='C')
+
+
+def make_stack(numImages, numBands, numRows, numCols, seed=0, patchSize=None, cloudFraction=0.1, nullFraction=0.1):
+    """
+    Make an image stack of uint16 TOAR-like values, following an annual cycle, with
+    cloudFraction of the observations cloudy and nullFraction nodata. Returns a tuple
+    (x, stack) of the design matrix and the stack.
+
+    If patchSize is given, the pixels are in square patches of patchSize pixels, each of
+    which follows its own annual cycle.
+    """
+    rng = np.random.RandomState(seed)
+    x = make_design_matrix(numImages, rng)
+
+    coeffs = np.broadcast_to(COEFFS[:, None, None], (len(x), numRows, numCols))
+    if patchSize is not None:
+        patchRows = -(-numRows // patchSize)
+        patchCols = -(-numCols // patchSize)
+        coeffs = COEFFS[:, None, None] * rng.uniform(0.5, 1.5, (len(x), patchRows, patchCols))
+        coeffs = coeffs.repeat(patchSize, axis=1).repeat(patchSize, axis=2)[:, :numRows, :numCols]
+
+    curve = np.einsum('pd,prc->drc', x, coeffs)
+    stack = np.empty((numImages, numBands, numRows, numCols), dtype=np.uint16)
+    for i in range(numImages):
+        image = curve[i] + rng.normal(0, 20, (numBands, numRows, numCols))
+        image[:, rng.uniform(size=(numRows, numCols)) < cloudFraction] += 3000
+        image[:, rng.uniform(size=(numRows, numCols)) < nullFraction] = 0
+        stack[i] = image
+    return x, stack
+
+
+def write_tif(fn, data):
+    ds = gdal.GetDriverByName('GTiff').Create(fn, data.shape[2], data.shape[1], data.shape[0], gdal.GDT_UInt16)
+    for band in range(data.shape[0]):
+        ds.GetRasterBand(band + 1).WriteArray(data[band])
+    ds = None
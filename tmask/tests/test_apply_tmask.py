@@ -0,0 +1,59 @@
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy as np
+
+from tmask.apply_tmask import score_image
+from tmask.create_cloud_masks import calculate_tmask_model, cloud_mask_bytes, get_threshold_info
+from tmask.tests.test_create_cloud_masks import COEFF_FILE, DATE_FILE, INPUT_DIR, TOAR_FILE
+
+# The index of the date of TOAR_FILE in the fitted series
+TOAR_DATE = 39
+
+
+class FakeArgs:
+    dynamic_threshold = False
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.results = tempfile.mkdtemp()
+        self.coeffs = np.load(COEFF_FILE)
+        self.juldates = np.load(DATE_FILE)
+        self.threshold_info = get_threshold_info(FakeArgs(), INPUT_DIR)
+        ds = gdal.Open(TOAR_FILE, gdal.GA_ReadOnly)
+        self.image = ds.ReadAsArray()[None].astype(np.uint16)
+        ds = None
+
+    def tearDown(self):
+        shutil.rmtree(self.results)
+
+    def expected_mask(self, num_days=None):
+        predicted = calculate_tmask_model(self.juldates, self.coeffs, dates=[TOAR_DATE], num_days=num_days)
+        thresholds_cloud, dynamic = self.threshold_info
+        return cloud_mask_bytes(self.image, predicted, thresholds_cloud, dynamic)[0]
+
+    def test_matches_mask_of_fitted_date(self):
+        # The julian date is taken from the file name
+        fn, cloud_byte = score_image(TOAR_FILE, self.juldates, self.coeffs, self.threshold_info, self.results)
+        self.assertTrue(np.array_equal(cloud_byte, self.expected_mask()))
+
+        ds = gdal.Open(fn, gdal.GA_ReadOnly)
+        self.assertTrue(np.array_equal(ds.GetRasterBand(1).ReadAsArray(), cloud_byte))
+        ds = None
+
+    def test_num_days(self):
+        fn, cloud_byte = score_image(TOAR_FILE, self.juldates, self.coeffs, self.threshold_info, self.results,
+                                     juldate=self.juldates[TOAR_DATE], num_days=365)
+        self.assertTrue(np.array_equal(cloud_byte, self.expected_mask(num_days=365)))
+
+    def test_size_mismatch(self):
+        with self.assertRaises(ValueError):
+            score_image(TOAR_FILE, self.juldates, self.coeffs[:, :, :1], self.threshold_info, self.results)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+
+from tmask import coarse_fit, robustregression, tile_fit
+from tmask.tests.synthetic import COEFFS, make_stack
+
+
+class Test(unittest.TestCase):
+
+    def fit(self, x, stack, tolerance):
+        numImages, numBands, numRows, numCols = stack.shape
+        c = np.zeros((numBands, len(x), numRows, numCols), dtype=np.float32)
+        rmse = np.zeros((numBands, numRows, numCols), dtype=np.float32)
+        results = coarse_fit.fit_stack_coarse(x, stack, c, rmse, 3, tolerance=tolerance,
+                                              backend=robustregression.BACKEND_NUMPY)
+        return c, rmse, results
+
+    def test_zero_tolerance_matches_full_fit(self):
+        x, stack = make_stack(40, 2, 10, 7)
+        c = np.zeros((2, len(x), 10, 7), dtype=np.float32)
+        rmse = np.zeros((2, 10, 7), dtype=np.float32)
+        tile_fit.fit_stack(x, stack, c, rmse, backend=robustregression.BACKEND_NUMPY)
+
+        cCoarse, rmseCoarse, results = self.fit(x, stack, 0)
+        self.assertEqual(results.numRefitted, 70)
+        self.assertTrue(np.array_equal(cCoarse, c))
+        self.assertTrue(np.array_equal(rmseCoarse, rmse))
+
+    def test_large_tolerance_keeps_interpolated_model(self):
+        x, stack = make_stack(40, 2, 10, 7)
+        c, rmse, results = self.fit(x, stack, 1e9)
+        self.assertEqual(results.numRefitted, 0)
+        self.assertEqual(results.numPixels, 70)
+
+        # The stack follows one curve, so the interpolated model is close to it
+        predicted = np.einsum('pd,bprc->dbrc', x, c)
+        curve = COEFFS.dot(x)
+        self.assertLess(np.abs(predicted - curve[:, None, None, None]).max(), 30)
+        self.assertTrue((rmse > 0).all())
+
+    def test_interpolated_rmse_matches_full_fit(self):
+        x, stack = make_stack(60, 2, 12, 9)
+        c = np.zeros((2, len(x), 12, 9), dtype=np.float32)
+        rmse = np.zeros((2, 12, 9), dtype=np.float32)
+        tile_fit.fit_stack(x, stack, c, rmse, backend=robustregression.BACKEND_NUMPY)
+
+        # The cloudy residuals don't inflate the rmse of the interpolated pixels. Pixels
+        # whose full fit doesn't converge are left as zeros.
+        fitted = rmse > 0
+        cCoarse, rmseCoarse, results = self.fit(x, stack, 1e9)
+        self.assertEqual(results.numRefitted, 0)
+        self.assertTrue(np.allclose(rmseCoarse[fitted], rmse[fitted], rtol=0.01))
+
+        valid = coarse_fit.valid_observations(stack)
+        robust, stored = coarse_fit.residual_rmse(x, stack, c, valid)
+        self.assertTrue(np.allclose(stored[fitted], rmse[fitted], rtol=1e-5))
+
+    def test_masked_median(self):
+        values = np.array([[4.0, 1.0, 3.0, 2.0], [5.0, 7.0, 6.0, 8.0], [1.0, 2.0, 3.0, 4.0]])
+        valid = np.array([[True, True, True, True], [True, False, True, True], [False] * 4])
+        median = coarse_fit.masked_median(values, valid)
+        self.assertEqual(list(median[:2]), [2.5, 6.0])
+        self.assertTrue(np.isnan(median[2]))
+
+    def test_interpolate_constant(self):
+        coarseC = np.full((2, 5, 4, 3), 7.0)
+        c = coarse_fit.interpolate_coeffs(coarseC, 3, 10, 8)
+        self.assertEqual(c.shape, (2, 5, 10, 8))
+        self.assertTrue(np.allclose(c, 7.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from tmask.coeff_store import RasterArray, write_array, open_array
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.coeffs = rng.normal(0, 1000, (4, 5, 9, 7)).astype(np.float32)
+        self.geotransform = (500000.0, 3.0, 0.0, 4000000.0, 0.0, -3.0)
+        self.fn = os.path.join(self.folder, 'tmask_coeffs.tif')
+        write_array(self.fn, self.coeffs, '', self.geotransform)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        store = RasterArray(self.fn)
+        self.assertEqual(store.shape, self.coeffs.shape)
+        self.assertEqual(store.dtype, self.coeffs.dtype)
+        self.assertEqual(tuple(store.geotransform), self.geotransform)
+        self.assertTrue(np.array_equal(np.asarray(store), self.coeffs))
+
+    def test_indexing_matches_numpy(self):
+        store = RasterArray(self.fn)
+        for key in [(1, ..., 5, [1, 4]), (..., slice(2, 8, 3), -1), ([2, 0], slice(None), slice(1, 5)),
+                    (slice(None, None, -1), 2), (0, 0, slice(6, 1, -2)), 3]:
+            self.assertTrue(np.array_equal(store[key], self.coeffs[key]), key)
+
+    def test_npy_is_preferred(self):
+        np.save(os.path.join(self.folder, 'tmask_coeffs_complete.npy'), self.coeffs + 1)
+        coeffs = open_array(self.folder, 'tmask_coeffs_complete.npy', 'tmask_coeffs.tif')
+        self.assertTrue(np.array_equal(coeffs, self.coeffs + 1))
+        os.remove(os.path.join(self.folder, 'tmask_coeffs_complete.npy'))
+        self.assertIsInstance(open_array(self.folder, 'tmask_coeffs_complete.npy', 'tmask_coeffs.tif'),
+                              RasterArray)
+        self.assertIsNone(open_array(self.folder, 'tmask_rmse.npy', 'tmask_rmse.tif'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 from osgeo import gdal
 import numpy as np
 
 from tmask.create_cloud_masks import calculate_tmask_model, create_cloud_masks, get_threshold_info
+from tmask.mask_cube import MASK_CUBE_FILE, read_mask_history
+from tmask.tests.synthetic import write_tif
 
 INPUT_DIR = '/home/{}/tmask/tests/test_data'.format(os.environ['USER'])
 
@@ -26,6 +30,15 @@ class Test(unittest.TestCase):
         expected = np.load(EXPECTED_RESULT)
         self.assertTrue(np.array_equal(expected, result))
 
+    def test_fitted_curve_subset(self):
+        coeffs = np.load(COEFF_FILE)
+        juldate = np.load(DATE_FILE)
+
+        full = calculate_tmask_model(juldate, coeffs)
+        dates = [0, 5, 100, len(juldate) - 1]
+        result = calculate_tmask_model(juldate, coeffs, dates=dates, window=(1, 0, 1, 2), chunk_dates=3)
+        self.assertTrue(np.array_equal(full[dates][:, :, 0:2, 1:2], result))
+
     def test_create_cloud_masks(self):
         img_files = [TOAR_FILE] * 239
 
@@ -35,7 +48,7 @@ class Test(unittest.TestCase):
 
         args = FakeArgs(False)
         threshold_info = get_threshold_info(args, INPUT_DIR)
-        create_cloud_masks(img_files, threshold_info, INPUT_DIR, INPUT_DIR)
+        create_cloud_masks(img_files, threshold_info, INPUT_DIR, INPUT_DIR, write_predictions=True)
 
         generated_cloud = os.path.join(INPUT_DIR, "281332_3061411_2016-10-31_0c0b_subarea_toar_cloud.tif")
         ds = gdal.Open(generated_cloud, gdal.GA_ReadOnly)
@@ -58,4 +71,32 @@ class Test(unittest.TestCase):
         os.unlink(generated_cloud)
         os.unlink(generated_pred)
 
-
+    def test_roi_matches_crop_of_full_aoi(self):
+        folder = tempfile.mkdtemp()
+        try:
+            # A flat model, and images whose residuals are noisy enough that the majority
+            # filter changes the masks at the edges of the region of interest
+            rng = np.random.RandomState(0)
+            coeffs = np.zeros((4, 5, 12, 16), dtype=np.float32)
+            coeffs[:, 0] = 1000
+            np.save(os.path.join(folder, 'tmask_coeffs_complete.npy'), coeffs)
+            np.save(os.path.join(folder, 'tmask_date.npy'), np.arange(2457000.0, 2457050.0, 10.0))
+            np.save(os.path.join(folder, 'tmask_rmse.npy'), np.ones((4, 12, 16), dtype=np.float32))
+            analytic = 1000 + rng.uniform(-800, 800, (5, 4, 12, 16))
+            np.save(os.path.join(folder, 'tmask_analytic_complete.npy'), analytic.astype(np.uint16))
+            img_files = [os.path.join(folder, 'img%d_toar.tif' % i) for i in range(5)]
+            write_tif(img_files[0], np.ones((4, 12, 16), dtype=np.uint16))
+
+            threshold_info = (np.ones((4, 12, 16)) * 400, False)
+            results = {}
+            for name, window in (('full', None), ('roi', (5, 3, 7, 6))):
+                results[name] = os.path.join(folder, name)
+                os.mkdir(results[name])
+                create_cloud_masks(img_files, threshold_info, folder, results[name], mask_cube=True, window=window)
+
+            full = read_mask_history(os.path.join(results['full'], MASK_CUBE_FILE), 5, 3, 7, 6)
+            roi = read_mask_history(os.path.join(results['roi'], MASK_CUBE_FILE), 0, 0, 7, 6)
+            self.assertTrue(np.array_equal(roi, full))
+            self.assertTrue(np.any(full == 2) and np.any(full == 1))
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from tmask.datacube import Datacube
+from tmask.tests.synthetic import write_tif
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.images = rng.randint(1, 10000, (3, 4, 6, 5)).astype(np.uint16)
+        self.files = []
+        for i, image in enumerate(self.images):
+            fn = os.path.join(self.folder, 'image%d_toar.tif' % i)
+            write_tif(fn, image)
+            self.files.append(fn)
+        self.cubeFolder = os.path.join(self.folder, 'datacube')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stack_matches_images(self):
+        cube = Datacube(self.cubeFolder, self.files)
+        self.assertEqual(cube.update(), 3)
+        self.assertTrue(cube.is_complete())
+        self.assertEqual(cube.shape, self.images.shape)
+        self.assertTrue(np.array_equal(cube[:], self.images))
+        self.assertTrue(np.array_equal(cube[:, :, 2, 3], self.images[:, :, 2, 3]))
+
+        block = np.zeros((3, 4, 2, 5), dtype=np.uint16)
+        cube.read_block(block, 1, 3)
+        self.assertTrue(np.array_equal(block, self.images[:, :, 1:3]))
+
+    def test_only_changed_images_are_read(self):
+        Datacube(self.cubeFolder, self.files).update()
+        self.assertEqual(Datacube(self.cubeFolder, self.files).update(), 0)
+
+        # Rewrite one image, and add another. The mtime is moved on explicitly, in case
+        # the file system only records whole seconds.
+        write_tif(self.files[1], self.images[1] + 1)
+        mtime = os.stat(self.files[1]).st_mtime + 10
+        os.utime(self.files[1], (mtime, mtime))
+        newFile = os.path.join(self.folder, 'image3_toar.tif')
+        write_tif(newFile, self.images[0])
+
+        cube = Datacube(self.cubeFolder, self.files + [newFile])
+        self.assertFalse(cube.is_complete())
+        self.assertEqual(cube.update(), 2)
+        self.assertTrue(np.array_equal(cube[1], self.images[1] + 1))
+        self.assertTrue(np.array_equal(cube[3], self.images[0]))
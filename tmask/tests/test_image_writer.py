@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+from tmask.image_writer import ImageWriter
+
+
+class FakeDataset:
+    def __init__(self, files, fn, options):
+        self.files = files
+        self.fn = fn
+        self.options = options
+
+    def SetProjection(self, projection):
+        pass
+
+    def SetGeoTransform(self, geotransform):
+        pass
+
+    def GetRasterBand(self, band):
+        return self
+
+    def WriteArray(self, image):
+        if self.fn == 'bad.tif':
+            raise IOError('cannot write %s' % self.fn)
+        self.files.setdefault(self.fn, []).append((image.copy(), self.options))
+
+
+class FakeDriver:
+    def __init__(self):
+        self.files = {}
+
+    def Create(self, fn, height, width, bands, datatype, options=None):
+        return FakeDataset(self.files, fn, options)
+
+
+class Test(unittest.TestCase):
+
+    def test_images_written_in_order(self):
+        drv = FakeDriver()
+        img_info = (drv, 2, 2, '', (0, 1, 0, 0, 0, -1))
+        with ImageWriter(numThreads=3, queueSize=2, options=['COMPRESS=DEFLATE']) as writer:
+            for i in range(50):
+                writer.write('%d.tif' % (i % 4), img_info, 1, np.full((2, 2), i), 1)
+
+        self.assertEqual(sorted(drv.files), ['0.tif', '1.tif', '2.tif', '3.tif'])
+        for j in range(4):
+            writes = drv.files['%d.tif' % j]
+            self.assertEqual([image[0, 0] for image, options in writes], list(range(j, 50, 4)))
+            self.assertTrue(all(options == ['COMPRESS=DEFLATE'] for image, options in writes))
+        self.assertEqual(len(writer.latencies), 50)
+
+    def test_errors_raised(self):
+        img_info = (FakeDriver(), 2, 2, '', (0, 1, 0, 0, 0, -1))
+        writer = ImageWriter(numThreads=2)
+        writer.write('bad.tif', img_info, 1, np.zeros((2, 2)), 1)
+        writer.write('good.tif', img_info, 1, np.zeros((2, 2)), 1)
+        with self.assertRaises(IOError):
+            writer.close()
@@ -0,0 +1,125 @@
+import unittest
+
+import numpy as np
+
+from tmask import irls, robustregression
+from tmask.tests import synthetic
+
+
+def make_stack(numImages=120, numRows=6, numCols=5, seed=0):
+    x, stack = synthetic.make_stack(numImages, 1, numRows, numCols, seed=seed, nullFraction=0.2)
+    return x, stack[:, 0].astype(np.float64), synthetic.COEFFS
+
+
+class Test(unittest.TestCase):
+
+    def test_recovers_coefficients(self):
+        x, y, coeffs = make_stack()
+        c, adj_Rsqrd, numIter, rmse = irls.multifit_robust_bisquare(x, y, 0)
+
+        self.assertEqual(c.shape, (5, 6, 5))
+        self.assertTrue(np.all(np.abs(c - coeffs[:, None, None]) < 20))
+        self.assertTrue(np.all(rmse > 0))
+        self.assertTrue(np.all(numIter > 0))
+
+    def test_chunking_does_not_change_result(self):
+        x, y, coeffs = make_stack()
+        whole = irls.multifit_robust_bisquare(x, y, 0)
+        chunked = irls.multifit_robust_bisquare(x, y, 0, chunkSize=7)
+        for a, b in zip(whole, chunked):
+            self.assertTrue(np.allclose(a, b, rtol=1e-12))
+
+    def test_too_few_points_left_as_zero(self):
+        x, y, coeffs = make_stack()
+        y[3:, 0, 0] = 0
+        c, adj_Rsqrd, numIter, rmse = irls.multifit_robust_bisquare(x, y, 0)
+        self.assertTrue(np.all(c[:, 0, 0] == 0))
+        self.assertEqual(rmse[0, 0], 0)
+
+    @unittest.skipIf(robustregression.robreg is None, "robreg extension not built")
+    def test_matches_gsl(self):
+        x, y, coeffs = make_stack()
+        gsl = robustregression.gsl_multifit_robust(x, y, nullVal=0)
+        numpy_fit = robustregression.gsl_multifit_robust(x, y, nullVal=0, backend=robustregression.BACKEND_NUMPY)
+        self.assertTrue(np.allclose(gsl.coeffs, numpy_fit.coeffs, rtol=irls.GSL_AGREEMENT_RTOL))
+        self.assertTrue(np.allclose(gsl.rmse, numpy_fit.rmse, rtol=irls.GSL_AGREEMENT_RTOL))
+
+    def test_shared_validity_patterns(self):
+        x, y, coeffs = make_stack()
+        # Null whole dates, so most pixels share one validity pattern
+        y = np.where(y == 0, 1500, y)
+        y[::7] = 0
+        y[5, 0, 0] = 0
+
+        first, inverse = irls.validity_groups(y.reshape((y.shape[0], -1)) != 0)
+        self.assertEqual(len(first), 2)
+
+        grouped = irls.multifit_robust_bisquare(x, y, 0)
+        minGroupSize = irls.MIN_GROUP_SIZE
+        irls.MIN_GROUP_SIZE = y.size
+        try:
+            ungrouped = irls.multifit_robust_bisquare(x, y, 0)
+        finally:
+            irls.MIN_GROUP_SIZE = minGroupSize
+        for a, b in zip(grouped, ungrouped):
+            self.assertTrue(np.allclose(a, b, rtol=1e-9))
+
+    def test_multiband_matches_single_band(self):
+        x, y, coeffs = make_stack()
+        rng = np.random.RandomState(1)
+        stack = np.stack([y, y * 0.5, y + rng.normal(0, 10, y.shape)], axis=1)
+        stack[np.broadcast_to(y[:, None] == 0, stack.shape)] = 0
+
+        multi = irls.multifit_robust_bisquare_multiband(x, stack, 0)
+        self.assertEqual(multi[0].shape, (3, 5, 6, 5))
+        for band in range(3):
+            single = irls.multifit_robust_bisquare(x, stack[:, band], 0)
+            for a, b in zip(multi, single):
+                self.assertTrue(np.allclose(a[band], b, rtol=1e-9))
+
+    def test_output_arrays_filled_in_place(self):
+        x, y, coeffs = make_stack()
+        full = robustregression.gsl_multifit_robust(x, y, nullVal=0, backend=robustregression.BACKEND_NUMPY)
+
+        c = np.full((5, 6, 5), np.nan, dtype=np.float32)
+        rmse = np.full((6, 5), np.nan, dtype=np.float32)
+        minimal = robustregression.gsl_multifit_robust(x, y, nullVal=0, backend=robustregression.BACKEND_NUMPY,
+                                                       regStats=robustregression.REGSTATS_MINIMAL,
+                                                       coeffsOut=c, rmseOut=rmse)
+        self.assertIs(minimal.coeffs, c)
+        self.assertIs(minimal.rmse, rmse)
+        self.assertIsNone(minimal.adj_Rsqrd)
+        self.assertIsNone(minimal.numIter)
+        self.assertTrue(np.array_equal(c, full.coeffs.astype(np.float32)))
+        self.assertTrue(np.array_equal(rmse, full.rmse.astype(np.float32)))
+
+        with self.assertRaises(robustregression.RegressionError):
+            robustregression.gsl_multifit_robust(x, y, nullVal=0, backend=robustregression.BACKEND_NUMPY,
+                                                 coeffsOut=c, rmseOut=np.zeros((6, 5)))
+
+    def test_pixel_major_layout(self):
+        x, y, coeffs = make_stack()
+        stack = np.stack([y, y * 0.5], axis=1).astype(np.uint16)
+
+        imageMajor = robustregression.gsl_multifit_robust_multiband(x, stack, nullVal=0,
+                                                                    backend=robustregression.BACKEND_NUMPY)
+        pixelMajor = robustregression.gsl_multifit_robust_multiband(x, robustregression.pixel_major_stack(stack),
+                                                                    nullVal=0,
+                                                                    backend=robustregression.BACKEND_NUMPY,
+                                                                    layout=robustregression.LAYOUT_PIXEL_MAJOR)
+        self.assertTrue(np.array_equal(imageMajor.coeffs, pixelMajor.coeffs))
+        self.assertTrue(np.array_equal(imageMajor.rmse, pixelMajor.rmse))
+
+    def test_exclude_mask_matches_zeroed_stack(self):
+        x, y, coeffs = make_stack()
+        stack = np.stack([y, y * 0.5], axis=1).astype(np.uint16)
+        clouds = np.random.RandomState(1).uniform(size=(stack.shape[0],) + stack.shape[2:]) < 0.1
+        zeroed = stack * np.invert(clouds)[:, None]
+
+        expected = robustregression.gsl_multifit_robust_multiband(x, zeroed, nullVal=0,
+                                                                  backend=robustregression.BACKEND_NUMPY)
+        masked = robustregression.gsl_multifit_robust_multiband(x, stack, nullVal=0,
+                                                                backend=robustregression.BACKEND_NUMPY,
+                                                                excludeMask=robustregression.pack_mask(clouds))
+        self.assertTrue(np.array_equal(expected.coeffs, masked.coeffs))
+        self.assertTrue(np.array_equal(expected.rmse, masked.rmse))
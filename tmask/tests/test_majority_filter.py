@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+from scipy import ndimage
+
+from tmask.majority_filter import majority_filter
+
+
+class Test(unittest.TestCase):
+
+    def test_matches_median_filter(self):
+        rng = np.random.RandomState(0)
+        for shape in [(1, 1), (1, 7), (5, 1), (13, 29), (64, 80)]:
+            for density in (0.1, 0.5, 0.9):
+                masks = rng.uniform(size=(4,) + shape) < density
+                for size in (3, 5):
+                    expected = np.array([ndimage.median_filter(mask, size=(size, size)) for mask in masks])
+                    self.assertTrue(np.array_equal(expected, majority_filter(masks, size)))
+
+    def test_small_clumps_removed(self):
+        masks = np.zeros((2, 10, 10), dtype=bool)
+        masks[0, 1:4, 1:4] = True
+        masks[0, 6:9, 5:9] = True
+        masks[1, 4:7, 4:8] = True
+
+        result = majority_filter(masks, 3, minClump=6)
+        self.assertFalse(np.any(result[0, :5]))
+        self.assertTrue(np.any(result[0, 5:]))
+        self.assertTrue(np.array_equal(result[1], majority_filter(masks[1], 3)))
+
+    def test_even_size_rejected(self):
+        with self.assertRaises(ValueError):
+            majority_filter(np.zeros((4, 4), dtype=bool), 2)
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy as np
+
+from tmask.mask_cube import MaskCube, read_date_index, read_mask_history
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        fn = os.path.join(self.folder, 'mask_cube.tif')
+        img_info = (gdal.GetDriverByName('GTiff'), 5, 4, '', (0, 3, 0, 0, 0, -3))
+        juldates = [2457000.25, 2457010.5, 2457020.75]
+        img_files = ['a/img1_toar.tif', 'a/img2_toar.tif', 'a/img3_toar.tif']
+        rng = np.random.RandomState(0)
+        masks = rng.randint(0, 3, (3, 4, 5)).astype(np.uint8)
+
+        with MaskCube(fn, img_info, juldates, img_files) as cube:
+            for i, mask in enumerate(masks):
+                cube.write(i, mask)
+
+        self.assertEqual(read_date_index(fn), [(1, 2457000.25, 'a/img1_toar.tif'),
+                                               (2, 2457010.5, 'a/img2_toar.tif'),
+                                               (3, 2457020.75, 'a/img3_toar.tif')])
+        history = read_mask_history(fn, 3, 2)
+        self.assertEqual(history.shape, (3, 1, 1))
+        self.assertEqual(list(history[:, 0, 0]), list(masks[:, 2, 3]))
+        self.assertTrue(np.array_equal(read_mask_history(fn, 1, 1, 3, 2), masks[:, 1:3, 1:4]))
+
+
+if __name__ == '__main__':
+    unittest.main()
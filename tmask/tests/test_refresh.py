@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from tmask import irls, refresh
+from tmask.tests.synthetic import make_stack
+
+
+class Test(unittest.TestCase):
+
+    def test_new_images(self):
+        prevImages = [('a.tif', [1.0, 10]), ('b.tif', [2.0, 10]), ('c.tif', [3.0, 10])]
+        images = [('a.tif', [1.0, 10]), ('d.tif', [4.0, 10]), ('b.tif', [2.5, 10]), ('c.tif', [3.0, 10])]
+        newDates, prevKept, kept = refresh.new_images(prevImages, images)
+
+        # b.tif was rewritten, so it is refreshed as well as the new d.tif
+        self.assertEqual(list(newDates), [1, 2])
+        self.assertEqual(list(prevKept), [0, 2])
+        self.assertEqual(list(kept), [0, 3])
+
+        with self.assertRaises(refresh.RefreshError):
+            refresh.new_images(prevImages, images[:2])
+        with self.assertRaises(refresh.RefreshError):
+            refresh.new_images(prevImages, images + [('a.tif', [1.0, 10])])
+
+    def test_warm_start_matches_full_fit(self):
+        x, stack = make_stack(140, 1, 6, 5, nullFraction=0.2)
+        c0, adj_Rsqrd, numIter, rmse0 = irls.multifit_robust_bisquare_multiband(x[:, :120], stack[:120], 0)
+        c, adj_Rsqrd, numIter, rmse = irls.multifit_robust_bisquare_multiband(x, stack, 0)
+
+        # Every pixel is refitted, starting from the fit of the first 120 dates
+        cNew = c0.astype(np.float32)
+        rmseNew = rmse0.astype(np.float32)
+        selected = np.ones(stack.shape[2:], dtype=bool)
+        numWarm, meanIter = refresh.refit_pixels(x, stack, cNew, rmseNew, selected, maxIter=irls.MAX_ITER)
+        self.assertEqual(numWarm, np.sum(rmse0 > 0))
+        self.assertTrue(0 < meanIter < irls.MAX_ITER)
+        self.assertTrue(np.allclose(cNew, c, rtol=1e-4, atol=1e-2))
+        self.assertTrue(np.allclose(rmseNew, rmse, rtol=1e-4))
+
+    def test_only_outlying_pixels_are_selected(self):
+        x, stack = make_stack(130, 1, 6, 5, nullFraction=0.2)
+        c, adj_Rsqrd, numIter, rmse = irls.multifit_robust_bisquare_multiband(x[:, :120], stack[:120], 0)
+
+        newStack = np.round(np.einsum('pd,bprc->dbrc', x[:, 120:], c)).astype(np.uint16)
+        newStack[3, 0, 2, 1] += 1000
+        newStack[5, 0, 4, 4] = 0
+        selected = refresh.exceeds_rmse(x[:, 120:], newStack, c, rmse)
+        self.assertEqual([tuple(p) for p in np.argwhere(selected)], [(2, 1)])
+
+        excluded = np.zeros((10,) + selected.shape, dtype=bool)
+        excluded[3, 2, 1] = True
+        self.assertFalse(refresh.exceeds_rmse(x[:, 120:], newStack, c, rmse, excluded=excluded).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from osgeo import osr
+
+from tmask import roi
+
+GEOTRANSFORM = (1000.0, 3.0, 0, 5000.0, 0, -3.0)
+
+
+class Test(unittest.TestCase):
+
+    def test_bbox_window(self):
+        self.assertEqual(roi.bbox_window(GEOTRANSFORM, (1003.0, 4970.0, 1010.0, 4997.0), 13, 29), (1, 1, 3, 9))
+        self.assertEqual(roi.bbox_window(GEOTRANSFORM, (900.0, 4000.0, 2000.0, 6000.0), 13, 29), (0, 0, 13, 29))
+        with self.assertRaises(ValueError):
+            roi.bbox_window(GEOTRANSFORM, (0.0, 0.0, 10.0, 10.0), 13, 29)
+
+    def test_geojson_bbox(self):
+        geojson = {'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature',
+                                 'geometry': {'type': 'Polygon',
+                                              'coordinates': [[[1, 2], [5, 2], [5, 7], [1, 2]]]}},
+                                {'type': 'Feature',
+                                 'geometry': {'type': 'MultiPoint', 'coordinates': [[-1, 3], [0, 9.5]]}}]}
+        self.assertEqual(roi.geojson_bbox(geojson), (-1, 2, 5, 9.5))
+
+    def test_geojson_bbox_transformed(self):
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32633)
+        utm = srs.ExportToWkt()
+
+        # WGS84 longitude and latitude, into UTM zone 33N, whose central meridian is 15E
+        geojson = {'type': 'Polygon', 'coordinates': [[[15, 45], [16, 45], [16, 45.5], [15, 45.5], [15, 45]]]}
+        minx, miny, maxx, maxy = roi.geojson_bbox(geojson, utm)
+        self.assertAlmostEqual(minx, 500000.0, places=1)
+        self.assertAlmostEqual(miny, 4982950.4, places=1)
+        self.assertAlmostEqual(maxx, 578815.3, places=1)
+        self.assertGreater(maxy, miny + 50000)
+
+        # The crs member of older GeoJSON gives the coordinates' CRS
+        geojson = {'type': 'Feature', 'crs': {'type': 'name', 'properties': {'name': 'EPSG:32633'}},
+                   'geometry': {'type': 'Point', 'coordinates': [510000.0, 4990000.0]}}
+        self.assertEqual(roi.geojson_bbox(geojson, utm), (510000.0, 4990000.0, 510000.0, 4990000.0))
+
+    def test_window_geotransform(self):
+        self.assertEqual(roi.window_geotransform(GEOTRANSFORM, 2, 5), (1006.0, 3.0, 0, 4985.0, 0, -3.0))
@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from osgeo import gdal
+import numpy as np
+
+from tmask import apply_tmask, scoring_service
+from tmask.apply_tmask import score_image
+from tmask.create_cloud_masks import get_threshold_info
+from tmask.scoring_service import Metrics, ScoringServer, ScoringService
+from tmask.tests.test_apply_tmask import TOAR_DATE, FakeArgs
+from tmask.tests.test_create_cloud_masks import INPUT_DIR, TOAR_FILE
+
+
+def fake_read_new_image(img_file, coeffs, juldate=None):
+    if img_file == 'bad.tif':
+        raise IOError('cannot read %s' % img_file)
+    image = np.zeros((1,) + coeffs.shape[:1] + coeffs.shape[2:], dtype=np.uint16)
+    return (2457000.0 if juldate is None else juldate), image, '', (0, 1, 0, 0, 0, -1)
+
+
+def fake_mask_image(img_file, image, predicted, projection, geotransform, threshold_info, results_folder, **kwargs):
+    cloud_byte = np.zeros(image.shape[2:], dtype=np.uint8)
+    cloud_byte[0, 0] = 2
+    if img_file == 'b.tif':
+        cloud_byte[0, 1] = 1
+    return img_file.replace('.tif', '_cloud.tif'), cloud_byte
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.results = tempfile.mkdtemp()
+        for (name, fake) in (('read_new_image', fake_read_new_image), ('mask_image', fake_mask_image)):
+            patcher = mock.patch.object(scoring_service, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        threshold_info = (np.ones((4, 2, 2)) * 400, False)
+        self.service = ScoringService(INPUT_DIR, self.results, threshold_info, numWorkers=2)
+        self.server = ScoringServer(('127.0.0.1', 0), self.service)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.service.executor.shutdown()
+        shutil.rmtree(self.results)
+
+    def request(self, path, body=None):
+        data = None if body is None else body.encode('utf-8')
+        try:
+            with urlopen(Request(self.url + path, data=data)) as response:
+                return response.status, json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+
+    def test_score(self):
+        body = json.dumps({'images': ['a.tif', {'image': 'b.tif', 'juldate': 2457693}, 'bad.tif']})
+        with mock.patch.object(scoring_service, 'calculate_tmask_model',
+                               wraps=scoring_service.calculate_tmask_model) as predict:
+            status, reply = self.request('/score', body)
+        self.assertEqual(status, 200)
+
+        # The images which were read are predicted together
+        self.assertEqual(predict.call_count, 1)
+        self.assertEqual(list(predict.call_args[0][0]), [2457000.0, 2457693.0])
+
+        (a, b, bad) = reply['results']
+        self.assertEqual(a['mask'], 'a_cloud.tif')
+        self.assertEqual(a['clouds'], 0.25)
+        self.assertEqual(a['shadows'], 0.0)
+        self.assertEqual(b['image'], 'b.tif')
+        self.assertEqual(b['shadows'], 0.25)
+        self.assertEqual(bad, {'image': 'bad.tif', 'error': 'cannot read bad.tif'})
+
+        status, metrics = self.request('/metrics')
+        self.assertEqual(status, 200)
+        self.assertEqual((metrics['requests'], metrics['scored'], metrics['failed']), (1, 2, 1))
+        self.assertEqual(sorted(metrics['latency_ms']), ['max', 'mean', 'p50', 'p95'])
+
+    def test_batch_matches_score_image(self):
+        threshold_info = get_threshold_info(FakeArgs(), INPUT_DIR)
+        service = ScoringService(INPUT_DIR, self.results, threshold_info, numWorkers=2)
+        self.addCleanup(service.executor.shutdown)
+        # The second image is a copy, so that its mask is written to another file
+        other = os.path.join(self.results, 'other_toar.tif')
+        shutil.copy(TOAR_FILE, other)
+        juldate = float(service.juldates[TOAR_DATE]) + 100
+        expected = [score_image(TOAR_FILE, service.juldates, service.coeffs, threshold_info, self.results,
+                                num_days=service.num_days)[1],
+                    score_image(other, service.juldates, service.coeffs, threshold_info, self.results,
+                                juldate=juldate, num_days=service.num_days)[1]]
+
+        with mock.patch.object(scoring_service, 'read_new_image', apply_tmask.read_new_image), \
+                mock.patch.object(scoring_service, 'mask_image', apply_tmask.mask_image):
+            results = service.score_batch([TOAR_FILE, {'image': other, 'juldate': juldate}])
+        for (result, cloud_byte) in zip(results, expected):
+            self.assertEqual(result['clouds'], float(np.mean(cloud_byte == 2)))
+            self.assertEqual(result['shadows'], float(np.mean(cloud_byte == 1)))
+            ds = gdal.Open(result['mask'], gdal.GA_ReadOnly)
+            self.assertTrue(np.array_equal(ds.GetRasterBand(1).ReadAsArray(), cloud_byte))
+            ds = None
+
+    def test_bad_requests(self):
+        self.assertEqual(self.request('/score', 'not json')[0], 400)
+        self.assertEqual(self.request('/score', json.dumps({'images': 'a.tif'}))[0], 400)
+        self.assertEqual(self.request('/score', json.dumps({'image': ['a.tif']}))[0], 400)
+        self.assertEqual(self.request('/masks', json.dumps({'images': []}))[0], 404)
+        self.assertEqual(self.request('/masks')[0], 404)
+        self.assertEqual(self.request('/health'), (200, {'status': 'ok'}))
+
+    def test_metrics_report(self):
+        metrics = Metrics()
+        self.assertEqual(metrics.report(), {'requests': 0, 'scored': 0, 'failed': 0})
+        for seconds in (0.001, 0.002, 0.003):
+            metrics.add(seconds)
+        metrics.add(1.0, failed=True)
+        report = metrics.report()
+        self.assertEqual((report['scored'], report['failed']), (3, 1))
+        self.assertAlmostEqual(report['latency_ms']['mean'], 2.0)
+        self.assertAlmostEqual(report['latency_ms']['p50'], 2.0)
+        self.assertAlmostEqual(report['latency_ms']['max'], 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from tmask import robustregression, tile_fit
+from tmask.tests.synthetic import make_stack
+
+
+class Test(unittest.TestCase):
+
+    def test_workers_match_serial_fit(self):
+        x, stack = make_stack(60, 4, 17, 11)
+        c = np.zeros((4, 5, 17, 11), dtype=np.float32)
+        rmse = np.zeros((4, 17, 11), dtype=np.float32)
+        tile_fit.fit_stack(x, stack, c, rmse, backend=robustregression.BACKEND_NUMPY,
+                           blockBytes=stack[:, :, :3].nbytes)
+
+        workDir = tempfile.mkdtemp()
+        try:
+            stackFile = os.path.join(workDir, 'stack.npy')
+            np.save(stackFile, stack)
+            (workerC, workerRmse, numAllocsAvoided) = tile_fit.fit_stack_workers(
+                x, stackFile, workDir, 5, 2, backend=robustregression.BACKEND_NUMPY)
+        finally:
+            shutil.rmtree(workDir)
+
+        self.assertTrue(np.array_equal(c, workerC))
+        self.assertTrue(np.array_equal(rmse, workerRmse))
+        self.assertTrue(np.any(c != 0))
@@ -0,0 +1,106 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from tmask import datacube, robustregression, tile_fit, tmask_model
+from tmask.tests.synthetic import make_stack, write_tif
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.x, self.stack = make_stack(40, 4, 9, 7)
+        self.files = []
+        for i, image in enumerate(self.stack):
+            fn = os.path.join(self.folder, 'image%02d_toar.tif' % i)
+            write_tif(fn, image)
+            self.files.append(fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_streaming_matches_in_memory_fit(self):
+        c = np.zeros((4, 5, 9, 7), dtype=np.float32)
+        rmse = np.zeros((4, 9, 7), dtype=np.float32)
+        tile_fit.fit_stack(self.x, self.stack, c, rmse, backend=robustregression.BACKEND_NUMPY)
+
+        # With no memory budget, the stack is streamed a row at a time
+        args = argparse.Namespace(use_udm=False, threads=1, backend=robustregression.BACKEND_NUMPY,
+                                  io_threads=2, memory_mb=0, output_format='npy')
+        basepath = os.path.join(self.folder, 'coeffs')
+        juldate = np.arange(40.0)
+        tmask_model.tmask_streaming(args, self.files, juldate, self.x, self.stack.shape, basepath)
+
+        self.assertTrue(np.array_equal(np.load(os.path.join(basepath, 'tmask_coeffs_complete.npy')), c))
+        self.assertTrue(np.array_equal(np.load(os.path.join(basepath, 'tmask_rmse.npy')), rmse))
+        self.assertTrue(np.array_equal(np.load(os.path.join(basepath, 'tmask_analytic_complete.npy')), self.stack))
+        self.assertTrue(np.any(c != 0))
+
+    def test_concurrent_reads_fill_their_own_slots(self):
+        # A RapidEye image has the red edge as band 4, which is skipped, and each image
+        # has a UDM with some clouds
+        rng = np.random.RandomState(1)
+        rapideye = np.concatenate([self.stack[3, :3], rng.randint(1, 100, (1, 9, 7)), self.stack[3, 3:]])
+        self.files[3] = os.path.join(self.folder, 'RapidEye_image03_toar.tif')
+        write_tif(self.files[3], rapideye.astype(np.uint16))
+        clouds = rng.uniform(size=(40, 9, 7)) < 0.2
+        for fn, cloud in zip(self.files, clouds):
+            write_tif(datacube.udm_filename(fn), (cloud * 2)[None].astype(np.uint16))
+
+        # The reads are delayed at random, so they finish out of order
+        def slow(read):
+            def delayed(*args, **kwargs):
+                time.sleep(rng.uniform(0, 0.01))
+                return read(*args, **kwargs)
+            return delayed
+
+        stack = np.zeros(self.stack.shape, dtype=np.uint16)
+        cloudMask = tmask_model.cloud_mask_array(40, 9, 7)
+        with mock.patch.object(tmask_model, 'read_image', slow(datacube.read_image)), \
+                mock.patch.object(tmask_model, 'read_cloud_mask', slow(datacube.read_cloud_mask)):
+            tmask_model.load_images(self.files, stack, cloudMask=cloudMask, numThreads=8)
+
+        self.assertTrue(np.array_equal(stack, self.stack))
+        self.assertTrue(np.array_equal(cloudMask, robustregression.pack_mask(clouds)))
+
+    def test_refresh_with_scenes_on_one_date(self):
+        args = argparse.Namespace(use_udm=False, threads=1, backend=robustregression.BACKEND_NUMPY, workers=1,
+                                  memory_mb=None, io_threads=2, datacube=False, output_format='npy',
+                                  incremental=False, refresh_max_iter=10, refresh_rmse_factor=1.0,
+                                  coarse_factor=None, coarse_tolerance=100.0)
+        basepath = os.path.join(self.folder, 'coeffs')
+
+        # The last three images, two of them new, are all taken on one day
+        juldates = 2457000.0 + 10 * np.arange(40)
+        juldates[30:32] = juldates[29]
+
+        def write_lists(numImages):
+            analyticList = os.path.join(self.folder, 'analytic_%d.txt' % numImages)
+            dateList = os.path.join(self.folder, 'dates_%d.txt' % numImages)
+            with open(analyticList, 'w') as f:
+                f.write(''.join(fn + '\n' for fn in self.files[:numImages]))
+            with open(dateList, 'w') as f:
+                f.write(''.join('%f\n' % juldate for juldate in juldates[:numImages]))
+            return analyticList, dateList
+
+        tmask_model.tmask(args, *write_lists(30), basepath=basepath)
+        args.incremental = True
+        with mock.patch.object(tile_fit, 'fit_stack', side_effect=AssertionError('the model was fitted again')):
+            tmask_model.tmask(args, *write_lists(32), basepath=basepath)
+
+        self.assertEqual([path for (path, state) in tmask_model.load_image_list(basepath)], self.files[:32])
+        self.assertTrue(np.array_equal(np.load(os.path.join(basepath, 'tmask_analytic_complete.npy')),
+                                       self.stack[:32]))
+        self.assertTrue(np.array_equal(np.load(os.path.join(basepath, 'tmask_date.npy')), juldates[:32]))
+        self.assertFalse([fn for fn in os.listdir(basepath) if fn.startswith('tmask_refresh_')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+#
+# Copyright 2018, Planet Labs, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Fit the TMASK regressions for a whole image stack, a tile of rows at a time.
+
+Each tile is transposed to pixel-major order before it is fitted (see
+robustregression.LAYOUT_PIXEL_MAJOR). The tiles can either be fitted one after the
+other in this process, with fit_stack(), or shared out to a pool of worker processes,
+with fit_stack_workers(). The workers read the stack from a memory mapped .npy file
+and write the results into memory mapped output files, so there is only ever one
+copy of the stack, in the page cache, whatever the number of workers.
+"""
+
+import os
+import multiprocessing
+
+import numpy
+
+from tmask import robustregression
+
+# Size of the pixel-major copy of the stack which is fitted at a time
+FIT_BLOCK_BYTES = 64 * 1024 * 1024
+
+# Number of tiles given to each worker process, so the work stays balanced when some
+# tiles take longer than others
+TILES_PER_WORKER = 4
+
+COEFFS_FILE = 'tile_coeffs.npy'
+RMSE_FILE = 'tile_rmse.npy'
+MASK_FILE = 'tile_mask.npy'
+
+
+def tile_rows(stackShape, itemsize, numThreads=1, numWorkers=1, blockBytes=FIT_BLOCK_BYTES):
+    """
+    Return the number of rows in each tile, for a stack of shape
+    (numImages, numBands, numRows, numCols). A tile is at most blockBytes, unless that
+    is less than one row per thread, and there are at least TILES_PER_WORKER tiles for
+    each worker.
+    """
+    (numImages, numBands, numRows, numCols) = stackShape
+    rowBytes = numCols * numImages * numBands * itemsize
+    rows = max(numThreads, blockBytes // rowBytes)
+    if numWorkers > 1:
+        rows = min(rows, max(1, -(-numRows // (numWorkers * TILES_PER_WORKER))))
+    return min(numRows, rows)
+
+
+def fit_rows(x, stack, c, rmse, rowStart, rowEnd, blockStack, numThreads=1,
+             backend=robustregression.BACKEND_GSL, excludeMask=None):
+    """
+    Fit rows rowStart to rowEnd of the image-major uint16 stack, writing the coefficients
+    and rmse into the same rows of c and rmse. blockStack is a pixel-major buffer with
+    at least (rowEnd - rowStart) rows, which is reused from one tile to the next.
+    excludeMask is None, or the packed mask of observations to leave out for the whole
+    stack (see robustregression.pack_mask()).
+
+    Returns the number of GSL allocations avoided.
+    """
+    block = robustregression.pixel_major_stack(stack, rowStart, rowEnd, out=blockStack[:rowEnd - rowStart])
+    if excludeMask is not None:
+        excludeMask = excludeMask[:, rowStart:rowEnd]
+    regObj = robustregression.gsl_multifit_robust_multiband(x, block,
+                                                            method=robustregression.GSL_METHOD_BISQUARE,
+                                                            nullVal=0, numThreads=numThreads,
+                                                            backend=backend,
+                                                            regStats=robustregression.REGSTATS_MINIMAL,
+                                                            layout=robustregression.LAYOUT_PIXEL_MAJOR,
+                                                            excludeMask=excludeMask)
+    c[:, :, rowStart:rowEnd] = regObj.coeffs
+    rmse[:, rowStart:rowEnd] = regObj.rmse
+    return regObj.numAllocsAvoided
+
+
+def make_block_stack(stack, rows):
+    """
+    Return a pixel-major buffer for tiles of up to the given number of rows of the stack
+    """
+    (numImages, numBands, numRows, numCols) = stack.shape
+    return numpy.empty((rows, numCols, numImages, numBands), dtype=stack.dtype)
+
+
+def fit_stack(x, stack, c, rmse, numThreads=1, backend=robustregression.BACKEND_GSL,
+              blockBytes=FIT_BLOCK_BYTES, excludeMask=None):
+    """
+    Fit the whole stack in this process, a tile at a time. The float32 c and rmse arrays,
+    of shape (numBands, numParams, numRows, numCols) and (numBands, numRows, numCols),
+    are filled in place. excludeMask is as for fit_rows().
+
+    Returns the number of GSL allocations avoided.
+    """
+    numRows = stack.shape[2]
+    rows = tile_rows(stack.shape, stack.itemsize, numThreads=numThreads, blockBytes=blockBytes)
+    blockStack = make_block_stack(stack, rows)
+    numAllocsAvoided = 0
+    for rowStart in range(0, numRows, rows):
+        numAllocsAvoided += fit_rows(x, stack, c, rmse, rowStart, min(rowStart + rows, numRows), blockStack,
+                                     numThreads=numThreads, backend=backend, excludeMask=excludeMask)
+    return numAllocsAvoided
+
+
+# The state of each worker process, set up by init_worker()
+workerState = {}
+
+
+def init_worker(x, stackFile, workDir, numThreads, backend, rows, useMask):
+    """
+    Open the memory mapped stack and outputs in a worker process
+    """
+    stack = numpy.load(stackFile, mmap_mode='r')
+    workerState['x'] = x
+    workerState['stack'] = stack
+    workerState['c'] = numpy.load(os.path.join(workDir, COEFFS_FILE), mmap_mode='r+')
+    workerState['rmse'] = numpy.load(os.path.join(workDir, RMSE_FILE), mmap_mode='r+')
+    workerState['numThreads'] = numThreads
+    workerState['backend'] = backend
+    workerState['blockStack'] = make_block_stack(stack, rows)
+    workerState['excludeMask'] = None
+    if useMask:
+        workerState['excludeMask'] = numpy.load(os.path.join(workDir, MASK_FILE), mmap_mode='r')
+
+
+def fit_tile(rowRange):
+    """
+    Fit one tile of rows in a worker process. Returns the number of GSL allocations
+    avoided.
+    """
+    (rowStart, rowEnd) = rowRange
+    return fit_rows(workerState['x'], workerState['stack'], workerState['c'], workerState['rmse'],
+                    rowStart, rowEnd, workerState['blockStack'], numThreads=workerState['numThreads'],
+                    backend=workerState['backend'], excludeMask=workerState['excludeMask'])
+
+
+def fit_stack_workers(x, stackFile, workDir, numParams, numWorkers, numThreads=1,
+                      backend=robustregression.BACKEND_GSL, blockBytes=FIT_BLOCK_BYTES, excludeMask=None):
+    """
+    Fit the stack held in the .npy file stackFile with a pool of numWorkers processes,
+    each of which fits whole tiles of rows. The outputs are memory mapped .npy files in
+    workDir, which must already exist. excludeMask is as for fit_rows(), and is shared
+    with the workers through a file in workDir.
+
+    Returns a tuple (c, rmse, numAllocsAvoided), where c and rmse are float32 arrays read
+    back from the output files.
+    """
+    stack = numpy.load(stackFile, mmap_mode='r')
+    (numImages, numBands, numRows, numCols) = stack.shape
+    rows = tile_rows(stack.shape, stack.itemsize, numThreads=numThreads, numWorkers=numWorkers,
+                     blockBytes=blockBytes)
+    stack = None
+
+    # Create the output files. Pixels which are not fitted stay zero.
+    c = numpy.lib.format.open_memmap(os.path.join(workDir, COEFFS_FILE), mode='w+', dtype=numpy.float32,
+                                     shape=(numBands, numParams, numRows, numCols))
+    rmse = numpy.lib.format.open_memmap(os.path.join(workDir, RMSE_FILE), mode='w+', dtype=numpy.float32,
+                                        shape=(numBands, numRows, numCols))
+    c.flush()
+    rmse.flush()
+    if excludeMask is not None:
+        numpy.save(os.path.join(workDir, MASK_FILE), excludeMask)
+
+    tiles = [(rowStart, min(rowStart + rows, numRows)) for rowStart in range(0, numRows, rows)]
+    pool = multiprocessing.Pool(numWorkers, initializer=init_worker,
+                                initargs=(x, stackFile, workDir, numThreads, backend, rows,
+                                          excludeMask is not None))
+    try:
+        numAllocsAvoided = sum(pool.imap_unordered(fit_tile, tiles))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return numpy.array(c), numpy.array(rmse), numAllocsAvoided
@@ -19,17 +19,30 @@
 import numpy
 import os
 import time
+import shutil
+import tempfile
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 
 from tmask import robustregression
+from tmask import tile_fit
+from tmask import datacube
+from tmask import coeff_store
+from tmask import refresh
+from tmask import coarse_fit
+from tmask.datacube import read_image, read_cloud_mask
 from tmask.create_plot import draw_plots
 from tools.folders_handle import (create_or_clean_folder,
                                   ANALYTIC_LIST_FILE,
                                   DATE_LIST_FILE,
                                   COEFFICIENTS_FOLDER,
+                                  DATACUBE_FOLDER,
                                   PLOTS_FOLDER)
 
+# The paths, mtimes and sizes of the images the model was fitted to
+IMAGES_FILE = 'tmask_images.txt'
+
 
 def array_shape(fname, numBands=4):
     print (fname)
@@ -48,59 +61,72 @@ def array_shape(fname, numBands=4):
     return (i + 1, numBands, ysize, xsize)
 
 
-def tmask(args, analyticlist, datelist, basepath, nodataval=0, coeffs_file=""):
-
-    # Open all input files and create a data stack
-    bands = 4
-    numDates, numBands, numRows, numCols = array_shape(analyticlist, numBands=bands)
-    analyticStack = numpy.empty((numDates, numBands, numRows, numCols), dtype=numpy.uint16, order='C')
+def cloud_mask_array(numDates, numRows, numCols):
+    """
+    Return an array for the cloud masks of a stack, packed 8 columns to a byte as the
+    fit's excludeMask (see robustregression.pack_mask()).
+    """
+    return numpy.zeros((numDates, numRows, (numCols + 7) // 8), dtype=numpy.uint8)
 
-    # We need to keep a copy of the unaltered analytic stack in case we use UDMs
-    if args.use_udm:
-        analyticStackOrig = numpy.empty((numDates, numBands, numRows, numCols), dtype=numpy.uint16, order='C')
 
-    with open(analyticlist) as an_file:
-        for i, fn in enumerate(an_file):
+def load_image(i, fn, stack, bands, window, cloudMask):
+    """
+    Read image i of the stack, and its cloud mask, as described for load_images().
+    Returns the number of bytes read.
+    """
+    print(i, fn)
+    numBytes = read_image(fn, stack[i], bands=bands, window=window)
 
-            print(i, fn)
-            img = gdal.Open(fn.rstrip(), gdal.GA_ReadOnly)
+    if cloudMask is not None:
+        print ('Excluding cloud pixels from UDM')
+        cloud_mask = read_cloud_mask(fn, window=window)
+        numBytes += cloud_mask.size
+        cloudMask[i] = robustregression.pack_mask(cloud_mask)
 
-            for band in range(1, bands+1):
-                # Read raster as arrays
-                if 'RapidEye' in fn and band >= 4:
-                    print ('RE case')
-                    banddataraster = img.GetRasterBand(band + 1)
-                else:
-                    banddataraster = img.GetRasterBand(band)
+    return numBytes
 
-                dataraster = banddataraster.ReadAsArray()
-                analyticStack[i, band - 1] = dataraster
 
-            img = None
+def load_images(analyticFiles, stack, bands=4, window=None, cloudMask=None, numThreads=1):
+    """
+    Read every image in analyticFiles into its slot stack[i] of the stack, using a pool
+    of numThreads threads. GDAL releases the GIL while it reads, so the reads overlap,
+    which helps a lot when the images are on network storage. Each thread opens its own
+    datasets, as GDAL datasets cannot be shared between threads.
 
-            if args.use_udm:
-                print ('Excluding cloud pixels from UDM')
+    window is as for read_image(). If cloudMask is given (see cloud_mask_array()), the
+    cloud bit of each image's UDM is packed into cloudMask[i]. The stack itself is left
+    as it was read, and the clouds are excluded by the fit.
 
-                # construct UDM file name
-                udm_fn = fn.replace('_resampled_toar', '_udm_resampled')
-                udm_fn = udm_fn.replace('_toar', '_udm')
+    Prints the read throughput, and returns the number of bytes read.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=numThreads) as executor:
+        futures = [executor.submit(load_image, i, fn, stack, bands, window, cloudMask)
+                   for i, fn in enumerate(analyticFiles)]
+        numBytes = sum(future.result() for future in futures)
 
-                udm_fn = udm_fn.replace('toar_images', 'input')
+    elapsed = max(time.time() - start, 1e-6)
+    print('Read %d images, %.1f MB in %.2f seconds (%.1f MB/s)' %
+          (len(analyticFiles), numBytes / 1e6, elapsed, numBytes / 1e6 / elapsed))
+    return numBytes
 
-                # Open UDM and extract cloud bit
-                udm = gdal.Open(udm_fn.rstrip(), gdal.GA_ReadOnly)
-                udm_band = udm.GetRasterBand(1)
-                udmraster = udm_band.ReadAsArray()
 
-                # Extract cloud bit in a boolean array
-                cloud_mask = (numpy.bitwise_and(udmraster, 2)).astype(numpy.bool)
+def series_days(juldate):
+    """
+    Return the length in whole days of the time series, which sets the inter-annual
+    period of the design matrix
+    """
+    return int(juldate[-1]) - int(juldate[0])
 
-                # mask cloud pixels in analytic image
-                analyticStackOrig[i, :] = analyticStack[i, :]
-                analyticStack[i, :] = analyticStack[i, :] * numpy.invert(cloud_mask)
 
-                udm = None
+def design_matrix(datelist, numDays=None):
+    """
+    Read the julian dates, and set up the independant variables for the robust
+    regression, which are functions of date. Returns a tuple (juldate, x).
 
+    numDays is the inter-annual period, by default the series_days() of the dates. A
+    refreshed model keeps the period it was first fitted with.
+    """
     juldatelist = []
     with open(datelist) as da_file:
         for da in da_file:
@@ -108,16 +134,10 @@ def tmask(args, analyticlist, datelist, basepath, nodataval=0, coeffs_file=""):
 
     juldate = numpy.array(juldatelist)
 
-    juldate_start = int(juldate[0])
-    juldate_end = int(juldate[-1])
-
-    num_days = juldate_end - juldate_start
+    num_days = series_days(juldate) if numDays is None else numDays
 
     daysPerYear = 365
 
-    # Fit the model for each band.
-
-    # Set up the independant variables for the robust regression. These are functions of date.
     constant = numpy.ones(juldate.shape, order='C')
     cosT = numpy.cos(2.0 * numpy.pi * juldate / daysPerYear)
     sinT = numpy.sin(2.0 * numpy.pi * juldate / daysPerYear)
@@ -125,75 +145,549 @@ def tmask(args, analyticlist, datelist, basepath, nodataval=0, coeffs_file=""):
     sinNT = numpy.sin(2.0 * numpy.pi * juldate / num_days)
 
     x = numpy.array([constant, cosT, sinT, cosNT, sinNT], order='C')
-    numParams = len(x)
-
-    # Now fit for each band. The c array is the coeefficients of the fits.
-    c = numpy.zeros((numBands, numParams, numRows, numCols), dtype=numpy.float32, order='C')
-    rmse = numpy.zeros((numBands, numRows, numCols), dtype=numpy.float32, order='C')
-    for bandNdx in range(numBands):
-        print('Fitting band %d' % bandNdx)
-        y = numpy.ascontiguousarray(
-            analyticStack[:, bandNdx, :, :],
-            dtype=numpy.double)
-        regObj = robustregression.gsl_multifit_robust(x, y, method=robustregression.GSL_METHOD_BISQUARE,
-                                                      nullVal=0)
-        c[bandNdx, :, :, :] = regObj.coeffs
-        rmse[bandNdx, :, :] = regObj.rmse
-
-    # Write coefficents to disk for one pixel (for creating plots) as well as
-    # the whole array (for further analysis)
-    writeToFile = True
-    if writeToFile:
-        if not os.path.exists(basepath):
-            os.mkdir(basepath)
-
-        outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_ul")
-        numpy.save(outCoeffile, c[:, :, 0, 0])
-        outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_ll")
-        numpy.save(outCoeffile, c[:, :, 0, -1])
-        outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_lr")
-        numpy.save(outCoeffile, c[:, :, -1, 0])
-        outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_ur")
-        numpy.save(outCoeffile, c[:, :, -1, -1])
+    return juldate, x
+
+
+def stream_block_rows(stackShape, memoryBytes):
+    """
+    Return the number of rows to read at a time when streaming a stack of shape
+    (numDates, numBands, numRows, numCols) within about memoryBytes of memory. Each block
+    is held twice, as read and transposed to pixel-major for the fit.
+    """
+    (numDates, numBands, numRows, numCols) = stackShape
+    rowBytes = numDates * numBands * numCols * numpy.dtype(numpy.uint16).itemsize
+    return max(1, min(numRows, memoryBytes // (2 * rowBytes)))
+
+
+def image_georeference(fn):
+    """
+    Return the (projection, geotransform) of the image fn
+    """
+    img = gdal.Open(fn.rstrip(), gdal.GA_ReadOnly)
+    georef = (img.GetProjection(), img.GetGeoTransform())
+    img = None
+    return georef
+
+
+def image_states(analyticFiles):
+    """
+    Return the (path, state) of each image, where state is the datacube.file_state()
+    of the file, which changes whenever it is rewritten
+    """
+    return [(fn.rstrip(), datacube.file_state(fn.rstrip())) for fn in analyticFiles]
+
+
+def save_image_list(basepath, images):
+    """
+    Save the (path, state) of the images the model was fitted to, one to a line, so a
+    refresh can tell which images are new or have changed
+    """
+    with open(os.path.join(basepath, IMAGES_FILE), 'w') as f:
+        for path, (mtime, size) in images:
+            f.write('%r %d %s\n' % (mtime, size, path))
+
+
+def load_image_list(basepath):
+    """
+    Return the (path, state) of the images the stored model was fitted to, or None if
+    they were not saved
+    """
+    fn = os.path.join(basepath, IMAGES_FILE)
+    if not os.path.exists(fn):
+        return None
+    images = []
+    with open(fn) as f:
+        for line in f:
+            mtime, size, path = line.rstrip('\n').split(' ', 2)
+            images.append((path, [float(mtime), int(size)]))
+    return images
+
+
+def save_outputs(basepath, c, rmse, juldate, analyticStack, saveComplete=True, saveAnalytic=True,
+                 outputFormat=coeff_store.FORMAT_NPY, georef=None, numDays=None, images=None):
+    """
+    Write coefficents to disk for one pixel (for creating plots) as well as the whole
+    array (for further analysis). If saveComplete is False, the whole coefficient and
+    rmse arrays are already on disk, and if saveAnalytic is False, the whole analytic
+    stack is not needed, either because it is already on disk or because it is in the
+    datacube. Only the plot pixels and dates are written for these.
+
+    With outputFormat coeff_store.FORMAT_GEOTIFF the whole arrays are written to the
+    coefficient store instead of .npy files, georeferenced with the
+    (projection, geotransform) georef.
+
+    numDays is the inter-annual period of the design matrix, by default the
+    series_days() of juldate. It is saved with the dates, so the model can be evaluated
+    with the basis it was fitted with. images, the image_states() of the images, are
+    saved with them if given.
+    """
+    if not os.path.exists(basepath):
+        os.mkdir(basepath)
+
+    outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_ul")
+    numpy.save(outCoeffile, c[:, :, 0, 0])
+    outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_ll")
+    numpy.save(outCoeffile, c[:, :, 0, -1])
+    outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_lr")
+    numpy.save(outCoeffile, c[:, :, -1, 0])
+    outCoeffile = os.path.join(basepath, "tmask_coeffs_plot_ur")
+    numpy.save(outCoeffile, c[:, :, -1, -1])
+    if saveComplete and outputFormat == coeff_store.FORMAT_GEOTIFF:
+        coeff_store.write_array(os.path.join(basepath, coeff_store.COEFFS_STORE_FILE), c, *georef)
+    elif saveComplete:
         outCoeffile = os.path.join(basepath, "tmask_coeffs_complete")
         numpy.save(outCoeffile, c[:, :, :, :])
 
-        outDatefile = os.path.join(basepath, "tmask_date")
-        numpy.save(outDatefile, juldate)
+    outDatefile = os.path.join(basepath, "tmask_date")
+    numpy.save(outDatefile, juldate)
+    outDaysfile = os.path.join(basepath, "tmask_num_days")
+    numpy.save(outDaysfile, series_days(juldate) if numDays is None else numDays)
+    if images is not None:
+        save_image_list(basepath, images)
 
+    if saveComplete and outputFormat == coeff_store.FORMAT_GEOTIFF:
+        coeff_store.write_array(os.path.join(basepath, coeff_store.RMSE_STORE_FILE), rmse, *georef)
+    elif saveComplete:
         outRMSEfile = os.path.join(basepath, "tmask_rmse")
         numpy.save(outRMSEfile, rmse)
 
-        if args.use_udm:
-            analyticStack = analyticStackOrig
-
-        outAnfile = os.path.join(basepath, "tmask_analytic_plot_ul")
-        numpy.save(outAnfile, analyticStack[:,:,0,0])
-        outAnfile = os.path.join(basepath, "tmask_analytic_plot_ll")
-        numpy.save(outAnfile, analyticStack[:, :, 0, -1])
-        outAnfile = os.path.join(basepath, "tmask_analytic_plot_lr")
-        numpy.save(outAnfile, analyticStack[:, :, -1, 0])
-        outAnfile = os.path.join(basepath, "tmask_analytic_plot_ur")
-        numpy.save(outAnfile, analyticStack[:, :, -1, -1])
+    outAnfile = os.path.join(basepath, "tmask_analytic_plot_ul")
+    numpy.save(outAnfile, analyticStack[:,:,0,0])
+    outAnfile = os.path.join(basepath, "tmask_analytic_plot_ll")
+    numpy.save(outAnfile, analyticStack[:, :, 0, -1])
+    outAnfile = os.path.join(basepath, "tmask_analytic_plot_lr")
+    numpy.save(outAnfile, analyticStack[:, :, -1, 0])
+    outAnfile = os.path.join(basepath, "tmask_analytic_plot_ur")
+    numpy.save(outAnfile, analyticStack[:, :, -1, -1])
+    if saveAnalytic and outputFormat == coeff_store.FORMAT_GEOTIFF:
+        coeff_store.write_array(os.path.join(basepath, coeff_store.ANALYTIC_STORE_FILE), analyticStack, *georef)
+    elif saveAnalytic:
         outAnfile = os.path.join(basepath, "tmask_analytic_complete")
         numpy.save(outAnfile, analyticStack[:, :, :, :])
 
 
+def tmask_streaming(args, analyticFiles, juldate, x, stackShape, basepath, cube=None):
+    """
+    Fit the model without ever holding the whole stack in memory. Blocks of rows are read
+    from every image with windowed reads, and fitted, and the coefficients, rmse and
+    analytic values of the block are written into memory mapped .npy files in basepath.
+    These are the same files that tmask() writes. With the GeoTIFF output format, the
+    .npy files are temporary, and are copied to the coefficient store at the end.
+
+    If cube is given, the blocks are read from the datacube instead of the images, and
+    the analytic values are not written, as the mask stage can read them from the cube.
+    """
+    (numDates, numBands, numRows, numCols) = stackShape
+    numParams = len(x)
+    if not os.path.exists(basepath):
+        os.mkdir(basepath)
+    outDir = basepath
+    if args.output_format == coeff_store.FORMAT_GEOTIFF:
+        outDir = tempfile.mkdtemp(prefix='tmask_stream_', dir=basepath)
+
+    # The temporary .npy files are as big as the outputs, so they are removed even if
+    # the fit fails
+    try:
+        c = numpy.lib.format.open_memmap(os.path.join(outDir, "tmask_coeffs_complete.npy"), mode='w+',
+                                         dtype=numpy.float32, shape=(numBands, numParams, numRows, numCols))
+        rmse = numpy.lib.format.open_memmap(os.path.join(outDir, "tmask_rmse.npy"), mode='w+',
+                                            dtype=numpy.float32, shape=(numBands, numRows, numCols))
+        if cube is None:
+            analyticStack = numpy.lib.format.open_memmap(os.path.join(outDir, "tmask_analytic_complete.npy"),
+                                                         mode='w+', dtype=numpy.uint16, shape=stackShape)
+        else:
+            analyticStack = cube
+
+        blockRows = stream_block_rows(stackShape, args.memory_mb * 1024 * 1024)
+        block = numpy.empty((numDates, numBands, blockRows, numCols), dtype=numpy.uint16)
+        blockMask = None
+        if args.use_udm:
+            blockMask = cloud_mask_array(numDates, blockRows, numCols)
+        print('Streaming %d rows at a time' % blockRows)
+
+        numAllocsAvoided = 0
+        for rowStart in range(0, numRows, blockRows):
+            rowEnd = min(rowStart + blockRows, numRows)
+            print('Rows %d to %d' % (rowStart, rowEnd))
+            window = (0, rowStart, numCols, rowEnd - rowStart)
+            blockStack = block[:, :, :rowEnd - rowStart]
+            excludeMask = None
+            if blockMask is not None:
+                excludeMask = blockMask[:, :rowEnd - rowStart]
+
+            if cube is None:
+                load_images(analyticFiles, blockStack, bands=numBands, window=window, cloudMask=excludeMask,
+                            numThreads=args.io_threads)
+                analyticStack[:, :, rowStart:rowEnd] = blockStack
+            else:
+                cube.read_block(blockStack, rowStart, rowEnd, cloudMask=excludeMask)
+
+            numAllocsAvoided += tile_fit.fit_stack(x, blockStack, c[:, :, rowStart:rowEnd], rmse[:, rowStart:rowEnd],
+                                                   numThreads=args.threads, backend=args.backend,
+                                                   blockBytes=blockStack.nbytes, excludeMask=excludeMask)
+        print('GSL allocations avoided by workspace reuse: %d' % numAllocsAvoided)
+
+        c.flush()
+        rmse.flush()
+        if cube is None:
+            analyticStack.flush()
+        if outDir == basepath:
+            save_outputs(basepath, c, rmse, juldate, analyticStack, saveComplete=False, saveAnalytic=False,
+                         images=image_states(analyticFiles))
+        else:
+            save_outputs(basepath, c, rmse, juldate, analyticStack, saveAnalytic=(cube is None),
+                         outputFormat=args.output_format, georef=image_georeference(analyticFiles[0]),
+                         images=image_states(analyticFiles))
+    finally:
+        if outDir != basepath:
+            c = rmse = analyticStack = None
+            shutil.rmtree(outDir)
+
+
+def load_cloud_masks(analyticFiles, indices, cloudMask, numThreads=1):
+    """
+    Read the cloud bit of the UDM of each image analyticFiles[i], for i in indices, into
+    cloudMask[i] (see cloud_mask_array()), using a pool of numThreads threads
+    """
+    with ThreadPoolExecutor(max_workers=numThreads) as executor:
+        masks = executor.map(lambda i: read_cloud_mask(analyticFiles[i]), indices)
+        for i, mask in zip(indices, masks):
+            cloudMask[i] = robustregression.pack_mask(mask)
+
+
+def tmask_refresh(args, analyticFiles, datelist, stackShape, basepath, cube=None):
+    """
+    Refresh the model stored in basepath with the images which were added to analyticFiles,
+    or rewritten, since it was fitted, instead of fitting it again (see the refresh
+    module). The images are matched to the stored model by path. The new images are
+    compared with the model, and the pixels they don't fit are fitted again a tile of
+    rows at a time. The coefficients and rmse are updated in place, in the format they
+    were written in, and the analytic stack, dates and image list are rewritten with the
+    new images.
+
+    If cube is given, the images are read from the datacube, as for tmask().
+
+    Raises refresh.RefreshError if there is no stored model, or it can't be refreshed
+    for these images.
+    """
+    (numDates, numBands, numRows, numCols) = stackShape
+    dateFile = os.path.join(basepath, "tmask_date.npy")
+    c = coeff_store.open_array(basepath, "tmask_coeffs_complete.npy", coeff_store.COEFFS_STORE_FILE, update=True)
+    rmse = coeff_store.open_array(basepath, "tmask_rmse.npy", coeff_store.RMSE_STORE_FILE, update=True)
+    prevImages = load_image_list(basepath)
+    if not os.path.exists(dateFile) or c is None or rmse is None:
+        raise refresh.RefreshError("There is no stored model in %s" % basepath)
+    if prevImages is None:
+        raise refresh.RefreshError("The images of the stored model are not listed in %s" % basepath)
+    if c.shape[2:] != (numRows, numCols):
+        raise refresh.RefreshError("The images are %dx%d, but the stored model is %dx%d" %
+                                   (numCols, numRows, c.shape[3], c.shape[2]))
+
+    # The model keeps the inter-annual period it was first fitted with
+    daysFile = os.path.join(basepath, "tmask_num_days.npy")
+    numDays = int(numpy.load(daysFile)) if os.path.exists(daysFile) else series_days(numpy.load(dateFile))
+    juldate, x = design_matrix(datelist, numDays=numDays)
+    images = image_states(analyticFiles)
+    (newDates, prevKept, kept) = refresh.new_images(prevImages, images)
+    if len(newDates) == 0 and numpy.array_equal(kept, numpy.arange(numDates)):
+        print('The stored model is up to date')
+        return
+
+    prevStack = None
+    if cube is None:
+        prevStack = coeff_store.open_array(basepath, "tmask_analytic_complete.npy", coeff_store.ANALYTIC_STORE_FILE)
+        if prevStack is None:
+            raise refresh.RefreshError("The analytic stack of the stored model is not in %s" % basepath)
+    print('Refreshing the model with %d new or changed images' % len(newDates))
+
+    # Only the new images are needed to find the pixels to fit again
+    newStack = numpy.empty((len(newDates), numBands, numRows, numCols), dtype=numpy.uint16)
+    newMask = None
+    if args.use_udm:
+        newMask = cloud_mask_array(len(newDates), numRows, numCols)
+    if cube is None:
+        load_images([analyticFiles[i] for i in newDates], newStack, bands=numBands, cloudMask=newMask,
+                    numThreads=args.io_threads)
+    else:
+        for j, i in enumerate(newDates):
+            newStack[j] = cube[i]
+            if newMask is not None:
+                newMask[j] = cube.cloud_mask(i)
+
+    # Without the datacube, the whole stack is put together from the stored one and the
+    # new images, in the order of the image list. It is a full copy of the stack, so it
+    # is removed even if the refresh fails.
+    workDir = None
+    cloudMask = None
+    try:
+        if cube is None:
+            workDir = tempfile.mkdtemp(prefix='tmask_refresh_', dir=basepath)
+            analyticStack = numpy.lib.format.open_memmap(os.path.join(workDir, 'stack.npy'), mode='w+',
+                                                         dtype=numpy.uint16, shape=stackShape)
+            for j, i in zip(prevKept, kept):
+                analyticStack[i] = prevStack[j]
+            analyticStack[newDates] = newStack
+            prevStack = None
+        else:
+            analyticStack = cube
+
+        rows = tile_fit.tile_rows(stackShape, numpy.dtype(numpy.uint16).itemsize)
+        block = numpy.empty((numDates, numBands, rows, numCols), dtype=numpy.uint16)
+        blockMask = None
+        if args.use_udm and cube is not None:
+            blockMask = cloud_mask_array(numDates, rows, numCols)
+
+        numRefit = 0
+        numWarmTotal = 0
+        sumIter = 0.0
+        for rowStart in range(0, numRows, rows):
+            rowEnd = min(rowStart + rows, numRows)
+            cTile = numpy.array(c[:, :, rowStart:rowEnd])
+            rmseTile = numpy.array(rmse[:, rowStart:rowEnd])
+            excluded = None
+            if newMask is not None:
+                excluded = numpy.unpackbits(newMask[:, rowStart:rowEnd], axis=2)[:, :, :numCols].astype(bool)
+            selected = refresh.exceeds_rmse(x[:, newDates], newStack[:, :, rowStart:rowEnd], cTile, rmseTile,
+                                            excluded=excluded, factor=args.refresh_rmse_factor)
+            if not selected.any():
+                continue
+
+            blockStack = block[:, :, :rowEnd - rowStart]
+            excludeMask = None
+            if cube is None:
+                blockStack[...] = analyticStack[:, :, rowStart:rowEnd]
+                if args.use_udm:
+                    # The UDMs of the old images are only read if some pixels are fitted again
+                    if cloudMask is None:
+                        cloudMask = cloud_mask_array(numDates, numRows, numCols)
+                        cloudMask[newDates] = newMask
+                        load_cloud_masks(analyticFiles, kept, cloudMask, numThreads=args.io_threads)
+                    excludeMask = cloudMask[:, rowStart:rowEnd]
+            else:
+                if blockMask is not None:
+                    excludeMask = blockMask[:, :rowEnd - rowStart]
+                cube.read_block(blockStack, rowStart, rowEnd, cloudMask=excludeMask)
+
+            (numWarm, meanIter) = refresh.refit_pixels(x, blockStack, cTile, rmseTile, selected,
+                                                       excludeMask=excludeMask, maxIter=args.refresh_max_iter)
+            numWarmTotal += numWarm
+            sumIter += numWarm * meanIter
+            c[:, :, rowStart:rowEnd] = cTile
+            rmse[:, rowStart:rowEnd] = rmseTile
+            numRefit += int(selected.sum())
+        print('Fitted %d of %d pixels again (%.1f%%)' % (numRefit, numRows * numCols,
+                                                          100.0 * numRefit / (numRows * numCols)))
+        if numWarmTotal > 0:
+            print('Mean iterations of the %d pixels started from the stored fit: %.2f' %
+                  (numWarmTotal, sumIter / numWarmTotal))
+
+        c.flush()
+        rmse.flush()
+        save_outputs(basepath, c, rmse, juldate, analyticStack, saveComplete=False, saveAnalytic=False,
+                     numDays=numDays)
+
+        if workDir is not None:
+            if isinstance(c, coeff_store.RasterArray):
+                coeff_store.write_array(os.path.join(basepath, coeff_store.ANALYTIC_STORE_FILE), analyticStack,
+                                        c.projection, c.geotransform)
+                analyticStack = None
+            else:
+                analyticStack.flush()
+                analyticStack = None
+                os.replace(os.path.join(workDir, 'stack.npy'),
+                           os.path.join(basepath, "tmask_analytic_complete.npy"))
+
+        # The images are listed last, so they only match the model once it is refreshed
+        save_image_list(basepath, images)
+    finally:
+        if workDir is not None:
+            analyticStack = None
+            shutil.rmtree(workDir)
+
+
+def tmask(args, analyticlist, datelist, basepath, nodataval=0, coeffs_file=""):
+
+    # Open all input files and create a data stack
+    bands = 4
+    numDates, numBands, numRows, numCols = array_shape(analyticlist, numBands=bands)
+    with open(analyticlist) as an_file:
+        analyticFiles = [fn for fn in an_file]
+
+    # Fit the model for each band.
+    juldate, x = design_matrix(datelist)
+    numParams = len(x)
+
+    # The datacube only reads the images which are new or have changed since the last run
+    cube = None
+    if args.datacube:
+        cube = datacube.Datacube(DATACUBE_FOLDER, analyticFiles, bands=bands)
+        cube.update(useUdm=args.use_udm, numThreads=args.io_threads)
+
+    # Only the pixels the new images don't fit are fitted again, if the stored model
+    # can be refreshed
+    if args.incremental:
+        try:
+            tmask_refresh(args, analyticFiles, datelist, (numDates, numBands, numRows, numCols), basepath,
+                          cube=cube)
+            return
+        except refresh.RefreshError as e:
+            print('Fitting the whole model: %s' % e)
+        create_or_clean_folder(basepath)
+
+    if args.memory_mb is not None:
+        tmask_streaming(args, analyticFiles, juldate, x, (numDates, numBands, numRows, numCols), basepath,
+                        cube=cube)
+        return
+
+    # With worker processes, the stack is held in a memory mapped file which they all share.
+    # It is a full copy of the stack, so it is removed even if the fit fails.
+    workDir = None
+    try:
+        if args.workers > 1:
+            if not os.path.exists(basepath):
+                os.mkdir(basepath)
+            workDir = tempfile.mkdtemp(prefix='tmask_tiles_', dir=basepath)
+            stackFile = os.path.join(workDir, 'stack.npy')
+            analyticStack = numpy.lib.format.open_memmap(stackFile, mode='w+', dtype=numpy.uint16,
+                                                         shape=(numDates, numBands, numRows, numCols))
+        else:
+            analyticStack = numpy.empty((numDates, numBands, numRows, numCols), dtype=numpy.uint16, order='C')
+
+        # The clouds in the UDMs are passed to the fit as a bit mask of the observations to
+        # leave out, so the analytic stack is kept as it was read for the mask stage
+        cloudMask = None
+        if args.use_udm:
+            cloudMask = cloud_mask_array(numDates, numRows, numCols)
+
+        if cube is None:
+            load_images(analyticFiles, analyticStack, bands=bands, cloudMask=cloudMask, numThreads=args.io_threads)
+        else:
+            cube.read_block(analyticStack, cloudMask=cloudMask)
+
+        # Now fit all bands in one pass. The c array is the coeefficients of the fits.
+        # The uint16 stack is passed as it is, and converted pixel by pixel in the fit.
+        # Only the coeffs and rmse are calculated, and they are copied into float32 arrays.
+        #
+        # The stack is fitted in tiles of rows, each of which is transposed to pixel-major
+        # order, so the time series of each pixel is contiguous while it is being fitted.
+        print('Fitting %d bands' % numBands)
+        if workDir is not None:
+            print('Fitting tiles with %d worker processes' % args.workers)
+            analyticStack.flush()
+            (c, rmse, numAllocsAvoided) = tile_fit.fit_stack_workers(x, stackFile, workDir, numParams, args.workers,
+                                                                     numThreads=args.threads, backend=args.backend,
+                                                                     excludeMask=cloudMask)
+        elif args.coarse_factor is not None:
+            # The stack is fitted on a coarser grid, and only the pixels which the
+            # interpolated model doesn't fit are fitted at full resolution
+            c = numpy.zeros((numBands, numParams, numRows, numCols), dtype=numpy.float32)
+            rmse = numpy.zeros((numBands, numRows, numCols), dtype=numpy.float32)
+            results = coarse_fit.fit_stack_coarse(x, analyticStack, c, rmse, args.coarse_factor,
+                                                  tolerance=args.coarse_tolerance, numThreads=args.threads,
+                                                  backend=args.backend, excludeMask=cloudMask)
+            numAllocsAvoided = results.numAllocsAvoided
+            print('Coarse to fine: fitted %d of %d pixels at full resolution (%.1f%%)' %
+                  (results.numRefitted, results.numPixels, 100.0 * results.numRefitted / results.numPixels))
+            if results.numSampled > 0:
+                print('Coarse to fine: %d sampled pixels differ from a full fit by %.1f (max %.1f) in their '
+                      'predictions and %.1f in their RMSE' %
+                      (results.numSampled, results.meanPredictionDiff, results.maxPredictionDiff, results.meanRmseDiff))
+        else:
+            c = numpy.zeros((numBands, numParams, numRows, numCols), dtype=numpy.float32)
+            rmse = numpy.zeros((numBands, numRows, numCols), dtype=numpy.float32)
+            numAllocsAvoided = tile_fit.fit_stack(x, analyticStack, c, rmse, numThreads=args.threads,
+                                                  backend=args.backend, excludeMask=cloudMask)
+        print('GSL allocations avoided by workspace reuse: %d' % numAllocsAvoided)
+
+        save_outputs(basepath, c, rmse, juldate, analyticStack, saveAnalytic=(cube is None),
+                     outputFormat=args.output_format, georef=image_georeference(analyticFiles[0]),
+                     images=image_states(analyticFiles))
+    finally:
+        if workDir is not None:
+            analyticStack = None
+            shutil.rmtree(workDir)
+
+
 def parse_params():
     parser = argparse.ArgumentParser()
     parser.add_argument('--use-udm',
                         action='store_true',
                         help='use UDM to exclude cloud pixels for training',
                         default=False)
-
-    return parser.parse_args()
+    parser.add_argument('--threads',
+                        type=int,
+                        help='number of threads used to fit the regressions',
+                        default=1)
+    parser.add_argument('--backend',
+                        choices=robustregression.BACKENDS,
+                        help='regression implementation: the GSL C extension, or batched numpy IRLS',
+                        default=robustregression.BACKEND_GSL)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='number of worker processes which fit tiles of the AOI',
+                        default=1)
+    parser.add_argument('--io-threads',
+                        type=int,
+                        help='number of threads reading the images',
+                        default=4)
+    parser.add_argument('--datacube',
+                        action='store_true',
+                        help='read the images through the persistent datacube, which only re-reads '
+                             'new or changed images',
+                        default=False)
+    parser.add_argument('--output-format',
+                        choices=coeff_store.FORMATS,
+                        help='format of the whole coefficient, rmse and analytic arrays: .npy files, or tiled '
+                             'and compressed GeoTIFFs with the georeferencing of the images',
+                        default=coeff_store.FORMAT_NPY)
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='refresh the stored model with the new or rewritten images, only fitting again the pixels '
+                             'which the new images do not fit, instead of fitting the whole model',
+                        default=False)
+    parser.add_argument('--refresh-max-iter',
+                        type=int,
+                        help='maximum number of iterations of each pixel fitted again by --incremental',
+                        default=refresh.REFRESH_MAX_ITER)
+    parser.add_argument('--refresh-rmse-factor',
+                        type=float,
+                        help='--incremental fits a pixel again if a new observation is further from the '
+                             'model than this many times its RMSE',
+                        default=refresh.REFRESH_RMSE_FACTOR)
+    parser.add_argument('--memory-mb',
+                        type=int,
+                        help='stream the AOI in blocks of rows using about this much memory (MB), '
+                             'instead of loading the whole stack',
+                        default=None)
+    parser.add_argument('--coarse-factor',
+                        type=int,
+                        help='fit the AOI on a grid of blocks of this many pixels on a side, and only fit at '
+                             'full resolution the pixels which the interpolated model does not fit',
+                        default=None)
+    parser.add_argument('--coarse-tolerance',
+                        type=float,
+                        help='--coarse-factor fits a pixel at full resolution if the robust RMSE of the '
+                             'interpolated model is more than this, in TOAR units, in any band',
+                        default=coarse_fit.COARSE_TOLERANCE)
+
+    args = parser.parse_args()
+    if args.memory_mb is not None and args.workers > 1:
+        parser.error('--memory-mb and --workers cannot be used together')
+    if args.coarse_factor is not None:
+        if args.coarse_factor < 2:
+            parser.error('--coarse-factor must be at least 2')
+        if args.memory_mb is not None or args.workers > 1:
+            parser.error('--coarse-factor cannot be used with --memory-mb or --workers')
+
+    return args
 
 
 if __name__ == "__main__":
     start = time.time()
 
     args = parse_params()
-    create_or_clean_folder(COEFFICIENTS_FOLDER)
+    if not args.incremental:
+        create_or_clean_folder(COEFFICIENTS_FOLDER)
     tmask(args, ANALYTIC_LIST_FILE, DATE_LIST_FILE, COEFFICIENTS_FOLDER)
 
     elapsed = time.time() - start
@@ -22,7 +22,9 @@ ANALYTIC_LIST_FILE = os.path.join(DATA_FOLDER, 'toar_images/image_list.txt')
 DATE_LIST_FILE = os.path.join(DATA_FOLDER, 'toar_images/juliandate_list.txt')
 COEFFICIENTS_FOLDER = os.path.join(DATA_FOLDER, 'coeffs')
 RESULTS_FOLDER = os.path.join(DATA_FOLDER, 'results')
+PREDICTIONS_FOLDER = os.path.join(DATA_FOLDER, 'predictions')
 PLOTS_FOLDER = os.path.join(DATA_FOLDER, 'plots')
+DATACUBE_FOLDER = os.path.join(DATA_FOLDER, 'datacube')
 
 
 def create_or_clean_folder(folder):